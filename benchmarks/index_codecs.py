@@ -0,0 +1,53 @@
+"""
+    Measures the time taken to encode and decode a key store index in each index format, along with the encoded size.
+    Formats whose optional package isn't installed are skipped.
+
+    PYTHONPATH=. python benchmarks/index_codecs.py --secrets 10000 100000
+"""
+import argparse
+import time
+from typing import Dict, Callable, Tuple
+
+from quick_manage.impl_helpers import KeyStoreIndex, INDEX_FORMATS, get_codec, decode_index, sha1_digest
+
+
+def make_data(count: int) -> Dict:
+    secrets = []
+    for i in range(count):
+        keys = {k: sha1_digest(f"{i}-{k}") for k in ["fullchain", "chain", "private", "cert"]}
+        secrets.append({"name": f"site{i % 100}/cert{i}", "meta_data": {"type": "certificate"}, "keys": keys})
+    return {"secrets": secrets}
+
+
+def timed(action: Callable[[], object]) -> Tuple[object, float]:
+    start = time.perf_counter()
+    result = action()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--secrets", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+
+    for count in args.secrets:
+        data = make_data(count)
+        print(f"{count} secrets with 4 keys each")
+        print(f"  {'format': <14} {'size': >10} {'encode': >10} {'decode': >10} {'load': >10}")
+        for name in INDEX_FORMATS:
+            codec = get_codec(name)
+            try:
+                raw, encode_time = timed(lambda: codec.encode(data))
+            except RuntimeError as e:
+                print(f"  {name: <14} skipped, {e}")
+                continue
+
+            # Decoding includes recognizing the format, and loading includes building the index from the contents
+            (decoded, _), decode_time = timed(lambda: decode_index(raw))
+            _, load_time = timed(lambda: KeyStoreIndex.from_dict(decoded))
+            print(f"  {name: <14} {len(raw) / 1024 / 1024: >6.1f} MiB {encode_time: >8.2f} s {decode_time: >8.2f} s "
+                  f"{load_time: >8.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+    Measures the memory used by a loaded key store index, comparing the compact KeyStoreIndex with the same secrets
+    held as one validated Secret dataclass per secret, which is how the index used to be held. Both are loaded from
+    the same JSON text and only what remains once loading has finished is counted.
+
+    PYTHONPATH=. python benchmarks/index_memory.py --secrets 200000
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from typing import Callable, Tuple
+
+from quick_manage.impl_helpers import KeyStoreIndex, sha1_digest
+from quick_manage.keys import Secret
+
+
+def make_text(count: int) -> str:
+    secrets = []
+    for i in range(count):
+        keys = {k: sha1_digest(f"{i}-{k}") for k in ["fullchain", "chain", "private", "cert"]}
+        secrets.append({"name": f"site{i % 100}/cert{i}", "meta_data": {"type": "certificate"}, "keys": keys})
+    return json.dumps({"secrets": secrets})
+
+
+def load_dataclasses(text: str):
+    return {x["name"]: Secret(x["name"], x.get("meta_data"), x.get("keys")) for x in json.loads(text)["secrets"]}
+
+
+def measure(load: Callable[[], object]) -> Tuple[float, float]:
+    """ Returns the megabytes held by the loaded object and the seconds it took to load, which is timed separately
+    since tracing allocations slows loading down """
+    gc.collect()
+    start = time.perf_counter()
+    loaded = load()
+    elapsed = time.perf_counter() - start
+    del loaded
+
+    gc.collect()
+    tracemalloc.start()
+    loaded = load()
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del loaded
+    return held / 1024 / 1024, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--secrets", type=int, default=200000)
+    args = parser.parse_args()
+
+    text = make_text(args.secrets)
+    results = [
+        ("Secret dataclasses", measure(lambda: load_dataclasses(text))),
+        ("KeyStoreIndex", measure(lambda: KeyStoreIndex.from_dict(json.loads(text)))),
+    ]
+
+    print(f"{args.secrets} secrets with 4 keys each")
+    for name, (megabytes, seconds) in results:
+        print(f"  {name: <20} {megabytes: >8.1f} MiB {seconds: >8.2f} s")
+
+
+if __name__ == "__main__":
+    main()
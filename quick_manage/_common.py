@@ -1,6 +1,6 @@
 from abc import ABC
 from dataclasses import dataclass, field
-from typing import Dict, Type, List, Callable, Optional
+from typing import Dict, Type, List, Callable, Optional, BinaryIO
 from dacite import from_dict
 from dacite.core import T
 
@@ -89,6 +89,16 @@ class ClientAction:
     actions: List[str]
 
 
+@dataclass
+class FileUpload:
+    """ The content of a file to upload along with the permissions to give it. A mode or owner which isn't set is
+    taken from the file being replaced, if there is one. """
+    stream: BinaryIO
+    mode: Optional[int] = None
+    uid: Optional[int] = None
+    gid: Optional[int] = None
+
+
 class IFileAccess(ABC):
     def get(self) -> bytes:
         pass
@@ -101,5 +111,22 @@ class HostClient(ABC):
     def put_data(self, destination: str, data: str):
         raise NotImplementedError()
 
+    def put_stream(self, destination: str, stream: BinaryIO):
+        """ Writes the bytes read from a stream to the destination. Clients should override this to upload the stream
+        as it is read. """
+        self.put_data(destination, stream.read().decode("utf-8"))
+
+    def put_many(self, files: Dict[str, FileUpload]):
+        """ Uploads several files at once, by destination path. Clients should override this to upload them together
+        and replace each destination atomically with its permissions already set. By default the files are uploaded
+        one at a time with put_stream and the permissions are ignored. """
+        for destination, upload in files.items():
+            self.put_stream(destination, upload.stream)
+
+    def file_hashes(self, paths: List[str]) -> Dict[str, str]:
+        """ Returns the sha1 hashes of the contents of the files at the paths, leaving out any which don't exist.
+        Clients which can't hash remote files return no hashes, so that every file is treated as changed. """
+        return {}
+
     def action(self, command: str):
         raise NotImplementedError()
@@ -74,10 +74,9 @@ class KeyPathType(ParamType):
 
             # We do not have any of the key, so we should find all possible secrets and keys which might match
             options = []
-            for s in key_store.all().values():
-                if s.name.startswith(path.secret):
-                    for k in (s.keys.keys() if s.keys else {}):
-                        options.append(CompletionItem(f"{path.store}/{s.name}@{k}"))
+            for s in key_store.iter_secrets(path.secret):
+                for k in (s.keys.keys() if s.keys else {}):
+                    options.append(CompletionItem(f"{path.store}/{s.name}@{k}"))
             return options
 
         else:
@@ -85,7 +84,7 @@ class KeyPathType(ParamType):
             candidate_stores = [(k, v) for k, v in qc.key_stores.items() if k.startswith(incomplete)]
             options = []
             for store_name, key_store in candidate_stores:
-                for s in key_store.all().values():
+                for s in key_store.iter_secrets():
                     for k in (s.keys.keys() if s.keys else {}):
                         options.append(CompletionItem(f"{store_name}/{s.name}@{k}"))
             return options
@@ -108,9 +107,8 @@ class SecretPathType(ParamType):
 
             # We do not have any of the key, so we should find all possible secrets and keys which might match
             options = []
-            for s in key_store.all().values():
-                if s.name.startswith(path.secret):
-                    options.append(CompletionItem(f"{path.store}/{s.name}"))
+            for s in key_store.iter_secrets(path.secret):
+                options.append(CompletionItem(f"{path.store}/{s.name}"))
             return options
 
         else:
@@ -118,7 +116,7 @@ class SecretPathType(ParamType):
             candidate_stores = [(k, v) for k, v in qc.key_stores.items() if k.startswith(incomplete)]
             options = []
             for store_name, key_store in candidate_stores:
-                for s in key_store.all().values():
+                for s in key_store.iter_secrets():
                     options.append(CompletionItem(f"{store_name}/{s.name}"))
             return options
 
@@ -140,9 +138,8 @@ class SecretOrEndpointType(ParamType):
 
             # We do not have any of the key, so we should find all possible secrets and keys which might match
             options = []
-            for s in key_store.all().values():
-                if s.name.startswith(path.secret) and s.get_type_name() == "certificate":
-                    options.append(CompletionItem(f"{path.store}/{s.name}"))
+            for s in key_store.iter_secrets(path.secret, type="certificate"):
+                options.append(CompletionItem(f"{path.store}/{s.name}"))
             return options
 
         else:
@@ -150,7 +147,6 @@ class SecretOrEndpointType(ParamType):
             candidate_stores = [(k, v) for k, v in qc.key_stores.items() if k.startswith(incomplete)]
             options = []
             for store_name, key_store in candidate_stores:
-                for s in key_store.all().values():
-                    if s.get_type_name() == "certificate":
-                        options.append(CompletionItem(f"{store_name}/{s.name}"))
+                for s in key_store.iter_secrets(type="certificate"):
+                    options.append(CompletionItem(f"{store_name}/{s.name}"))
             return options
@@ -1,9 +1,14 @@
+import fnmatch
 import getpass
+import threading
+from dataclasses import asdict
 from io import BytesIO
+from typing import Optional
 
 import click
 
-from quick_manage.environment import Environment, echo_line, echo_json
+from quick_manage.environment import Environment, echo_line, echo_json, echo_table
+from quick_manage.hosts import deploy_certs
 from quick_manage.ssh.client import create_remote_admin, SSHClient
 from quick_manage.ssh.keys import generate_key_pair, private_key_from_string
 from quick_manage.cli.common import HostNameType, StoreVarType, KeyPathType, HostCertType
@@ -33,25 +38,73 @@ def list_command(ctx: click.Context, json_output):
 
 
 @host_command.command(name="update-cert")
-@click.argument("host-cert", type=HostCertType())
+@click.argument("host-cert", type=HostCertType(), required=False)
+@click.option("-a", "--all", "all_hosts", is_flag=True, help="Deploy certificates to every host")
+@click.option("--hosts", "host_pattern", type=str, default=None,
+              help="Deploy certificates to the hosts whose names match a glob pattern")
+@click.option("-j", "--workers", type=int, default=8, help="Number of hosts to deploy to at once (default is 8)")
+@click.option("--json", "json_output", is_flag=True, help="Write a JSON report instead of the summary table")
+@click.option("-f", "--force", is_flag=True, help="Upload every file and run post-deployment commands even if the "
+                                                  "host already has the same content")
 @click.pass_context
-def update_cert(ctx: click.Context, host_cert: str):
+def update_cert(ctx: click.Context, host_cert: Optional[str], all_hosts: bool, host_pattern: Optional[str],
+                workers: int, json_output: bool, force: bool):
+    """ Deploy certificates to a host, optionally naming a single certificate as host@cert, or to many hosts at once
+    with --all or --hosts. A failure on one host doesn't stop the deployment to the others. Files the host already has
+    are not uploaded again, and post-deployment commands only run when something changed. """
     env = Environment.default()
 
-    host_name, *cert_name = host_cert.split("@")
+    if sum([host_cert is not None, all_hosts, host_pattern is not None]) != 1:
+        echo_line(env.fail("Specify exactly one of a host, --all or --hosts"), err=True)
+        ctx.exit(2)
 
-    try:
-        host = env.active_context.hosts[host_name]
-    except:
-        echo_line(env.fail(f"Could not get host {host_name}"), err=True)
+    if host_cert is not None:
+        host_name, *cert_names = host_cert.split("@")
+        if host_name not in env.active_context.host_names:
+            echo_line(env.fail(f"Could not get host {host_name}"), err=True)
+            ctx.exit(1)
+    else:
+        host_names = sorted(env.active_context.host_names)
+        if host_pattern is not None:
+            host_names = [n for n in host_names if fnmatch.fnmatch(n, host_pattern)]
+        cert_names = []
+
+    hosts = env.active_context.hosts
+    targets = []
+    for name in ([host_name] if host_cert is not None else host_names):
+        host = hosts[name]
+        configs = [c for c in host.config.certs if not cert_names or c.name in cert_names]
+        if configs:
+            targets.append((host, configs))
+
+    if not targets:
+        echo_line(env.warning("No certificates to deploy"), err=True)
         return
 
-    configs = host.config.certs if not cert_name else [c for c in host.config.certs if c.name in cert_name]
-    for cert_config in configs:
-        try:
-            host.deploy_cert(cert_config, message=lambda s: echo_line(f"  {s}"))
-        except Exception as e:
-            echo_line(env.fail(f"Error on cert {cert_config.name}: {e}"), err=True)
+    lock = threading.Lock()
+
+    def _message(name: str, text: str):
+        with lock:
+            echo_line(f"[{name}] {text}", err=json_output)
+
+    results = deploy_certs(targets, env.active_context.key_getter, workers, message=_message, force=force)
+
+    if json_output:
+        echo_json([asdict(r) for r in results])
+    else:
+        echo_line()
+        rows = [["Host", "Certificate", "Result", "Time", "Error"]]
+        for r in results:
+            status = "failed" if not r.success else "updated" if r.changed else "unchanged"
+            rows.append([r.host, r.cert, status, f"{r.seconds:.1f} s", r.error or ""])
+        echo_table(rows, header=env.head)
+        failed = sum(1 for r in results if not r.success)
+        updated = sum(1 for r in results if r.changed)
+        summary = f"{updated} certificates updated, {len(results) - failed - updated} unchanged, {failed} failed"
+        echo_line(env.fail(summary) if failed else env.success(summary))
+
+    if any(not r.success for r in results):
+        ctx.exit(1)
 
 
 @host_command.command(name="ssh")
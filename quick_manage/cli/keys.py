@@ -1,4 +1,5 @@
-import sys
+import io
+import json
 import typing as t
 from typing import List, Dict
 
@@ -7,7 +8,8 @@ from click import Context, Command
 
 from quick_manage.cli.common import StoreVarType, SecretPathType, SecretPath, KeyPathType, StoreBuilderType
 from quick_manage.environment import Environment, echo_line, echo_json, echo_table
-from quick_manage.keys import Secret, python_variable_name, IKeyCreateCommand, IKeyStore
+from quick_manage.keys import Secret, python_variable_name, IKeyCreateCommand, IKeyStore, copy_secrets, sync_stores
+from quick_manage.sqlite import SqliteKeyStore
 
 
 @click.group(name="key")
@@ -50,61 +52,105 @@ def store_create(ctx: Context, store_type):
     raise NotImplementedError()
 
 
+@store.command(name="migrate")
+@click.pass_context
+@click.argument("store_name", type=StoreVarType())
+def store_migrate(ctx: Context, store_name: str):
+    """ Move the data in a key store into the layout it is configured for, and rewrite its index in the configured
+    index format. An interrupted migration may be run again, and the store can be used while the migration is in
+    progress. """
+    env = Environment.default()
+
+    key_store = env.active_context.key_stores.get(store_name, None)
+    if not key_store:
+        echo_line(env.fail(f"No key store named '{store_name}' was found in the active context"))
+        return
+
+    echo_line(env.head(f"Migrating key store '{store_name}' ({key_store.type_name})"))
+    key_store.migrate(message=lambda s: echo_line(f"  {s}"))
+
+
+@store.command(name="import")
+@click.pass_context
+@click.argument("store_name", type=StoreVarType())
+@click.argument("source_name", type=StoreVarType())
+def store_import(ctx: Context, store_name: str, source_name: str):
+    """ Copy every secret from another key store into a SQLite key store in one transaction. """
+    env = Environment.default()
+
+    key_store = env.active_context.key_stores.get(store_name, None)
+    source = env.active_context.key_stores.get(source_name, None)
+    for name, found in [(store_name, key_store), (source_name, source)]:
+        if not found:
+            echo_line(env.fail(f"No key store named '{name}' was found in the active context"))
+            return
+
+    if not isinstance(key_store, SqliteKeyStore):
+        echo_line(env.fail(f"The key store '{store_name}' is a {key_store.type_name} store, only SQLite key stores "
+                           f"can import other stores"))
+        return
+
+    echo_line(env.head(f"Importing key store '{source_name}' into '{store_name}'"))
+    key_store.import_store(source, message=lambda s: echo_line(f"  {s}"))
+
+
 @main.command(name="list")
 @click.option("-j", "--json", "json_output", is_flag=True, help="Use JSON output")
 @click.option("-p", "--prefix", "secret_prefix", type=SecretPathType(), default=None,
               help="A prefix used to exclude secrets which don't match")
+@click.option("-t", "--type", "secret_type", default=None, help="Only list secrets of this type")
 @click.pass_context
-def list_all(ctx: click.Context, json_output, secret_prefix):
+def list_all(ctx: click.Context, json_output, secret_prefix, secret_type):
     """ Lists secrets in the active context with an optional prefix filter. """
     env = Environment.default()
 
     prefix = SecretPath.from_text(secret_prefix if secret_prefix else "")
 
-    working = []
-
     if prefix.secret:
         # Already have the completed store name and some part of the path
         key_store = env.active_context.key_stores.get(prefix.store, None)
-        if key_store:
-            for s in key_store.all().values():
-                if s.name.startswith(prefix.secret):
-                    working.append((prefix.store, s))
+        candidate_stores = [(prefix.store, key_store)] if key_store else []
     else:
-        candidate_stores = [(k, v) for k, v in env.active_context.key_stores.items() if k.startswith(prefix.store)]
-        for store_name, key_store in candidate_stores:
-            for s in key_store.all().values():
-                working.append((store_name, s))
+        candidate_stores = sorted((k, v) for k, v in env.active_context.key_stores.items()
+                                  if k.startswith(prefix.store))
+
+    # Stores are visited in order of name and yield their secrets in order of name, so nothing needs sorting
+    working = ((n, s) for n, k in candidate_stores for s in k.iter_secrets(prefix.secret, secret_type))
 
     if json_output:
-        collected = [{"store": n, "secret": s.name, "type": s.get_type_name()} for n, s in working]
-        echo_json(collected)
+        # The array is written one element at a time so that output starts before the last store is read
+        click.echo("[", nl=False)
+        for i, (n, s) in enumerate(working):
+            click.echo((", " if i else "") + json.dumps({"store": n, "secret": s.name, "type": s.get_type_name()}),
+                       nl=False)
+        click.echo("]")
         return
 
-    list_of_rows = []
+    list_of_rows = [["Store", "Secret", "Type", "Key Count"]]
     for name, secret in working:
         list_of_rows.append([name, secret.name, f"{secret.get_type_name()}", f"{len(secret.get_keys())} keys"])
-    list_of_rows.sort()
-    list_of_rows = [["Store", "Secret", "Type", "Key Count"]] + list_of_rows
     echo_table(list_of_rows, header=env.head, spacing=3)
 
 
 @main.command(name="put")
 @click.argument("key_path", type=KeyPathType())
-@click.argument("file", type=click.File('r'), default=sys.stdin)
+@click.argument("file", type=click.File('rb'), default="-")
+@click.option("-b", "--binary", is_flag=True, help="Store the contents as raw bytes rather than as text")
 @click.option("-j", "--json", "json_output", is_flag=True, help="Use JSON output")
 @click.pass_context
-def put(ctx: click.Context, key_path: str, file, json_output):
+def put(ctx: click.Context, key_path: str, file, binary: bool, json_output):
     """ Put a value for a secret/key into a store. The key contents may be specified as a file name or by redirection
-    from stdin
+    from stdin. Binary contents, such as a DER encoded certificate, are stored as they are with --binary.
 
     \b
     Examples:
         quick key put store_name/secret_name this_file.pem
         quick key put store_name/secret_name < /path/to/other/file
         curl https://key.example.com/value.txt | quick key put store_name/key_name
+        quick key put --binary store_name/secret_name@der cert.der
     """
-    data = file.read()
+    # Binary contents are streamed into the store, while text is read with its line endings normalized
+    data = None if binary else io.TextIOWrapper(file, encoding="utf-8").read()
     env = Environment.default()
 
     path = SecretPath.from_text(key_path)
@@ -118,7 +164,11 @@ def put(ctx: click.Context, key_path: str, file, json_output):
             echo_line(env.fail(f"No key store named '{path.store}' was found in the active context"))
             return
 
-        key_store.put_value(path.secret, path.key, data)
+        if binary:
+            key_store.put_stream(path.secret, path.key, file)
+        else:
+            key_store.put_value(path.secret, path.key, data)
+
         if json_output:
             echo_json({"name": path.secret, "value": data, "store": path.store})
         else:
@@ -130,9 +180,13 @@ def put(ctx: click.Context, key_path: str, file, json_output):
 @main.command(name="copy-secret")
 @click.argument("source_path", type=SecretPathType())
 @click.argument("destination_path", type=SecretPathType())
+@click.option("-r", "--recursive", is_flag=True, help="Also copy every secret under the source path")
+@click.option("-w", "--workers", type=int, default=8, show_default=True,
+              help="The number of values to transfer at the same time")
 @click.pass_context
-def copy_secret(ctx: click.Context, source_path: str, destination_path: str):
-    """ Copy a secret from one location to another. """
+def copy_secret(ctx: click.Context, source_path: str, destination_path: str, recursive: bool, workers: int):
+    """ Copy a secret from one location to another. Content the destination already holds is not copied again, and
+    content between S3 stores on the same server is copied by the server. """
     env = Environment.default()
 
     source = SecretPath.from_text(source_path)
@@ -158,32 +212,67 @@ def copy_secret(ctx: click.Context, source_path: str, destination_path: str):
             echo_line(env.fail(f"No key store named '{destination.store}' was found in the active context"))
             return
 
-        # Validate that the source secret exists
-        source_meta = source_key_store.get_meta(source.secret)
-        if source_meta is None:
+        # Validate that the source secrets exist
+        source_secrets = {}
+        if source_key_store.has_secret(source.secret):
+            source_secrets[source.secret] = source_key_store.get_meta(source.secret)
+        if recursive:
+            subtree = source.secret.rstrip("/") + "/"
+            source_secrets.update((s.name, s) for s in source_key_store.iter_secrets(subtree))
+        names = list(source_secrets.keys())
+        if not names:
             echo_line(env.fail(f"No secret named '{source.secret}' was found in the '{source.store}' key store"))
             return
+        pairs = [(n, destination.secret + n[len(source.secret):]) for n in names]
 
-        # Validate that the destination secret does not exist
-        dest_secrets = destination_key_store.all()
-        if destination.secret in dest_secrets:
+        # Validate that the destination secrets do not exist
+        existing = [d for _, d in pairs if destination_key_store.has_secret(d)]
+        if existing:
             echo_line(env.fail(
-                f"A secret named '{destination.secret}' already exists in the '{destination.store}' key store"))
+                f"A secret named '{existing[0]}' already exists in the '{destination.store}' key store"))
             return
 
-        # Copy all keys
-        for key in source_meta.keys.keys():
-            value = source_key_store.get_value(source.secret, key)
-            destination_key_store.put_value(destination.secret, key, value)
-            echo_line(f"Copied '{source.store}/{source.secret}@{key}' to '{destination.store}/{destination.secret}@{key}'")
+        # Transfer the content the destination is missing, then write the destination index once
+        copy_secrets(source_key_store, destination_key_store, pairs, workers=workers,
+                     message=lambda s: echo_line(f"  {s}"))
 
-        # Copy all metadata
-        destination_key_store.set_meta(destination.secret, source_meta.meta_data)
+        for source_name, destination_name in pairs:
+            for key in source_secrets[source_name].get_keys():
+                echo_line(f"Copied '{source.store}/{source_name}@{key}' to "
+                          f"'{destination.store}/{destination_name}@{key}'")
 
     except KeyError as e:
         echo_line(env.fail(e), err=True)
 
 
+@main.command(name="sync")
+@click.argument("source_name", type=StoreVarType())
+@click.argument("destination_name", type=StoreVarType())
+@click.option("-p", "--prefix", "secret_prefix", default=None, help="Only sync secrets whose names start with this")
+@click.option("-d", "--delete", is_flag=True, help="Remove secrets and keys which aren't in the source")
+@click.option("-w", "--workers", type=int, default=8, show_default=True,
+              help="The number of values to transfer at the same time")
+@click.pass_context
+def sync(ctx: click.Context, source_name: str, destination_name: str, secret_prefix: str, delete: bool, workers: int):
+    """ Make the secrets in one key store match those in another, transferring only the content the destination is
+    missing. An interrupted sync may simply be run again. """
+    env = Environment.default()
+
+    source = env.active_context.key_stores.get(source_name, None)
+    destination = env.active_context.key_stores.get(destination_name, None)
+    for name, found in [(source_name, source), (destination_name, destination)]:
+        if not found:
+            echo_line(env.fail(f"No key store named '{name}' was found in the active context"))
+            return
+
+    echo_line(env.head(f"Syncing key store '{source_name}' into '{destination_name}'"))
+    try:
+        sync_stores(source, destination, prefix=secret_prefix, delete=delete, workers=workers,
+                    message=lambda s: echo_line(f"  {s}"))
+    except (KeyError, ValueError) as e:
+        echo_line(env.fail(e), err=True)
+
+
 @main.command(name="info")
 @click.argument("secret_path", type=SecretPathType())
 @click.option("-j", "--json", "json_output", is_flag=True, help="Use JSON output")
@@ -279,10 +368,13 @@ def remove_secret(ctx: click.Context, secret_path: str, json_output: bool, confi
             return
 
         meta_data: Secret = key_store.get_meta(path.secret)
-        json_deleted = []
-        for key in meta_data.keys.keys():
-            key_store.rm(path.secret, key)
+        key_names = list(meta_data.keys.keys())
+        with key_store.batch() as batch:
+            for key in key_names:
+                batch.rm(path.secret, key)
 
+        json_deleted = []
+        for key in key_names:
             if json_output:
                 json_deleted.append({"name": path.secret, "key": key})
             else:
@@ -354,9 +446,10 @@ def _secret_type(type_name: str, environ: Environment):
                 echo_line(environ.fail(f"A secret already exists at '{path.secret}'"))
                 return
 
-            for key_name, data in found_keys.items():
-                key_store.put_value(path.secret, key_name, data)
-            key_store.set_meta(path.secret, {"type": type_name})
+            with key_store.batch() as batch:
+                for key_name, data in found_keys.items():
+                    batch.put(path.secret, key_name, data)
+                batch.set_meta(path.secret, {"type": type_name})
 
             echo_line(f"Stored value to secret '{path.secret}' in store '{path.store}'")
         except KeyError as e:
@@ -386,6 +479,7 @@ def _create_command(creator: IKeyCreateCommand, environ: Environment):
                 echo_line(environ.fail(str(e)), err=True)
                 return
 
+            batch = key_store.batch()
             if key_store.has_secret(path.secret):
                 if not overwrite:
                     echo_line(environ.fail(f"A secret already exists at '{path.secret}' "
@@ -395,12 +489,12 @@ def _create_command(creator: IKeyCreateCommand, environ: Environment):
                     secret = key_store.get_meta(path.secret)
                     for sub_key in secret.keys:
                         print(f"rm {path.secret}@{sub_key}")
-                        key_store.rm(path.secret, sub_key)
+                        batch.rm(path.secret, sub_key)
 
-            sub_kwargs = {k: kwargs[k] for k in kwargs.keys() if k not in {"secret_path", "overwrite"}}
-            for key_name, data in creator.on_create(**sub_kwargs).items():
-                key_store.put_value(path.secret, key_name, data)
-            key_store.set_meta(path.secret, {"type": creator.secret_type_name})
+            for key_name, data in key_values.items():
+                batch.put(path.secret, key_name, data)
+            batch.set_meta(path.secret, {"type": creator.secret_type_name})
+            batch.commit()
 
             echo_line(f"Stored value to secret '{path.secret}' in store '{path.store}'")
         except KeyError as e:
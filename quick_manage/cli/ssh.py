@@ -38,8 +38,11 @@ def main(ctx: Context, host_name: str, commands: List[str]):
 
     if commands:
         conn = client.connect()
-        for c in commands:
-            conn.run(c)
+        try:
+            for c in commands:
+                conn.run(c)
+        finally:
+            client.close()
     else:
         if client.config.key is None:
             echo_line(env.fail("Must have a private key in order to launch ssh on this host"))
@@ -5,7 +5,7 @@ from dacite import from_dict
 from dacite.core import T
 
 from .._common import EntityConfig, EntityTypeBuildInfo
-from ..keys import IKeyStore
+from ..keys import IKeyStore, KeyGetter
 from ..hosts import Host
 
 
@@ -15,6 +15,11 @@ class IContext(ABC):
     def key_stores(self) -> Dict[str, IKeyStore]:
         raise NotImplementedError()
 
+    @property
+    def key_getter(self) -> KeyGetter:
+        """ The key getter shared by everything in this context, which may cache the values it retrieves """
+        raise NotImplementedError()
+
     @property
     def host_names(self) -> List[str]:
         raise NotImplementedError()
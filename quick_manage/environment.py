@@ -12,6 +12,7 @@ from .file import FolderKeyStore, LocalFileContext
 from .config import QuickConfig
 from .keys import SecretType, IKeyCreateCommand, LetsEncryptCertificate
 from .s3 import S3Config, S3Store
+from .sqlite import SqliteKeyStore
 from .ssh.client import SSHClient
 
 
@@ -71,6 +72,7 @@ class Environment:
 
         self.builders.key_store.register("folder", FolderKeyStore, FolderKeyStore.Config)
         self.builders.key_store.register("s3", S3Store, S3Config)
+        self.builders.key_store.register("sqlite", SqliteKeyStore, SqliteKeyStore.Config)
 
         self.builders.clients.register("ssh", SSHClient, SSHClient.Config)
 
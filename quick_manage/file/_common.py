@@ -1,6 +1,6 @@
 from abc import ABC
 from dataclasses import dataclass
-from typing import List, Optional, Dict, Callable, TextIO
+from typing import List, Optional, Dict, Callable, TextIO, Tuple, ContextManager, BinaryIO, Union
 
 
 @dataclass
@@ -30,9 +30,36 @@ class IFileProvider(ABC):
     def write_file(self, path: str) -> TextIO:
         raise NotImplementedError()
 
+    def read_binary(self, path: str) -> BinaryIO:
+        raise NotImplementedError()
+
+    def write_binary(self, path: str) -> BinaryIO:
+        raise NotImplementedError()
+
+    def append_file(self, path: str) -> ContextManager[TextIO]:
+        """ Opens a file for appending. The appended data must be durable on disk once the context exits. """
+        raise NotImplementedError()
+
+    def write_file_atomic(self, path: str, binary: bool = False) -> ContextManager[Union[TextIO, BinaryIO]]:
+        """ Opens a file for writing which replaces the file at the path once the context exits, such that readers see
+        either the old or the complete new contents but never a mix of the two, and the new contents are durable on
+        disk. If the context exits with an exception the old file is left in place. The file is opened in binary mode
+        if binary is set. """
+        raise NotImplementedError()
+
+    def lock(self, path: str) -> ContextManager:
+        """ Holds an exclusive advisory lock on the lock file at the path for as long as the context is open, waiting
+        for any other process which holds it. Only cooperating writers are affected; readers never wait. """
+        raise NotImplementedError()
+
     def checksum(self, path: str) -> str:
         raise NotImplementedError()
 
+    def signature(self, path: str) -> Optional[Tuple]:
+        """ Returns a value which changes whenever the file at the path is modified, or None if the file does not exist
+        or the provider cannot tell when files change """
+        return None
+
     def move_file(self, source: str, dest: str):
         raise NotImplementedError()
 
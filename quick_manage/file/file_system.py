@@ -1,5 +1,7 @@
 import os
-from typing import List, Optional, Callable, TextIO
+import tempfile
+from contextlib import contextmanager
+from typing import List, Optional, Callable, TextIO, Tuple, ContextManager, BinaryIO, Union
 from ._common import IFileProvider, FileInfo
 import hashlib
 import shutil
@@ -42,6 +44,53 @@ class FileSystem(IFileProvider):
             os.makedirs(folder)
         return open(path, "w")
 
+    def read_binary(self, path: str) -> BinaryIO:
+        return open(path, "rb")
+
+    def write_binary(self, path: str) -> BinaryIO:
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return open(path, "wb")
+
+    def append_file(self, path: str) -> ContextManager[TextIO]:
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return _durable(open(path, "a"))
+
+    @contextmanager
+    def write_file_atomic(self, path: str, binary: bool = False) -> ContextManager[Union[TextIO, BinaryIO]]:
+        folder, file_name = os.path.split(os.path.abspath(path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        descriptor, temp_path = tempfile.mkstemp(dir=folder, prefix=f".{file_name}.", suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb" if binary else "w") as handle:
+                yield handle
+                handle.flush()
+                os.fsync(handle.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        _sync_folder(folder)
+
+    @contextmanager
+    def lock(self, path: str) -> ContextManager:
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        with open(path, "a+") as handle:
+            _lock_file(handle)
+            try:
+                yield
+            finally:
+                _unlock_file(handle)
+
     def checksum(self, path: str) -> str:
         sha = hashlib.sha1()
         with open(path, "rb") as handle:
@@ -52,6 +101,13 @@ class FileSystem(IFileProvider):
                 sha.update(data)
         return sha.hexdigest()
 
+    def signature(self, path: str) -> Optional[Tuple]:
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return info.st_mtime_ns, info.st_size, info.st_ino
+
     def move_file(self, source: str, dest: str):
         if os.path.exists(dest):
             raise FileExistsError(f"The file {dest} already exists! Aborting rather than overwrite")
@@ -59,3 +115,46 @@ class FileSystem(IFileProvider):
 
     def exists(self, path: str) -> bool:
         return os.path.exists(path)
+
+
+try:
+    import fcntl
+
+    def _lock_file(handle):
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_file(handle):
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+    def _sync_folder(folder: str):
+        """ Flushes a folder's entries to disk so that a file renamed into it survives a crash """
+        descriptor = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+except ImportError:
+    import msvcrt
+
+    def _lock_file(handle):
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+
+    def _unlock_file(handle):
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _sync_folder(folder: str):
+        pass
+
+
+@contextmanager
+def _durable(handle: TextIO):
+    """ Closes the handle once the context exits, first flushing its contents through to the disk """
+    try:
+        yield handle
+        handle.flush()
+        os.fsync(handle.fileno())
+    finally:
+        handle.close()
@@ -1,11 +1,16 @@
 import os.path
-from typing import Dict, Optional, List, Tuple
+import uuid
+from typing import Dict, Optional, List, Tuple, Callable, BinaryIO, Iterable, Set, Iterator
 from dataclasses import dataclass, field
 
-from ..impl_helpers import to_yaml, from_yaml, KeyStoreIndex, sha1_digest
-from ..keys import Secret, IKeyStore
+from ..impl_helpers import get_codec, decode_index, KeyStoreIndex, IndexCache, apply_operations, copy_hashed
+from ..keys import Secret, IKeyStore, KeyStoreOperation
 from ._common import IFileProvider
 from .file_system import FileSystem
+from .index_journal import encode_records, replay
+
+
+_MAX_SHARD_DEPTH = 3
 
 
 class FolderKeyStore(IKeyStore):
@@ -16,64 +21,171 @@ class FolderKeyStore(IKeyStore):
     @dataclass
     class Config:
         path: str
+        journal: bool = False
+        compact_after: int = 500
+        shard_depth: int = 0
+        index_format: str = "yaml"
 
     def __init__(self, config: Config, file_system: Optional[IFileProvider] = None):
         self._file = file_system if file_system else FileSystem()
         self._path = config.path
+        self._journal = config.journal
+        self._compact_after = config.compact_after
+        if not 0 <= config.shard_depth <= _MAX_SHARD_DEPTH:
+            raise ValueError(f"The shard depth must be between 0 and {_MAX_SHARD_DEPTH}")
+        self._shard_depth = config.shard_depth
+        self._codec = get_codec(config.index_format)
+        self._index_format: Optional[str] = None
         self.__index_path: Optional[str] = None
+        self._journal_path = os.path.join(self._path, "index.log")
+        self._lock_path = os.path.join(self._path, "index.lock")
+        self._journal_entries = 0
+        self._journal_torn = False
+        self._cache = IndexCache()
 
-    def put_value(self, secret_name: str, key_name: Optional[str], value: str):
-        index = self._read_index()
-        sha = sha1_digest(value)
-        if not key_name:
-            key_name = "default"
-        target = index.find_or_create(secret_name)
+    @property
+    def index_cache(self) -> IndexCache:
+        """ The cache of the parsed index, which holds the hit and miss counters """
+        return self._cache
 
-        if target.keys is None:
-            target.keys = {}
-        target.keys[key_name] = sha
+    def put_value(self, secret_name: str, key_name: Optional[str], value: str):
+        self.apply([KeyStoreOperation(KeyStoreOperation.PUT, secret_name, key_name, value=value)])
 
-        self._write_index(index)
+    def rm(self, secret_name: str, key_name: Optional[str]):
+        self.apply([KeyStoreOperation(KeyStoreOperation.RM, secret_name, key_name)])
 
-        # Save the hash file
-        with self._file.write_file(self._key_path(sha)) as handle:
-            handle.write(value)
+    def apply(self, operations: List[KeyStoreOperation]):
+        # The index is read and written back under the lock so that a write by another process in between can't be
+        # lost, while readers rely on the snapshot being replaced atomically and never wait
+        with self._file.lock(self._lock_path):
+            self._apply(operations)
 
-    def rm(self, secret_name: str, key_name: Optional[str]):
-        index, target, sha = self._find_key(secret_name, key_name)
+    def _apply(self, operations: List[KeyStoreOperation]):
+        index = self._read_index()
+        try:
+            writes, released = apply_operations(index, operations)
 
-        # If no other secret/key uses this hash, we may delete the file
-        used = [h for s in index.secrets for h in s.keys.values() if h == sha]
-        if len(used) == 1:
-            self._file.remove(self._key_path(sha))
-        # used =[[h for h in s.keys.values()] for s in index.secrets]
+            # Save the hash files before the index which refers to them
+            for sha, value in writes.items():
+                self._write_blob(sha, value)
 
-        if len(target.keys) == 1:
-            # This is the only key left, we can delete the whole secret
-            index.secrets.remove(target)
-        else:
-            del target.keys[key_name]
+            if self._journal and not self._journal_torn:
+                self._append_journal(index, operations)
+            else:
+                self._write_index(index)
+        except Exception:
+            # The cached index is modified in place, so it must not keep operations which were never committed
+            self._cache.clear()
+            raise
 
-        self._write_index(index)
+        for sha in released:
+            for path in self._layout_paths(sha):
+                if self._file.exists(path):
+                    self._file.remove(path)
 
     def get_value(self, secret_name: str, key_name: Optional[str]) -> str:
         index, target, sha = self._find_key(secret_name, key_name)
-        with self._file.read_file(self._key_path(sha)) as handle:
+        with self._file.read_file(self._existing_key_path(sha)) as handle:
             return handle.read()
 
+    def open_value(self, secret_name: str, key_name: Optional[str]) -> BinaryIO:
+        index, target, sha = self._find_key(secret_name, key_name)
+        return self.open_blob(sha)
+
+    def put_stream(self, secret_name: str, key_name: Optional[str], stream: BinaryIO, length: Optional[int] = None):
+        # The content is hashed as it is written to a temporary file, which is then moved to its content address
+        incoming = os.path.join(self._path, f".incoming-{uuid.uuid4().hex}")
+        try:
+            with self._file.write_binary(incoming) as handle:
+                sha, _ = copy_hashed(stream, handle, length)
+
+            with self._file.lock(self._lock_path):
+                self._place_blob(incoming, sha)
+                self._apply([KeyStoreOperation(KeyStoreOperation.LINK, secret_name, key_name, sha=sha)])
+        finally:
+            if self._file.exists(incoming):
+                self._file.remove(incoming)
+
+    def has_blobs(self, hashes: Iterable[str]) -> Set[str]:
+        return {sha for sha in hashes if self._file.exists(self._existing_key_path(sha))}
+
+    def open_blob(self, sha: str) -> BinaryIO:
+        return self._file.read_binary(self._existing_key_path(sha))
+
+    def put_blob(self, sha: str, stream: BinaryIO, length: Optional[int] = None) -> int:
+        incoming = os.path.join(self._path, f".incoming-{uuid.uuid4().hex}")
+        try:
+            with self._file.write_binary(incoming) as handle:
+                actual, size = copy_hashed(stream, handle, length)
+            if actual != sha:
+                raise ValueError(f"The content given for '{sha}' has the hash '{actual}'")
+
+            # The lock keeps a writer which is releasing the same content from deleting it right after it was placed
+            with self._file.lock(self._lock_path):
+                self._place_blob(incoming, sha)
+            return size
+        finally:
+            if self._file.exists(incoming):
+                self._file.remove(incoming)
+
+    def _write_blob(self, sha: str, value: str):
+        """ Writes a text value to its content address, unless the content is already stored. The value is written to
+        a temporary file which is then moved into place, since other keys may refer to the same content and their
+        readers must never see a partly written file. """
+        if self._file.exists(self._existing_key_path(sha)):
+            return
+
+        incoming = os.path.join(self._path, f".incoming-{uuid.uuid4().hex}")
+        try:
+            with self._file.write_file(incoming) as handle:
+                handle.write(value)
+            self._place_blob(incoming, sha)
+        finally:
+            if self._file.exists(incoming):
+                self._file.remove(incoming)
+
+    def _place_blob(self, incoming: str, sha: str):
+        """ Moves a received content file to its content address, or discards it if the content is already there """
+        target = self._existing_key_path(sha)
+        if self._file.exists(target):
+            self._file.remove(incoming)
+            return
+
+        folder = os.path.dirname(target)
+        if not self._file.exists(folder):
+            self._file.mkdirs(folder)
+        self._file.move_file(incoming, target)
+
+    def get_values(self, requests: List[Tuple[str, Optional[str]]]) -> List[str]:
+        index = self._read_index()
+        hashes = [index.find_key(secret_name, key_name) for secret_name, key_name in requests]
+
+        contents = {}
+        for sha in hashes:
+            if sha not in contents:
+                with self._file.read_file(self._existing_key_path(sha)) as handle:
+                    contents[sha] = handle.read()
+        return [contents[sha] for sha in hashes]
+
     def get_meta(self, secret_name: str) -> Secret:
         index, target = self._find_secret(secret_name)
         return target
 
     def set_meta(self, secret_name: str, value: Dict):
-        index, target = self._find_secret(secret_name)
-        target.meta_data = value
-        self._write_index(index)
+        self.apply([KeyStoreOperation(KeyStoreOperation.SET_META, secret_name, meta_data=value)])
 
     def all(self) -> Dict[str, Secret]:
         index = self._read_index()
         return {x.name: x for x in index.secrets}
 
+    def has_secret(self, secret_name: str) -> bool:
+        return secret_name in self._read_index()
+
+    def iter_secrets(self, prefix: Optional[str] = None, type: Optional[str] = None) -> Iterator[Secret]:
+        for secret in self._read_index().with_prefix(prefix):
+            if not type or secret.get_type_name() == type:
+                yield secret
+
     def _find_secret(self, secret_name) -> Tuple[KeyStoreIndex, Secret]:
         index = self._read_index()
 
@@ -93,23 +205,133 @@ class FolderKeyStore(IKeyStore):
 
         return index, target, target.keys[key_name]
 
-    def _key_path(self, sha: str) -> str:
-        return os.path.join(self._path, sha)
+    def migrate(self, message: Optional[Callable[[str], None]] = None):
+        """ Moves content files from any other layout into the configured shard layout, and rewrites the index in the
+        configured format if it is stored in another one. Each file is moved on its own, so an interrupted migration
+        can simply be run again. """
+        with self._file.lock(self._lock_path):
+            moved = self._migrate(message)
+            previous = self._index_format
+            if previous not in (None, self._codec.name):
+                self._write_index(self._read_index())
+
+        if message:
+            message(f"Moved {moved} content files into the layout with shard depth {self._shard_depth}")
+            if previous not in (None, self._codec.name):
+                message(f"Converted the index from {previous} to {self._codec.name}")
+
+    def _migrate(self, message: Optional[Callable[[str], None]]) -> int:
+        moved = 0
+        for sha in self._read_index().content_hashes():
+            target = self._key_path(sha)
+            if self._file.exists(target):
+                continue
+
+            source = self._existing_key_path(sha)
+            if not self._file.exists(source):
+                if message:
+                    message(f"Content file for {sha} is missing")
+                continue
+
+            folder = os.path.dirname(target)
+            if not self._file.exists(folder):
+                self._file.mkdirs(folder)
+            self._file.move_file(source, target)
+            moved += 1
+
+        return moved
+
+    def _key_path(self, sha: str, depth: Optional[int] = None) -> str:
+        depth = self._shard_depth if depth is None else depth
+        shards = [sha[i * 2:i * 2 + 2] for i in range(depth)]
+        return os.path.join(self._path, *shards, sha)
+
+    def _layout_paths(self, sha: str) -> List[str]:
+        """ The paths a content file may be found at, starting with the configured layout """
+        others = [d for d in range(_MAX_SHARD_DEPTH + 1) if d != self._shard_depth]
+        return [self._key_path(sha, d) for d in [self._shard_depth] + others]
+
+    def _existing_key_path(self, sha: str) -> str:
+        """ The path of a content file in whichever layout it is currently stored, so that files which have not been
+        migrated yet can still be read """
+        paths = self._layout_paths(sha)
+        for path in paths:
+            if self._file.exists(path):
+                return path
+        return paths[0]
 
     @property
     def _index_path(self):
+        # The index keeps its name in every format, since the format is recognized from the contents
         if self.__index_path is None:
             self.__index_path = os.path.join(self._path, "index.yaml")
         return self.__index_path
 
+    def compact(self):
+        """ Folds any journal entries into the index snapshot and removes the journal """
+        with self._file.lock(self._lock_path):
+            self._write_index(self._read_index())
+
+    def _append_journal(self, index: KeyStoreIndex, operations: List[KeyStoreOperation]):
+        try:
+            with self._file.append_file(self._journal_path) as handle:
+                handle.write(encode_records(operations))
+        except Exception:
+            self._cache.clear()
+            raise
+
+        self._journal_entries += len(operations)
+        if self._journal_entries >= self._compact_after:
+            self._write_index(index)
+        else:
+            self._cache.put(self._signature(), index)
+
     def _write_index(self, index: KeyStoreIndex):
-        if not self._file.exists(self._path):
-            self._file.mkdirs(self._path)
-        with self._file.write_file(self._index_path) as handle:
-            to_yaml(index, handle)
+        """ Replaces the index snapshot, which must only be done while holding the lock """
+        try:
+            with self._file.write_file_atomic(self._index_path, binary=True) as handle:
+                handle.write(self._codec.encode(index.to_dict()))
+
+            # Replaying the journal over the new snapshot would be harmless, so a failure between replacing the
+            # snapshot and removing the journal loses nothing
+            if self._file.exists(self._journal_path):
+                self._file.remove(self._journal_path)
+        except Exception:
+            # The cached index may have been modified in place before the write failed
+            self._cache.clear()
+            raise
+
+        self._journal_entries = 0
+        self._journal_torn = False
+        self._index_format = self._codec.name
+        self._cache.put(self._signature(), index)
+
+    def _signature(self):
+        snapshot = self._file.signature(self._index_path)
+        journal = self._file.signature(self._journal_path)
+        if snapshot is None and journal is None:
+            return None
+        return snapshot, journal
 
     def _read_index(self) -> KeyStoreIndex:
-        if not self._file.exists(self._index_path):
-            return KeyStoreIndex()
-        with self._file.read_file(self._index_path) as handle:
-            return from_yaml(KeyStoreIndex, handle)
+        signature = self._signature()
+        cached = self._cache.get(signature)
+        if cached is not None:
+            return cached
+
+        index = KeyStoreIndex()
+        if self._file.exists(self._index_path):
+            # The index may have been written in any format, for instance before the store's format was changed
+            with self._file.read_binary(self._index_path) as handle:
+                data, self._index_format = decode_index(handle.read())
+            index = KeyStoreIndex.from_dict(data)
+
+        # The journal is replayed even when journaling is turned off, so that no entries are lost
+        self._journal_entries, self._journal_torn = 0, False
+        if self._file.exists(self._journal_path):
+            with self._file.read_file(self._journal_path) as handle:
+                count, clean = replay(index, handle)
+            self._journal_entries, self._journal_torn = count, not clean
+
+        self._cache.put(signature, index)
+        return index
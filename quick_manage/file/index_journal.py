@@ -0,0 +1,64 @@
+"""
+    Encoding and replay of the append-only journal which a FolderKeyStore may keep alongside its index snapshot.
+
+    Each line of the journal is a JSON record describing the end state of one write, so replaying a record which has
+    already been applied to the snapshot leaves the index unchanged. A line which cannot be decoded can only be the
+    result of a write interrupted part way through, and it marks the end of the usable journal.
+"""
+import json
+from typing import Iterable, Tuple
+
+from ..impl_helpers import KeyStoreIndex, sha1_digest
+from ..keys import KeyStoreOperation
+
+
+def encode_records(operations: Iterable[KeyStoreOperation]) -> str:
+    lines = []
+    for op in operations:
+        key_name = op.key_name if op.key_name else "default"
+        if op.kind == KeyStoreOperation.PUT:
+            record = {"op": op.kind, "secret": op.secret_name, "key": key_name, "sha": sha1_digest(op.value)}
+        elif op.kind == KeyStoreOperation.LINK:
+            record = {"op": KeyStoreOperation.PUT, "secret": op.secret_name, "key": key_name, "sha": op.sha}
+        elif op.kind == KeyStoreOperation.RM:
+            record = {"op": op.kind, "secret": op.secret_name, "key": key_name}
+        elif op.kind == KeyStoreOperation.SET_META:
+            record = {"op": op.kind, "secret": op.secret_name, "meta": op.meta_data}
+        else:
+            raise ValueError(f"Unknown key store operation '{op.kind}'")
+        lines.append(json.dumps(record) + "\n")
+    return "".join(lines)
+
+
+def replay(index: KeyStoreIndex, lines: Iterable[str]) -> Tuple[int, bool]:
+    """ Applies journal lines to the index in place. Returns the number of records applied and whether the journal
+    ended cleanly, which is False if the last record was torn by an interrupted write. """
+    count = 0
+    for line in lines:
+        try:
+            if not line.endswith("\n"):
+                raise ValueError("Incomplete record")
+            record = json.loads(line)
+        except ValueError:
+            return count, False
+
+        _apply_record(index, record)
+        count += 1
+
+    return count, True
+
+
+def _apply_record(index: KeyStoreIndex, record):
+    kind, secret_name = record["op"], record["secret"]
+    if kind == KeyStoreOperation.PUT:
+        index.set_key(secret_name, record["key"], record["sha"])
+    elif kind == KeyStoreOperation.RM:
+        try:
+            index.remove_key(secret_name, record["key"])
+        except KeyError:
+            pass
+    elif kind == KeyStoreOperation.SET_META:
+        if secret_name in index:
+            index.set_meta(secret_name, record["meta"])
+    else:
+        raise ValueError(f"Unknown journal record '{kind}'")
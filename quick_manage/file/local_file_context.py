@@ -11,13 +11,14 @@ from ..file import IFileProvider, FileSystem
 from ..hosts import Host, HostConfig
 from ..impl_helpers import to_yaml, from_yaml
 from ..context import IContext
-from ..keys import IKeyStore
+from ..keys import IKeyStore, KeyGetter, CachingKeyGetter
 
 
 class LocalFileContext(IContext):
     @dataclass
     class Config:
         path: str
+        key_cache_max_bytes: Optional[int] = None
 
     @dataclass
     class KeyStoresConfig:
@@ -29,6 +30,7 @@ class LocalFileContext(IContext):
         self._path_key_stores = os.path.join(self.config.path, "key-stores.yaml")
         self._hosts_folder = os.path.join(self.config.path, "hosts")
         self._key_stores: Optional[Dict[str, IKeyStore]] = None
+        self._key_getter: Optional[CachingKeyGetter] = None
         self._builders = builders
         self._files = file_system if file_system else FileSystem()
         self._host_configs: Optional[List[HostConfig]] = None
@@ -54,6 +56,12 @@ class LocalFileContext(IContext):
         self._key_stores = {c.name: self._builders.key_store.build(c) for c in stores_config.stores}
         return self._key_stores
 
+    @property
+    def key_getter(self) -> KeyGetter:
+        if self._key_getter is None:
+            self._key_getter = CachingKeyGetter(self.key_stores, self.config.key_cache_max_bytes)
+        return self._key_getter
+
     @property
     def host_names(self) -> List[str]:
         return [x.host for x in self._get_host_configs()]
@@ -61,7 +69,7 @@ class LocalFileContext(IContext):
     @property
     def hosts(self) -> Dict[str, Host]:
         if self._hosts is None:
-            self._hosts = {c.host: Host(c, self._builders.clients, self.key_stores) for c in self._get_host_configs()}
+            self._hosts = {c.host: Host(c, self._builders.clients, self.key_getter) for c in self._get_host_configs()}
         return self._hosts
 
     def _get_host_configs(self) -> List[HostConfig]:
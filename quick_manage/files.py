@@ -1,5 +1,8 @@
+import threading
 from abc import ABC
-from typing import Dict
+from typing import Dict, Optional
+
+from minio import Minio
 
 from quick_manage.s3 import S3Config
 
@@ -16,10 +19,20 @@ class S3FileAccess(FileAccess):
     def __init__(self, path: str, config: S3Config):
         self.config = config
         self.path = path
+        self._client: Optional[Minio] = None
+        self._client_lock = threading.Lock()
         super(S3FileAccess, self).__init__()
 
+    @property
+    def client(self) -> Minio:
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.config.make_client()
+        return self._client
+
     def get(self) -> bytes:
-        client = self.config.make_client()
+        client = self.client
         path_elements = ([self.config.prefix] if self.config.prefix else []) + [self.path]
         path = "/".join(x.strip("/") for x in path_elements)
 
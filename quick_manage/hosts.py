@@ -1,11 +1,13 @@
 from __future__ import annotations
 
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from dataclasses import dataclass, field
-from io import BytesIO
-from typing import Optional, List, Dict, Callable
+from typing import Optional, List, Dict, Callable, Tuple, Union
 
-from quick_manage._common import IBuilder, EntityConfig, HostClient, ClientAction
-from quick_manage.keys import IKeyStore, KeyGetter
+from quick_manage._common import IBuilder, EntityConfig, HostClient, ClientAction, FileUpload
+from quick_manage.keys import KeyGetter
 
 
 @dataclass
@@ -16,6 +18,22 @@ class DeployConfig:
     cert: Optional[str] = None
     chain: Optional[str] = None
     post: Optional[List[ClientAction]] = None
+    mode: Optional[Union[int, str]] = None
+    uid: Optional[int] = None
+    gid: Optional[int] = None
+
+    def file_mode(self) -> Optional[int]:
+        """ The mode for the deployed files, which is written in octal digits in the configuration, such as 640,
+        whether it was read as a number or as a string """
+        if self.mode is None:
+            return None
+        try:
+            mode = int(str(self.mode), 8)
+        except ValueError:
+            mode = -1
+        if not 0 <= mode <= 0o7777:
+            raise ValueError(f"The deployment mode '{self.mode}' is not a file mode in octal digits, such as 640")
+        return mode
 
 
 @dataclass
@@ -25,6 +43,17 @@ class HostCertConfig:
     deploy: DeployConfig
 
 
+@dataclass
+class CertDeployResult:
+    """ The outcome of deploying one certificate to one host """
+    host: str
+    cert: str
+    success: bool
+    changed: bool = False
+    error: Optional[str] = None
+    seconds: float = 0.0
+
+
 @dataclass
 class HostConfig:
     host: str
@@ -35,11 +64,11 @@ class HostConfig:
 
 
 class Host:
-    def __init__(self, config: HostConfig, client_builder: IBuilder, key_stores: Dict[str, IKeyStore]):
+    def __init__(self, config: HostConfig, client_builder: IBuilder, key_getter: KeyGetter):
         self.config = config
         self._certs = None
         self._client_builder = client_builder
-        self._key_getter = KeyGetter(key_stores)
+        self._key_getter = key_getter
 
     def get_client_by_type(self, type_name) -> Optional[HostClient]:
         for item in self.config.clients:
@@ -53,20 +82,57 @@ class Host:
                 return self._client_builder.build(item, key_getter=self._key_getter, nets=self.config.network)
         return None
 
-    def deploy_cert(self, config: HostCertConfig, message: Optional[Callable[[str], None]] = None):
+    def cert_paths(self, configs: List[HostCertConfig]) -> List[str]:
+        """ The paths of the keys holding the certificate parts which would be deployed to this host """
+        return [f"{c.secret}@{k}" for c in configs for k in _deploy_keys(c)]
+
+    def login_key_paths(self) -> List[str]:
+        """ The paths of the keys this host's clients log in with """
+        return [c.config["key"] for c in self.config.clients if c.config and c.config.get("key", None)]
+
+    def deploy_cert(self, config: HostCertConfig, message: Optional[Callable[[str], None]] = None,
+                    force: bool = False) -> bool:
+        """ Uploads the parts of a certificate and runs the post-deployment commands. Files which the host already has
+        with the same content are not uploaded again, and if none of them changed the post-deployment commands are
+        skipped. Setting force uploads every file and runs the commands regardless. Returns whether anything was
+        uploaded. """
         # Get the push client
         push_client = self.get_client_by_name(config.deploy.client)
         if push_client is None:
             raise KeyError(f"No client named {config.deploy.client} for certificate deployment")
 
-        for sub_key in ["fullchain", "private", "chain", "cert"]:
-            deploy_value = getattr(config.deploy, sub_key)
+        deploy_keys = _deploy_keys(config)
+        changed = dict(deploy_keys)
+        if not force:
+            wanted = self._key_getter.get_hashes([f"{config.secret}@{k}" for k in deploy_keys])
+            existing = push_client.file_hashes(list(deploy_keys.values()))
+            changed = {k: v for k, v in deploy_keys.items() if existing.get(v, None) != wanted[f"{config.secret}@{k}"]}
+
+        # A caching key getter fetches the parts which changed together, making a single request to each key store
+        # involved, and each part is then streamed from the key getter into the upload
+        self._key_getter.prefetch([f"{config.secret}@{k}" for k in changed])
+
+        mode = config.deploy.file_mode()
+        with ExitStack() as streams:
+            uploads = {}
+            for sub_key, deploy_value in deploy_keys.items():
+                if sub_key not in changed:
+                    if message:
+                        message(f"Unchanged {sub_key} at {deploy_value}")
+                    continue
 
-            if deploy_value:
                 if message:
                     message(f"Putting {sub_key} at {deploy_value}")
-                data = self._key_getter.get(f"{config.secret}@{sub_key}")
-                push_client.put_data(deploy_value, data)
+                stream = streams.enter_context(self._key_getter.open(f"{config.secret}@{sub_key}"))
+                uploads[deploy_value] = FileUpload(stream, mode, config.deploy.uid, config.deploy.gid)
+
+            if uploads:
+                push_client.put_many(uploads)
+
+        if not changed:
+            if message and config.deploy.post:
+                message("Nothing changed, skipping post-deployment commands")
+            return False
 
         if config.deploy.post:
             if message:
@@ -82,3 +148,52 @@ class Host:
                         message(f" * {command}")
 
                     post_client.action(command)
+
+        return True
+
+
+def _deploy_keys(config: HostCertConfig) -> Dict[str, str]:
+    return {k: getattr(config.deploy, k) for k in ["fullchain", "private", "chain", "cert"]
+            if getattr(config.deploy, k)}
+
+
+def deploy_certs(targets: List[Tuple[Host, List[HostCertConfig]]], key_getter: KeyGetter, workers: int = 8,
+                 message: Optional[Callable[[str, str], None]] = None, force: bool = False) -> List[CertDeployResult]:
+    """ Deploys certificates to many hosts with a pool of workers, where each worker deploys all the certificates for
+    one host in order, skipping files which are unchanged unless force is set. A failure is recorded in the results
+    and doesn't stop the deployment to other hosts, or of the host's other certificates. Messages are passed along
+    with the name of the host they concern.
+
+    The keys the hosts need are requested from the key getter before any deployment starts, so a caching key getter
+    fetches the values shared between hosts a single time. Unless force is set, only the hashes of the certificate
+    parts are fetched up front, since the parts themselves are only needed by the hosts where they changed. """
+    cert_paths = [p for host, configs in targets for p in host.cert_paths(configs)]
+    try:
+        key_getter.prefetch([p for host, _ in targets for p in host.login_key_paths()] + (cert_paths if force else []))
+        if not force:
+            key_getter.get_hashes(cert_paths)
+    except Exception:
+        # Any value which couldn't be fetched fails the deployments that need it, and is reported by them
+        pass
+
+    def _deploy(target: Tuple[Host, List[HostCertConfig]]) -> List[CertDeployResult]:
+        host, configs = target
+        results = []
+        for config in configs:
+            host_message = (lambda s: message(host.config.host, s)) if message else None
+            start = time.perf_counter()
+            try:
+                changed = host.deploy_cert(config, message=host_message, force=force)
+                result = CertDeployResult(host.config.host, config.name, True, changed=changed)
+            except Exception as e:
+                result = CertDeployResult(host.config.host, config.name, False, error=str(e))
+                if message:
+                    message(host.config.host, f"Error on cert {config.name}: {e}")
+            result.seconds = time.perf_counter() - start
+            results.append(result)
+        return results
+
+    if not targets:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets)))) as executor:
+        return [r for results in executor.map(_deploy, targets) for r in results]
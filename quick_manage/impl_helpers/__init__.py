@@ -3,5 +3,7 @@ This sub-package holds common entities which are used during the implementation
 helpful for those implementing plugins and add-ons.
 """
 
-from .serialization import to_yaml, from_yaml, to_yaml_string
-from .key_store_helpers import sha1_digest, KeyStoreIndex
+from .serialization import to_yaml, from_yaml, to_yaml_string, load_yaml
+from .key_store_helpers import sha1_digest, copy_hashed, KeyStoreIndex, IndexCache, apply_operations
+from .blob_cache import BlobCache
+from .index_codecs import IndexCodec, INDEX_FORMATS, get_codec, detect_format, decode_index
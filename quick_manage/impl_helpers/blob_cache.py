@@ -0,0 +1,183 @@
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Optional, BinaryIO, List, Tuple, Iterator
+
+from .key_store_helpers import copy_hashed
+
+
+class BlobCache:
+    """ A folder of content blobs named by their sha1 hash, used to keep local copies of the content held by remote
+    key stores. Since a blob's name is the hash of its content, a cached blob never goes stale and the same cache can
+    be shared by every store and every process. Blobs are checked against their hash when read and corrupt ones are
+    discarded.
+
+    The folder is only accessible to its owner. When the blobs grow past max_bytes, the least recently used are
+    removed until they fit again, where a blob's modification time is updated each time it is read. The total size is
+    kept as blobs are added and removed, after a single scan of the folder the first time it is needed, so the folder
+    is only walked again when the total goes past max_bytes. Blobs added by other processes are only counted then. """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._checked = False
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def cached_bytes(self) -> int:
+        """ The total size of the blobs in the cache """
+        with self._lock:
+            return self._total()
+
+    def get(self, sha: str) -> Optional[bytes]:
+        """ Returns the content of a blob, or None if it isn't in the cache """
+        try:
+            with open(self._blob_path(sha), "rb") as handle:
+                data = handle.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        if hashlib.sha1(data).hexdigest() != sha:
+            self._discard(sha)
+            self.misses += 1
+            return None
+
+        self._touch(sha)
+        self.hits += 1
+        return data
+
+    def open(self, sha: str) -> Optional[BinaryIO]:
+        """ Opens a blob for reading, or returns None if it isn't in the cache. The content is not checked against its
+        hash, since that would mean reading it twice. """
+        try:
+            handle = open(self._blob_path(sha), "rb")
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self._touch(sha)
+        self.hits += 1
+        return handle
+
+    def put(self, sha: str, data: bytes):
+        with self._incoming() as (handle, temp_path):
+            handle.write(data)
+        self._commit(sha, temp_path)
+
+    def put_stream(self, sha: str, stream: BinaryIO, length: Optional[int] = None):
+        """ Copies a stream into the cache, raising a ValueError and caching nothing if its content doesn't match the
+        hash it is stored under """
+        with self._incoming() as (handle, temp_path):
+            actual, _ = copy_hashed(stream, handle, length)
+        if actual != sha:
+            os.remove(temp_path)
+            raise ValueError(f"The content received for '{sha}' has the hash '{actual}'")
+        self._commit(sha, temp_path)
+
+    def evict(self):
+        """ Removes the least recently used blobs until the total size of the cache is within max_bytes """
+        with self._lock:
+            blobs = self._scan()
+            total = sum(size for _, size, _ in blobs)
+            for _, size, file_path in sorted(blobs):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._size = total
+
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        """ The modification time, size and path of every blob in the cache folder """
+        blobs = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.startswith("."):
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    info = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                blobs.append((info.st_mtime, info.st_size, file_path))
+        return blobs
+
+    def _total(self) -> int:
+        """ The running total size of the blobs, found with a scan of the folder the first time it is needed, which
+        must be called while holding the lock """
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._scan())
+        return self._size
+
+    @contextmanager
+    def _incoming(self) -> Iterator[Tuple[BinaryIO, str]]:
+        """ A temporary file to write a blob into, which is only readable by its owner and is removed if the write
+        fails """
+        descriptor, temp_path = tempfile.mkstemp(dir=self._prepare(), prefix=".incoming-")
+        try:
+            with os.fdopen(descriptor, "wb") as handle:
+                yield handle, temp_path
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _commit(self, sha: str, temp_path: str):
+        target = self._blob_path(sha)
+        folder = os.path.dirname(target)
+        if not os.path.exists(folder):
+            os.makedirs(folder, mode=0o700, exist_ok=True)
+
+        with self._lock:
+            total = self._total()
+            # A blob which is already cached is replaced, so its size is no longer part of the total
+            total -= _file_size(target)
+            os.replace(temp_path, target)
+            self._size = total + _file_size(target)
+            over = self._size > self.max_bytes
+
+        if over:
+            self.evict()
+
+    def _prepare(self) -> str:
+        """ Creates the cache folder if necessary and makes sure only its owner can read it """
+        if not self._checked:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            os.chmod(self.path, 0o700)
+            self._checked = True
+        return self.path
+
+    def _touch(self, sha: str):
+        try:
+            os.utime(self._blob_path(sha))
+        except FileNotFoundError:
+            pass
+
+    def _discard(self, sha: str):
+        with self._lock:
+            size = _file_size(self._blob_path(sha))
+            try:
+                os.remove(self._blob_path(sha))
+            except FileNotFoundError:
+                return
+            if self._size is not None:
+                self._size -= size
+
+    def _blob_path(self, sha: str) -> str:
+        return os.path.join(self.path, sha[:2], sha)
+
+
+def _file_size(path: str) -> int:
+    """ The size of a file, or zero if it doesn't exist """
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
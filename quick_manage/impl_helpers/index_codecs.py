@@ -0,0 +1,129 @@
+"""
+    Encodings for key store indexes. A format is named by a base codec, optionally followed by a compression, such as
+    "yaml", "json", "msgpack", "json+gzip" or "msgpack+zstd". YAML is the slowest but can be read and edited by hand,
+    while the others are meant for large stores. The msgpack codec and zstd compression need their optional packages
+    to be installed.
+
+    Every format can be recognized from the encoded bytes alone, so an index is always readable no matter which
+    format the store is configured to write.
+"""
+import gzip
+import json
+from io import StringIO
+from typing import Dict, Tuple, Callable
+
+from .serialization import to_yaml, load_yaml
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class IndexCodec:
+    def __init__(self, name: str, content_type: str, encode: Callable[[Dict], bytes], decode: Callable[[bytes], Dict]):
+        self.name = name
+        self.content_type = content_type
+        self._encode = encode
+        self._decode = decode
+
+    def encode(self, data: Dict) -> bytes:
+        return self._encode(data)
+
+    def decode(self, raw: bytes) -> Dict:
+        return self._decode(raw)
+
+
+def _encode_yaml(data: Dict) -> bytes:
+    target = StringIO()
+    to_yaml(data, target)
+    return target.getvalue().encode("utf-8")
+
+
+def _decode_yaml(raw: bytes) -> Dict:
+    return load_yaml(raw.decode("utf-8"))
+
+
+def _encode_json(data: Dict) -> bytes:
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def _decode_json(raw: bytes) -> Dict:
+    return json.loads(raw)
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise RuntimeError("The msgpack index format needs the msgpack package, install it with "
+                           "'pip install quick-manage[msgpack]'")
+    return msgpack
+
+
+def _encode_msgpack(data: Dict) -> bytes:
+    return _msgpack().packb(data, use_bin_type=True)
+
+
+def _decode_msgpack(raw: bytes) -> Dict:
+    return _msgpack().unpackb(raw, raw=False)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("The zstd index compression needs the zstandard package, install it with "
+                           "'pip install quick-manage[zstd]'")
+    return zstandard
+
+
+_BASE_CODECS = {
+    "yaml": ("application/yaml", _encode_yaml, _decode_yaml),
+    "json": ("application/json", _encode_json, _decode_json),
+    "msgpack": ("application/msgpack", _encode_msgpack, _decode_msgpack),
+}
+
+_COMPRESSIONS = {
+    "gzip": (lambda raw: gzip.compress(raw, compresslevel=6, mtime=0), gzip.decompress),
+    "zstd": (lambda raw: _zstandard().ZstdCompressor().compress(raw),
+             lambda raw: _zstandard().ZstdDecompressor().decompress(raw)),
+}
+
+INDEX_FORMATS = list(_BASE_CODECS.keys()) + [f"{b}+{c}" for b in ["json", "msgpack"] for c in _COMPRESSIONS]
+
+
+def get_codec(name: str) -> IndexCodec:
+    """ Returns the codec for an index format, raising a ValueError if the format is not known """
+    base, _, compression = name.partition("+")
+    if base not in _BASE_CODECS or (compression and compression not in _COMPRESSIONS):
+        raise ValueError(f"Unknown index format '{name}', the known formats are {', '.join(INDEX_FORMATS)}")
+
+    content_type, encode, decode = _BASE_CODECS[base]
+    if not compression:
+        return IndexCodec(name, content_type, encode, decode)
+
+    compress, decompress = _COMPRESSIONS[compression]
+    return IndexCodec(name, content_type, lambda data: compress(encode(data)), lambda raw: decode(decompress(raw)))
+
+
+def detect_format(raw: bytes) -> str:
+    """ Recognizes the format of an encoded index from its first bytes """
+    if raw.startswith(_GZIP_MAGIC):
+        return f"{detect_format(gzip.decompress(raw))}+gzip"
+    if raw.startswith(_ZSTD_MAGIC):
+        return f"{detect_format(_zstandard().ZstdDecompressor().decompress(raw))}+zstd"
+
+    first = raw.lstrip()[:1]
+    if first == b"{":
+        return "json"
+    if first and (0x80 <= first[0] <= 0x8f or first[0] in (0xde, 0xdf)):
+        # A msgpack map, which can't be the start of UTF-8 text
+        return "msgpack"
+    return "yaml"
+
+
+def decode_index(raw: bytes) -> Tuple[Dict, str]:
+    """ Decodes an index in any known format, returning its contents and the name of the format it was in """
+    if not raw.strip():
+        return {}, "yaml"
+    name = detect_format(raw)
+    return get_codec(name).decode(raw) or {}, name
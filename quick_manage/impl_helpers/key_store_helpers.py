@@ -1,30 +1,368 @@
-from typing import Dict, Optional, List
-from dataclasses import dataclass, field
+import copy
+import hashlib
+import json
+import sys
+from bisect import bisect_left, insort
+from typing import Dict, Optional, List, Iterable, Iterator, Hashable, Tuple, Set, BinaryIO
 
-from ..keys import Secret, IKeyStore
+from dacite import from_dict
+
+from ..keys import Secret, IKeyStore, KeyStoreOperation
+
+
+_DIGEST_SIZE = 20
+
+
+def _copy_meta(meta_data: Dict) -> Dict:
+    """ A copy of metadata shared between secrets which can be changed without affecting the others. A deep copy is
+    only made when there are nested values, since most metadata holds plain values only. """
+    if all(isinstance(v, (str, int, float, bool, type(None))) for v in meta_data.values()):
+        return dict(meta_data)
+    return copy.deepcopy(meta_data)
+
+
+class _Entry:
+    """ The compact form of a secret held by a KeyStoreIndex. The key names are a tuple which is shared by every
+    secret with the same keys, and the sha1 hashes of the keys are held as their 20 byte digests, one after another
+    in a single bytes object in the same order as the names. """
+    __slots__ = ("name", "meta_data", "key_names", "digests")
+
+    def __init__(self, name: str, meta_data: Optional[Dict] = None, key_names: Tuple[str, ...] = (),
+                 digests: bytes = b""):
+        self.name = name
+        self.meta_data = meta_data
+        self.key_names = key_names
+        self.digests = digests
+
+    def items(self) -> Iterator[Tuple[str, bytes]]:
+        for i, name in enumerate(self.key_names):
+            yield name, self.digests[i * _DIGEST_SIZE:(i + 1) * _DIGEST_SIZE]
+
+    def find(self, key_name: str) -> Optional[bytes]:
+        try:
+            i = self.key_names.index(key_name)
+        except ValueError:
+            return None
+        return self.digests[i * _DIGEST_SIZE:(i + 1) * _DIGEST_SIZE]
+
+    def to_secret(self) -> Secret:
+        keys = {name: digest.hex() for name, digest in self.items()} if self.key_names else None
+        meta_data = _copy_meta(self.meta_data) if self.meta_data is not None else None
+        return Secret.trusted(self.name, meta_data, keys)
 
 
-@dataclass
 class KeyStoreIndex:
-    secrets: List[Secret] = field(default_factory=list)
+    """ The index of all secrets held in a key store. Secrets are held in a map by name for constant time lookups,
+    alongside a sorted array of names which allows prefix queries to be answered with a binary search.
+
+    Secrets are stored in a compact form and handed to callers as new Secret objects, so changes to those objects do
+    not affect the index and must be made through set_key, remove_key, set_meta and remove_secret instead. Secrets
+    with equal metadata share a single copy of it, which is why callers get their own copy.
+
+    The index also counts how many keys refer to each content hash. The counts are only built the first time they are
+    needed, since an index which is only read never uses them, and are then kept up to date by those methods. """
+
+    def __init__(self, secrets: Optional[Iterable[Secret]] = None):
+        self._entries: Dict[str, _Entry] = {}
+        self._refs: Optional[Dict[bytes, int]] = None
+        self._shared_names: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+        self._shared_meta: Dict[Hashable, Dict] = {}
+        for secret in (secrets or []):
+            self._add_entry(secret.name, secret.meta_data, secret.get_keys())
+        self._names: List[str] = sorted(self._entries.keys())
+
+    def _add_entry(self, name: str, meta_data: Optional[Dict], keys: Dict[str, Optional[str]]):
+        if name in self._entries:
+            raise KeyError(f"The key store index has more than one secret named '{name}'")
+        keys = {k: v for k, v in keys.items() if v}
+        entry = _Entry(name, self._share_meta(meta_data), self._share_names(tuple(keys.keys())),
+                       bytes.fromhex("".join(keys.values())))
+        self._entries[name] = entry
+
+    def _share_names(self, key_names: Tuple[str, ...]) -> Tuple[str, ...]:
+        """ Returns the one copy of a tuple of key names used by every secret which has those keys """
+        shared = self._shared_names.get(key_names, None)
+        if shared is None:
+            shared = self._shared_names[key_names] = tuple(sys.intern(k) for k in key_names)
+        return shared
+
+    def _share_meta(self, meta_data: Optional[Dict]) -> Optional[Dict]:
+        """ Returns the one copy of the metadata used by every secret which has metadata equal to it """
+        if not meta_data:
+            return meta_data
+        try:
+            # The type of each value is part of the key, since 1, 1.0 and True are equal and hash alike
+            key = tuple(sorted((k, type(v), v) for k, v in meta_data.items()))
+            hash(key)
+        except TypeError:
+            # Nested values can't be hashed, so they are compared through their text instead
+            key = json.dumps(meta_data, sort_keys=True)
+
+        if key not in self._shared_meta:
+            # The shared copy is a deep copy, so later changes to the caller's dictionary can't reach it
+            self._shared_meta[key] = copy.deepcopy(meta_data)
+        return self._shared_meta[key]
+
+    @property
+    def secrets(self) -> List[Secret]:
+        return [x.to_secret() for x in self._entries.values()]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, secret_name: str) -> bool:
+        return secret_name in self._entries
 
     def find_secret(self, secret_name: str) -> Optional[Secret]:
-        matches = [x for x in self.secrets if x.name == secret_name]
-        return matches[0] if matches else None
+        entry = self._entries.get(secret_name, None)
+        return entry.to_secret() if entry else None
 
     def create_secret(self, secret_name: str) -> Secret:
-        if any(x for x in self.secrets if x.name == secret_name):
+        if secret_name in self._entries:
             raise KeyError(f"The key store already has a secret named '{secret_name}'")
 
         secret = Secret(secret_name)
-        self.secrets.append(secret)
+        self._entries[secret_name] = _Entry(secret_name)
+        insort(self._names, secret_name)
         return secret
 
-    def find_or_create(self, secret_name: str) -> Secret:
-        found = self.find_secret(secret_name)
-        return found if found else self.create_secret(secret_name)
+    def find_key(self, secret_name: str, key_name: Optional[str]) -> str:
+        """ Returns the content hash of a key in a secret, raising a KeyError if either does not exist """
+        entry = self._entries.get(secret_name, None)
+        if not entry:
+            raise KeyError(f"No secret named '{secret_name}' was found")
+
+        if not key_name:
+            key_name = "default"
+        digest = entry.find(key_name)
+        if digest is None:
+            raise KeyError(f"No key named '{key_name}' found in secret '{secret_name}'")
+
+        return digest.hex()
+
+    def remove_secret(self, secret_name: str) -> Secret:
+        entry = self._entries.pop(secret_name, None)
+        if entry is None:
+            raise KeyError(f"No secret named '{secret_name}' was found")
+
+        del self._names[bisect_left(self._names, secret_name)]
+        for _, digest in entry.items():
+            self._release_ref(digest)
+        return entry.to_secret()
+
+    def set_key(self, secret_name: str, key_name: Optional[str], sha: str) -> Optional[str]:
+        """ Points a key at a content hash, creating the secret if necessary. Returns the hash the key previously
+        referred to, if any. """
+        if secret_name not in self._entries:
+            self.create_secret(secret_name)
+        if not key_name:
+            key_name = "default"
+        if not Secret.key_is_valid(key_name):
+            raise ValueError(f"The key name '{key_name}' is not valid")
+
+        entry = self._entries[secret_name]
+        digest = bytes.fromhex(sha)
+        previous = entry.find(key_name)
+        if previous is None:
+            entry.key_names = self._share_names(entry.key_names + (key_name,))
+            entry.digests += digest
+        else:
+            i = entry.key_names.index(key_name) * _DIGEST_SIZE
+            entry.digests = entry.digests[:i] + digest + entry.digests[i + _DIGEST_SIZE:]
+
+        self._add_ref(digest)
+        if previous is not None:
+            self._release_ref(previous)
+        return previous.hex() if previous is not None else None
+
+    def remove_key(self, secret_name: str, key_name: Optional[str]) -> str:
+        """ Removes a key from a secret, removing the whole secret if it was the last key. Returns the content hash
+        the key referred to. """
+        sha = self.find_key(secret_name, key_name)
+        key_name = key_name if key_name else "default"
+        entry = self._entries[secret_name]
+        if len(entry.key_names) == 1:
+            # This is the only key left, we can delete the whole secret
+            self.remove_secret(secret_name)
+        else:
+            kept = [(k, d) for k, d in entry.items() if k != key_name]
+            entry.key_names = self._share_names(tuple(k for k, _ in kept))
+            entry.digests = b"".join(d for _, d in kept)
+            self._release_ref(bytes.fromhex(sha))
+        return sha
+
+    def set_meta(self, secret_name: str, meta_data: Optional[Dict]):
+        entry = self._entries.get(secret_name, None)
+        if not entry:
+            raise KeyError(f"No secret named '{secret_name}' was found")
+        entry.meta_data = self._share_meta(meta_data)
+
+    def content_hashes(self) -> List[str]:
+        """ All content hashes referred to by at least one key in the index """
+        return [x.hex() for x in self._counts().keys()]
+
+    def ref_count(self, sha: str) -> int:
+        """ The number of keys in the index which refer to a content hash """
+        return self._counts().get(bytes.fromhex(sha), 0)
+
+    def _counts(self) -> Dict[bytes, int]:
+        if self._refs is None:
+            self._refs = {}
+            for entry in self._entries.values():
+                for _, digest in entry.items():
+                    self._refs[digest] = self._refs.get(digest, 0) + 1
+        return self._refs
+
+    def _add_ref(self, digest: bytes):
+        if self._refs is not None:
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+
+    def _release_ref(self, digest: bytes):
+        if self._refs is None:
+            return
+        count = self._refs.get(digest, 0) - 1
+        if count > 0:
+            self._refs[digest] = count
+        else:
+            self._refs.pop(digest, None)
+
+    def names_with_prefix(self, prefix: Optional[str] = None) -> Iterator[str]:
+        """ Iterates the names of all secrets which start with the prefix, in sorted order. The names are read from the
+        index as they are yielded rather than copied first, so the index shouldn't be changed during the iteration. """
+        names = self._names
+        i = bisect_left(names, prefix) if prefix else 0
+        while i < len(names):
+            name = names[i]
+            if prefix and not name.startswith(prefix):
+                break
+            yield name
+            i += 1
+
+    def with_prefix(self, prefix: Optional[str] = None) -> Iterator[Secret]:
+        """ Iterates all secrets whose names start with the prefix, in sorted order by name """
+        for name in self.names_with_prefix(prefix):
+            yield self._entries[name].to_secret()
+
+    def to_dict(self) -> Dict:
+        secrets = []
+        for entry in self._entries.values():
+            item = {"name": entry.name}
+            if entry.meta_data is not None:
+                # The metadata may be shared with other secrets, so callers get their own copy
+                item["meta_data"] = _copy_meta(entry.meta_data)
+            if entry.key_names:
+                item["keys"] = {k: d.hex() for k, d in entry.items()}
+            secrets.append(item)
+        return {"secrets": secrets}
+
+    @staticmethod
+    def from_dict(data: Optional[Dict], trusted: bool = True) -> "KeyStoreIndex":
+        """ Builds an index from its serialized form. Names in an index written by a key store have already been
+        validated, so they are only checked again if the data is not trusted. """
+        items = (data or {}).get("secrets", None) or []
+        if not trusted:
+            return KeyStoreIndex(from_dict(Secret, x) for x in items)
+
+        index = KeyStoreIndex()
+        for item in items:
+            index._add_entry(item["name"], item.get("meta_data", None), item.get("keys", None) or {})
+        index._names = sorted(index._entries.keys())
+        return index
+
+
+class IndexCache:
+    """ Holds the most recently parsed KeyStoreIndex along with a signature of the source it was parsed from. The
+    cached index is only handed back while the caller presents the same signature, so a change made by another
+    process invalidates it. """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._signature: Optional[Hashable] = None
+        self._index: Optional[KeyStoreIndex] = None
+
+    @property
+    def signature(self) -> Optional[Hashable]:
+        """ The signature of the currently cached index, or None if nothing is cached """
+        return self._signature if self._index is not None else None
+
+    def get(self, signature: Optional[Hashable]) -> Optional[KeyStoreIndex]:
+        if signature is not None and self._index is not None and signature == self._signature:
+            self.hits += 1
+            return self._index
+
+        self.misses += 1
+        return None
+
+    def put(self, signature: Optional[Hashable], index: KeyStoreIndex):
+        if signature is None:
+            self.clear()
+            return
+        self._signature = signature
+        self._index = index
+
+    def clear(self):
+        self._signature = None
+        self._index = None
+
+
+def apply_operations(index: KeyStoreIndex,
+                     operations: Iterable[KeyStoreOperation]) -> Tuple[Dict[str, str], Set[str]]:
+    """ Applies a list of key store writes to an index in place, raising a KeyError if any of them refer to a secret
+    or key which doesn't exist. Returns the values which must be written, keyed by their content hash, and the set of
+    content hashes which are no longer referenced by anything in the index and may be deleted. """
+    writes: Dict[str, str] = {}
+    released: Set[str] = set()
+
+    for op in operations:
+        key_name = op.key_name if op.key_name else "default"
+
+        if op.kind == KeyStoreOperation.PUT:
+            sha = sha1_digest(op.value)
+            previous = index.set_key(op.secret_name, key_name, sha)
+            if previous is not None and previous != sha:
+                released.add(previous)
+            writes[sha] = op.value
+
+        elif op.kind == KeyStoreOperation.LINK:
+            previous = index.set_key(op.secret_name, key_name, op.sha)
+            if previous is not None and previous != op.sha:
+                released.add(previous)
+
+        elif op.kind == KeyStoreOperation.RM:
+            released.add(index.remove_key(op.secret_name, key_name))
+
+        elif op.kind == KeyStoreOperation.SET_META:
+            index.set_meta(op.secret_name, op.meta_data)
+
+        else:
+            raise ValueError(f"Unknown key store operation '{op.kind}'")
+
+    # If no other secret/key uses a released hash, its content may be deleted
+    released = {h for h in released if index.ref_count(h) == 0}
+    return {k: v for k, v in writes.items() if k not in released}, released
 
 
 def sha1_digest(text: str) -> str:
-    import hashlib
     return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def copy_hashed(source: BinaryIO, sink: BinaryIO, length: Optional[int] = None,
+                chunk_size: int = 65536) -> Tuple[str, int]:
+    """ Copies a stream in chunks while computing the sha1 hash of its content, so that the hash of a large value is
+    known once it has been written without ever holding the whole value in memory. If a length is given exactly that
+    many bytes are copied, and a ValueError is raised if the source ends early. Returns the hex digest and the number
+    of bytes copied. """
+    sha = hashlib.sha1()
+    copied = 0
+    while length is None or copied < length:
+        chunk = source.read(chunk_size if length is None else min(chunk_size, length - copied))
+        if not chunk:
+            break
+        sha.update(chunk)
+        sink.write(chunk)
+        copied += len(chunk)
+
+    if length is not None and copied != length:
+        raise ValueError(f"Expected {length} bytes but the stream ended after {copied}")
+    return sha.hexdigest(), copied
@@ -15,11 +15,12 @@ def as_dict_strip(obj) -> Dict:
 
 
 def to_yaml(obj, target: Union[TextIO, StringIO, str]):
+    data = obj if isinstance(obj, dict) else as_dict_strip(obj)
     if isinstance(target, str):
         with open(target, "w") as handle:
-            yaml.dump(as_dict_strip(obj), handle)
+            yaml.dump(data, handle)
     else:
-        yaml.dump(as_dict_strip(obj), target)
+        yaml.dump(data, target)
 
 
 def to_yaml_string(obj) -> str:
@@ -29,5 +30,9 @@ def to_yaml_string(obj) -> str:
     return target.read()
 
 
+def load_yaml(target: Union[TextIO, StringIO, str]) -> Dict:
+    return yaml.load(target, Loader=yaml.Loader)
+
+
 def from_yaml(data_cls, target: Union[TextIO, StringIO, str]):
-    return from_dict(data_cls, yaml.load(target, Loader=yaml.Loader))
+    return from_dict(data_cls, load_yaml(target))
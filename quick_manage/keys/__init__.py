@@ -1,2 +1,5 @@
-from ._common import (IKeyStore, Secret, SecretPath, SecretType, IKeyCreateCommand, python_variable_name, KeyGetter)
+from ._common import (IKeyStore, Secret, SecretPath, SecretType, IKeyCreateCommand, python_variable_name, KeyGetter,
+                      KeyStoreBatch, KeyStoreOperation)
+from ._caching import CachingKeyGetter
+from ._transfer import TransferStats, SyncResult, transfer_blobs, copy_secrets, sync_stores
 from ._letsencrypt import LetsEncryptCertificate
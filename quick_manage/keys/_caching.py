@@ -0,0 +1,138 @@
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple, BinaryIO
+
+from ._common import IKeyStore, KeyGetter, SecretPath
+
+
+class CachingKeyGetter(KeyGetter):
+    """ A key getter which remembers the values it retrieves, so that a value used many times in one run, such as a
+    private key shared by many hosts, is only fetched from its key store once. Cached values are never checked against
+    the store again, so the getter should only live as long as a single run.
+
+    When max_bytes is set, the least recently used values are dropped to keep the cached values within it, and values
+    larger than it are never cached. The getter can be shared between threads. """
+
+    def __init__(self, stores: Dict[str, IKeyStore], max_bytes: Optional[int] = None):
+        super().__init__(stores)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values: Dict[Tuple, bytes] = OrderedDict()
+        self._hashes: Dict[Tuple, str] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cached_bytes(self) -> int:
+        return self._size
+
+    def get(self, key_path: str) -> str:
+        path = SecretPath.from_text(key_path)
+        cached = self._lookup(path)
+        if cached is not None:
+            return cached.decode("utf-8")
+
+        value = super().get(key_path)
+        self._remember(path, value.encode("utf-8"))
+        return value
+
+    def open(self, key_path: str) -> BinaryIO:
+        path = SecretPath.from_text(key_path)
+        cached = self._lookup(path)
+        if cached is None:
+            with super().open(key_path) as stream:
+                cached = stream.read()
+            self._remember(path, cached)
+        return BytesIO(cached)
+
+    def get_many(self, key_paths: List[str]) -> Dict[str, str]:
+        results = {}
+        missing = []
+        for key_path in key_paths:
+            cached = self._lookup(SecretPath.from_text(key_path))
+            if cached is None:
+                missing.append(key_path)
+            else:
+                results[key_path] = cached.decode("utf-8")
+
+        if missing:
+            results.update(self._fetch(missing))
+        return results
+
+    def get_hashes(self, key_paths: List[str]) -> Dict[str, str]:
+        """ Returns the content hashes of values, remembering them separately from the values, since they are small
+        and don't count towards max_bytes """
+        with self._lock:
+            results = {p: self._hashes[_cache_key(SecretPath.from_text(p))] for p in key_paths
+                       if _cache_key(SecretPath.from_text(p)) in self._hashes}
+
+        missing = [p for p in key_paths if p not in results]
+        if missing:
+            fetched = super().get_hashes(missing)
+            with self._lock:
+                self._hashes.update((_cache_key(SecretPath.from_text(p)), sha) for p, sha in fetched.items())
+            results.update(fetched)
+        return results
+
+    def prefetch(self, key_paths: List[str]):
+        """ Retrieves the values which aren't cached yet, making a single request to each key store involved. Values
+        fetched this way don't count as misses, and later reads of them count as hits. Binary values can't be fetched
+        together as text, so if there are any each missing value is read as bytes on its own instead. """
+        with self._lock:
+            missing = [p for p in key_paths if _cache_key(SecretPath.from_text(p)) not in self._values]
+        if not missing:
+            return
+
+        try:
+            self._fetch(missing)
+        except UnicodeDecodeError:
+            for key_path in dict.fromkeys(missing):
+                with super().open(key_path) as stream:
+                    self._remember(SecretPath.from_text(key_path), stream.read())
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._hashes.clear()
+            self._size = 0
+
+    def _fetch(self, key_paths: List[str]) -> Dict[str, str]:
+        fetched = super().get_many(list(dict.fromkeys(key_paths)))
+        for key_path, value in fetched.items():
+            self._remember(SecretPath.from_text(key_path), value.encode("utf-8"))
+        return fetched
+
+    def _lookup(self, path: SecretPath) -> Optional[bytes]:
+        key = _cache_key(path)
+        with self._lock:
+            value = self._values.get(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._values.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _remember(self, path: SecretPath, value: bytes):
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            return
+
+        key = _cache_key(path)
+        with self._lock:
+            previous = self._values.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._values[key] = value
+            self._size += len(value)
+
+            while self.max_bytes is not None and self._size > self.max_bytes:
+                _, dropped = self._values.popitem(last=False)
+                self._size -= len(dropped)
+                self.evictions += 1
+
+
+def _cache_key(path: SecretPath) -> Tuple:
+    return path.store, path.secret, path.key
@@ -1,7 +1,8 @@
 from __future__ import annotations
 from abc import ABC
 from dataclasses import dataclass, field
-from typing import Dict, Type, List, Optional
+from io import BytesIO
+from typing import Dict, Type, List, Optional, Tuple, Callable, BinaryIO, Set, Iterable, Iterator
 
 import click
 from dacite import from_dict
@@ -63,6 +64,16 @@ class Secret:
                         f"The key name '{k}' is not valid. Alphanumeric, period, underscore, and dashes are allowed, "
                         f"with the first and last characters alphanumeric only.")
 
+    @classmethod
+    def trusted(cls, name: str, meta_data: Optional[Dict] = None,
+                keys: Optional[Dict[str, Optional[str]]] = None) -> Secret:
+        """ Creates a secret without validating its name and keys, for data which was validated before it was stored """
+        secret = cls.__new__(cls)
+        secret.name = name
+        secret.meta_data = meta_data
+        secret.keys = keys
+        return secret
+
     def get_keys(self) -> Dict[str, Optional[str]]:
         return self.keys if self.keys else {}
 
@@ -117,12 +128,130 @@ class KeyGetter:
             raise KeyError(f"No key store named '{path.store}' in this context")
         return key_store.get_value(path.secret, path.key)
 
+    def open(self, key_path: str) -> BinaryIO:
+        """ Opens a value for reading as a binary stream, which should be closed when it is no longer needed """
+        path = SecretPath.from_text(key_path)
+        key_store = self._stores.get(path.store, None)
+        if key_store is None:
+            raise KeyError(f"No key store named '{path.store}' in this context")
+        return key_store.open_value(path.secret, path.key)
+
+    def get_hashes(self, key_paths: List[str]) -> Dict[str, str]:
+        """ Returns the sha1 hashes of the contents of several values, which are read from the key stores' metadata
+        without retrieving the values themselves """
+        results = {}
+        secrets: Dict[Tuple[str, str], Secret] = {}
+        for key_path in key_paths:
+            path = SecretPath.from_text(key_path)
+            key_store = self._stores.get(path.store, None)
+            if key_store is None:
+                raise KeyError(f"No key store named '{path.store}' in this context")
+            if (path.store, path.secret) not in secrets:
+                secrets[(path.store, path.secret)] = key_store.get_meta(path.secret)
+
+            key_name = path.key if path.key else "default"
+            sha = secrets[(path.store, path.secret)].get_keys().get(key_name, None)
+            if sha is None:
+                raise KeyError(f"No key named '{key_name}' found in secret '{path.secret}'")
+            results[key_path] = sha
+        return results
+
+    def prefetch(self, key_paths: List[str]):
+        """ Prepares values which are about to be used, which getters that don't cache values have no need to do """
+        pass
+
+    def get_many(self, key_paths: List[str]) -> Dict[str, str]:
+        """ Retrieves several values at once, making a single request to each key store involved """
+        by_store: Dict[str, List[SecretPath]] = {}
+        for key_path in key_paths:
+            path = SecretPath.from_text(key_path)
+            by_store.setdefault(path.store, []).append(path)
+
+        results = {}
+        for store_name, paths in by_store.items():
+            key_store = self._stores.get(store_name, None)
+            if key_store is None:
+                raise KeyError(f"No key store named '{store_name}' in this context")
+            values = key_store.get_values([(p.secret, p.key) for p in paths])
+            results.update((p.original, v) for p, v in zip(paths, values))
+        return results
+
+
+@dataclass
+class KeyStoreOperation:
+    """ A single write against a key store, used to apply several writes together through IKeyStore.apply. A link
+    points a key at content which the store already holds, identified by its sha1 hash. """
+    PUT = "put"
+    RM = "rm"
+    SET_META = "set_meta"
+    LINK = "link"
+
+    kind: str
+    secret_name: str
+    key_name: Optional[str] = None
+    value: Optional[str] = None
+    meta_data: Optional[Dict] = None
+    sha: Optional[str] = None
+
+
+class KeyStoreBatch:
+    """ Collects writes against a key store and applies them together when the context exits without an exception.
+    Stores which support it write all the values first and then update their index a single time.
+
+    with key_store.batch() as batch:
+        batch.put("secret", "key", value)
+        batch.set_meta("secret", {"type": "example"})
+    """
+
+    def __init__(self, store: IKeyStore):
+        self._store = store
+        self.operations: List[KeyStoreOperation] = []
+
+    def put(self, secret_name: str, key_name: Optional[str], value: str):
+        self.operations.append(KeyStoreOperation(KeyStoreOperation.PUT, secret_name, key_name, value=value))
+
+    def rm(self, secret_name: str, key_name: Optional[str]):
+        self.operations.append(KeyStoreOperation(KeyStoreOperation.RM, secret_name, key_name))
+
+    def set_meta(self, secret_name: str, value: Dict):
+        self.operations.append(KeyStoreOperation(KeyStoreOperation.SET_META, secret_name, meta_data=value))
+
+    def link(self, secret_name: str, key_name: Optional[str], sha: str):
+        self.operations.append(KeyStoreOperation(KeyStoreOperation.LINK, secret_name, key_name, sha=sha))
+
+    def commit(self):
+        operations, self.operations = self.operations, []
+        if operations:
+            self._store.apply(operations)
+
+    def __enter__(self) -> KeyStoreBatch:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+
 
 class IKeyStore(ABC):
     @property
     def type_name(self) -> str:
         raise NotImplementedError()
 
+    def batch(self) -> KeyStoreBatch:
+        return KeyStoreBatch(self)
+
+    def apply(self, operations: List[KeyStoreOperation]):
+        """ Applies a list of writes in order. Stores should override this to write their index once per call. """
+        for op in operations:
+            if op.kind == KeyStoreOperation.PUT:
+                self.put_value(op.secret_name, op.key_name, op.value)
+            elif op.kind == KeyStoreOperation.RM:
+                self.rm(op.secret_name, op.key_name)
+            elif op.kind == KeyStoreOperation.SET_META:
+                self.set_meta(op.secret_name, op.meta_data)
+            else:
+                raise ValueError(f"Unknown key store operation '{op.kind}'")
+
     def put_value(self, secret_name: str, key_name: Optional[str], value: str):
         raise NotImplementedError()
 
@@ -132,6 +261,44 @@ class IKeyStore(ABC):
     def get_value(self, secret_name: str, key_name: Optional[str]) -> str:
         raise NotImplementedError()
 
+    def open_value(self, secret_name: str, key_name: Optional[str]) -> BinaryIO:
+        """ Opens the raw bytes of a value as a stream, which works for binary content that get_value can't decode.
+        Stores should override this to stream from their storage rather than holding the value in memory. """
+        return BytesIO(self.get_value(secret_name, key_name).encode("utf-8"))
+
+    def put_stream(self, secret_name: str, key_name: Optional[str], stream: BinaryIO, length: Optional[int] = None):
+        """ Stores the bytes read from a stream as a value. If a length is given exactly that many bytes are read,
+        otherwise the stream is read to its end. Stores should override this to hash and store the content as it is
+        read. """
+        data = stream.read(length) if length is not None else stream.read()
+        if length is not None and len(data) != length:
+            raise ValueError(f"Expected {length} bytes but the stream ended after {len(data)}")
+        self.put_value(secret_name, key_name, data.decode("utf-8"))
+
+    def has_blobs(self, hashes: Iterable[str]) -> Set[str]:
+        """ Returns which of the content hashes the store already holds content for, whether or not any key refers to
+        it. Stores which can't tell return an empty set, so that the content is always sent to them. """
+        return set()
+
+    def open_blob(self, sha: str) -> BinaryIO:
+        """ Opens the content stored under a sha1 hash as a binary stream """
+        raise NotImplementedError()
+
+    def put_blob(self, sha: str, stream: BinaryIO, length: Optional[int] = None) -> int:
+        """ Stores content under its sha1 hash without pointing any key at it, so that a later link operation can.
+        Raises a ValueError if the content doesn't match the hash. Returns the number of bytes stored. """
+        raise NotImplementedError()
+
+    def copy_blob_from(self, source: IKeyStore, sha: str) -> bool:
+        """ Copies content from another store without passing it through this process, if the two stores allow it.
+        Returns False if they don't, in which case the content has to be read and put instead. """
+        return False
+
+    def get_values(self, requests: List[Tuple[str, Optional[str]]]) -> List[str]:
+        """ Retrieves the values for a list of (secret name, key name) pairs, in the same order. Stores should
+        override this to read their index once and fetch the values together. """
+        return [self.get_value(secret_name, key_name) for secret_name, key_name in requests]
+
     def get_meta(self, secret_name: str) -> Secret:
         raise NotImplementedError()
 
@@ -141,9 +308,23 @@ class IKeyStore(ABC):
     def all(self) -> Dict[str, Secret]:
         raise NotImplementedError()
 
+    def iter_secrets(self, prefix: Optional[str] = None, type: Optional[str] = None) -> Iterator[Secret]:
+        """ Iterates the secrets whose names start with the prefix and, if a type is given, whose metadata has that
+        type, in sorted order by name. Stores should override this to answer the prefix from their index without
+        loading every secret. """
+        for name, secret in sorted(self.all().items()):
+            if (not prefix or name.startswith(prefix)) and (not type or secret.get_type_name() == type):
+                yield secret
+
     def has_secret(self, secret_name: str) -> bool:
         return secret_name in self.all()
 
+    def migrate(self, message: Optional[Callable[[str], None]] = None):
+        """ Moves any stored data which is not in the layout the store is configured for into that layout. The
+        migration may be interrupted and run again, and the store remains readable while it is in progress. Stores
+        which only have one layout do nothing. """
+        pass
+
 
 class IKeyCreateCommand(ABC):
     @property
@@ -0,0 +1,180 @@
+"""
+    Copying of content between key stores. Content is identified by its sha1 hash in every store, so only the blobs
+    which the destination doesn't already hold have to be moved, after which the destination's keys are pointed at
+    them with link operations in a single batch.
+
+    Stores which only implement the value methods of IKeyStore have no blobs to transfer, so with those the values are
+    copied key by key instead.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Iterable, Optional, Callable, List, Tuple
+
+from ._common import IKeyStore, Secret, KeyStoreBatch
+
+
+@dataclass
+class TransferStats:
+    """ Counts of the content moved between two stores. Blobs copied by the server don't pass through this process,
+    so they are not included in the bytes sent. """
+    sent: int = 0
+    bytes_sent: int = 0
+    server_copies: int = 0
+    skipped: int = 0
+
+
+def transfer_blobs(source: IKeyStore, destination: IKeyStore, hashes: Iterable[str], workers: int = 8,
+                   message: Optional[Callable[[str], None]] = None) -> TransferStats:
+    """ Makes sure the destination holds the content for every hash, copying whatever it is missing from the source
+    with a pool of workers. A transfer which is interrupted can be run again and will skip the content which already
+    arrived. """
+    unique = list(dict.fromkeys(hashes))
+    present = destination.has_blobs(unique)
+    missing = [sha for sha in unique if sha not in present]
+    stats = TransferStats(skipped=len(unique) - len(missing))
+    lock = threading.Lock()
+
+    def _transfer(sha: str):
+        if destination.copy_blob_from(source, sha):
+            with lock:
+                stats.server_copies += 1
+            return
+
+        with source.open_blob(sha) as stream:
+            size = destination.put_blob(sha, stream)
+        with lock:
+            stats.sent += 1
+            stats.bytes_sent += size
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(missing)))) as executor:
+            list(executor.map(_transfer, missing))
+
+    if message:
+        message(f"{stats.sent} blobs sent ({stats.bytes_sent} bytes), {stats.server_copies} copied by the server, "
+                f"{stats.skipped} already present")
+    return stats
+
+
+def _copy_values(source: IKeyStore, destination: IKeyStore, keys: List[Tuple[str, str, str]]) -> TransferStats:
+    """ Copies values key by key, given (source secret, destination secret, key name) triples, for stores which don't
+    implement the blob methods. Each value is read with open_value and written with put_stream, which stores that only
+    implement get_value and put_value support through the defaults of IKeyStore. """
+    stats = TransferStats()
+    for source_name, destination_name, key_name in keys:
+        with source.open_value(source_name, key_name) as stream:
+            data = stream.read()
+        destination.put_stream(destination_name, key_name, BytesIO(data), len(data))
+        stats.sent += 1
+        stats.bytes_sent += len(data)
+    return stats
+
+
+def copy_secrets(source: IKeyStore, destination: IKeyStore, names: List[Tuple[str, str]], workers: int = 8,
+                 message: Optional[Callable[[str], None]] = None) -> TransferStats:
+    """ Copies secrets with all their keys and metadata, given pairs of source and destination names. The content is
+    transferred first and the destination is then updated in a single batch, unless either store only implements
+    the value methods, in which case the values are copied key by key. """
+    secrets: List[Tuple[Secret, str]] = [(source.get_meta(s), d) for s, d in names]
+    if not (_has_blob_api(source) and _has_blob_api(destination)):
+        keys = [(secret.name, d, k) for secret, d in secrets for k, sha in secret.get_keys().items() if sha]
+        stats = _copy_values(source, destination, keys)
+        for secret, destination_name in secrets:
+            destination.set_meta(destination_name, secret.meta_data)
+        if message:
+            message(f"{stats.sent} values copied ({stats.bytes_sent} bytes)")
+        return stats
+
+    hashes = [sha for secret, _ in secrets for sha in secret.get_keys().values() if sha]
+    stats = transfer_blobs(source, destination, hashes, workers, message)
+
+    with destination.batch() as batch:
+        for secret, destination_name in secrets:
+            for key_name, sha in secret.get_keys().items():
+                if sha:
+                    batch.link(destination_name, key_name, sha)
+            batch.set_meta(destination_name, secret.meta_data)
+
+    return stats
+
+
+@dataclass
+class SyncResult:
+    """ The changes a sync made to the destination store, along with the content it had to move """
+    created: int = 0
+    updated: int = 0
+    removed: int = 0
+    unchanged: int = 0
+    transfer: TransferStats = field(default_factory=TransferStats)
+
+
+def sync_stores(source: IKeyStore, destination: IKeyStore, prefix: Optional[str] = None, delete: bool = False,
+                workers: int = 8, message: Optional[Callable[[str], None]] = None) -> SyncResult:
+    """ Makes the secrets in the destination match those in the source, optionally only the ones whose names start
+    with a prefix. Secrets are compared key by key using their content hashes, so only content the destination is
+    missing is transferred. Secrets and keys which aren't in the source are only removed from the destination if
+    delete is set.
+
+    The destination is updated in a single batch after all the content has arrived, so an interrupted sync leaves it
+    unchanged, and running the sync again skips the content which was already transferred. With stores which don't
+    implement the blob methods the changed values are copied key by key before the batch instead. """
+    wanted = {s.name: s for s in source.iter_secrets(prefix)}
+    current = {s.name: s for s in destination.iter_secrets(prefix)}
+    result = SyncResult()
+    by_blob = _has_blob_api(source) and _has_blob_api(destination)
+
+    operations = KeyStoreBatch(destination)
+    needed: List[str] = []
+    copies: List[Tuple[str, str, str]] = []
+    for name, secret in sorted(wanted.items()):
+        keys = {k: sha for k, sha in secret.get_keys().items() if sha}
+        existing = current.get(name, None)
+        existing_keys = existing.get_keys() if existing else {}
+
+        changed = {k: sha for k, sha in keys.items() if existing_keys.get(k, None) != sha}
+        extra = [k for k in existing_keys if k not in keys] if delete else []
+        meta_changed = existing is None or existing.meta_data != secret.meta_data
+        if not changed and not extra and not meta_changed:
+            result.unchanged += 1
+            continue
+
+        # Keys are linked before any are removed, since removing the last key of a secret removes the secret
+        for key_name, sha in changed.items():
+            if by_blob:
+                operations.link(name, key_name, sha)
+                needed.append(sha)
+            else:
+                copies.append((name, name, key_name))
+        for key_name in extra:
+            operations.rm(name, key_name)
+        operations.set_meta(name, secret.meta_data)
+
+        if existing is None:
+            result.created += 1
+        else:
+            result.updated += 1
+
+    if delete:
+        for name in sorted(n for n in current if n not in wanted):
+            for key_name in current[name].get_keys():
+                operations.rm(name, key_name)
+            result.removed += 1
+
+    if by_blob:
+        result.transfer = transfer_blobs(source, destination, needed, workers, message)
+    else:
+        result.transfer = _copy_values(source, destination, copies)
+    operations.commit()
+
+    if message:
+        message(f"{result.created} secrets created, {result.updated} updated, {result.removed} removed, "
+                f"{result.unchanged} unchanged")
+    return result
+
+
+def _has_blob_api(store: IKeyStore) -> bool:
+    """ Whether a store implements the blob methods and link operations, rather than only the value methods of
+    IKeyStore """
+    return all(getattr(type(store), m) is not getattr(IKeyStore, m) for m in ("open_blob", "put_blob"))
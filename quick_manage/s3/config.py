@@ -1,8 +1,11 @@
 from dataclasses import dataclass
 from typing import Optional
 
+import socket
+
 from minio import Minio
 from urllib3 import Retry, PoolManager
+from urllib3.connection import HTTPConnection
 
 
 @dataclass
@@ -16,10 +19,26 @@ class S3Config:
     secure: bool = True
     timeout: float = 1
     retries: int = 1
+    index_max_age: float = 0
+    index_shards: int = 0
+    write_retries: int = 5
+    retry_backoff: float = 0.1
+    pool_size: int = 10
+    keep_alive: bool = True
+    max_workers: int = 8
+    cache_path: Optional[str] = None
+    cache_max_bytes: int = 256 * 1024 * 1024
+    index_format: str = "json"
 
     def make_client(self) -> Minio:
+        socket_options = list(HTTPConnection.default_socket_options)
+        if self.keep_alive:
+            socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+
         http_client = PoolManager(timeout=self.timeout,
-                                  retries=Retry(total=self.retries))
+                                  retries=Retry(total=self.retries),
+                                  maxsize=self.pool_size,
+                                  socket_options=socket_options)
         return Minio(self.endpoint,
                      access_key=self.access_key,
                      secret_key=self.secret_key,
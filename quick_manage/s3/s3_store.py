@@ -1,19 +1,81 @@
+import heapq
+import io
 import json
+import random
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
-from dacite import from_dict
 from minio import Minio, S3Error
+from minio.commonconfig import CopySource
+from minio.error import ServerError
 from minio.datatypes import Object
 from urllib3.response import HTTPResponse
-from typing import List, Generator, Dict, Optional, Tuple
+from typing import List, Generator, Dict, Optional, Tuple, Callable, Set, BinaryIO, Iterable, Iterator
 from io import BytesIO
+from dataclasses import dataclass
 
 from quick_manage.s3 import S3Config
-from ..impl_helpers import KeyStoreIndex, sha1_digest
-from ..impl_helpers.serialization import as_dict_strip
-from ..keys import IKeyStore, Secret
+from ..impl_helpers import KeyStoreIndex, IndexCache, BlobCache, apply_operations, copy_hashed, get_codec, \
+    decode_index
+from ..keys import IKeyStore, Secret, KeyStoreOperation
+
+_MANIFEST_NAME = "index/manifest.json"
+
+# Streamed values larger than this are spooled to a temporary file while they are hashed
+_SPOOL_SIZE = 8 * 1024 * 1024
+
+
+@dataclass
+class IndexWriteStats:
+    """ Counts of index object writes made by a store, and of the conflicts with other writers it had to resolve """
+    writes: int = 0
+    conflicts: int = 0
+    retries: int = 0
+
+
+class _IndexObject:
+    """ An index object in the bucket along with the cached copy of its contents """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.cache = IndexCache()
+        self.validated_at: Optional[float] = None
+        self.format: Optional[str] = None
+
+
+class _ObjectStream(io.RawIOBase):
+    """ A readable stream over the body of a get_object response, which releases the connection when closed """
+
+    def __init__(self, response: HTTPResponse):
+        self._response = response
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._response.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._response.close()
+            self._response.release_conn()
+        super().close()
 
 
 class S3Store(IKeyStore):
+    """ A key store which keeps content objects and its index in an S3 bucket. The index is either a single
+    index.json object, or, when the store has been migrated to a partitioned layout, a set of shard objects listed by
+    a small manifest. Secrets are assigned to shards by a hash of the first segment of their name, so all secrets
+    under the same top level prefix share one shard.
+
+    Index objects are only overwritten if they are unchanged since they were read. When another writer got there
+    first, the store reads the new version and applies its pending writes again, so several writers may safely work
+    on one bucket at the same time. """
 
     @property
     def type_name(self) -> str:
@@ -22,102 +84,427 @@ class S3Store(IKeyStore):
     def __init__(self, config: S3Config):
         self.config = config
         self._prefix = self.config.prefix.strip("/") if self.config.prefix is not None else None
-        self._index_path = self._name("index.json")
+        self._objects: Dict[str, _IndexObject] = {}
+        self._shard_count: Optional[int] = None
+        self._client: Optional[Minio] = None
+        self._client_lock = threading.Lock()
+        self.write_stats = IndexWriteStats()
+        self._codec = get_codec(self.config.index_format)
+        self.blob_cache: Optional[BlobCache] = None
+        if self.config.cache_path:
+            self.blob_cache = BlobCache(self.config.cache_path, self.config.cache_max_bytes)
+
+    @property
+    def client(self) -> Minio:
+        """ The minio client shared by all operations on this store, created on first use. Its connection pool keeps
+        connections to the endpoint open between calls. """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.config.make_client()
+        return self._client
+
+    @property
+    def index_caches(self) -> Dict[str, IndexCache]:
+        """ The caches of the index objects fetched so far, by object name, which hold the hit and miss counters """
+        return {name: obj.cache for name, obj in self._objects.items()}
 
     def put_value(self, secret_name: str, key_name: Optional[str], value: str):
-        client = self.config.make_client()
-        index = self._read_index(client)
-        sha = sha1_digest(value)
-        if not key_name:
-            key_name = "default"
-        target = index.find_or_create(secret_name)
+        self.apply([KeyStoreOperation(KeyStoreOperation.PUT, secret_name, key_name, value=value)])
 
-        if target.keys is None:
-            target.keys = {}
-        target.keys[key_name] = sha
+    def rm(self, secret_name: str, key_name: Optional[str]):
+        self.apply([KeyStoreOperation(KeyStoreOperation.RM, secret_name, key_name)])
 
-        self._write_index(index, client)
+    def apply(self, operations: List[KeyStoreOperation]):
+        client = self.client
+        groups: Dict[str, List[KeyStoreOperation]] = {}
+        for op in operations:
+            groups.setdefault(self._index_name_for(op.secret_name, client), []).append(op)
 
-        raw_bytes = value.encode("utf-8")
-        buffer = BytesIO(raw_bytes)
-        client.put_object(self.config.bucket, self._name(sha), buffer, len(raw_bytes))
+        indexes: Dict[str, KeyStoreIndex] = {}
+        released: Set[str] = set()
+        for name, group in groups.items():
+            indexes[name], group_released = self._apply_to_object(name, group, client)
+            released.update(group_released)
 
-    def rm(self, secret_name: str, key_name: Optional[str]):
-        client = self.config.make_client()
-        index, target, sha = self._find_key(secret_name, key_name, client)
+        # A content hash released by one shard may still be used by secrets in another, or may have been linked again
+        # by another writer since this one read the index, so every index object is checked against the bucket right
+        # before the content is deleted
+        if released:
+            for index in self._revalidate_objects(self._index_names(client), client):
+                released = {h for h in released if index.ref_count(h) == 0}
 
-        # If no other secret/key uses this hash, we may delete the file
-        used = [h for s in index.secrets for h in s.keys.values() if h == sha]
-        if len(used) == 1:
+        for sha in released:
             client.remove_object(self.config.bucket, self._name(sha))
 
-        if len(target.keys) == 1:
-            # This is the only key left, we can delete the whole secret
-            index.secrets.remove(target)
-        else:
-            del target.keys[key_name]
+    def _apply_to_object(self, name: str, operations: List[KeyStoreOperation],
+                         client: Minio) -> Tuple[KeyStoreIndex, Set[str]]:
+        """ Applies writes to a single index object, re-reading the object and applying them again if another writer
+        changes it in the meantime. Returns the index as written and the content hashes it no longer refers to. """
+        attempts = self.config.write_retries + 1
+        for attempt in range(attempts):
+            if attempt:
+                self.write_stats.retries += 1
+                time.sleep(self.config.retry_backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
 
-        self._write_index(index, client)
+            index = self._read_object(name, client, revalidate=attempt > 0)
+            try:
+                writes, released = apply_operations(index, operations)
+
+                # Upload the content objects before the index which refers to them
+                for sha, value in writes.items():
+                    raw_bytes = value.encode("utf-8")
+                    client.put_object(self.config.bucket, self._name(sha), BytesIO(raw_bytes), len(raw_bytes))
+                    if self.blob_cache is not None:
+                        self.blob_cache.put(sha, raw_bytes)
+            except Exception:
+                # The cached index is modified in place, so it must not keep operations which were never committed
+                self._object(name).cache.clear()
+                raise
+
+            try:
+                self._write_object(name, index, client)
+                return index, released
+            except S3Error as e:
+                if e.code != "PreconditionFailed":
+                    raise
+                self.write_stats.conflicts += 1
+
+        raise RuntimeError(f"Could not update the index object '{name}' after {attempts} attempts because it was "
+                           f"repeatedly changed by other writers")
 
     def get_value(self, secret_name: str, key_name: Optional[str]) -> str:
-        client = self.config.make_client()
-        index, target, sha = self._find_key(secret_name, key_name, client)
+        client = self.client
+        index = self._read_object(self._index_name_for(secret_name, client), client)
+        return self._get_content(index.find_key(secret_name, key_name), client)
 
-        result: HTTPResponse = client.get_object(self.config.bucket, self._name(sha))
-        return result.data.decode("utf-8")
+    def open_value(self, secret_name: str, key_name: Optional[str]) -> BinaryIO:
+        client = self.client
+        index = self._read_object(self._index_name_for(secret_name, client), client)
+        return self.open_blob(index.find_key(secret_name, key_name))
+
+    def put_stream(self, secret_name: str, key_name: Optional[str], stream: BinaryIO, length: Optional[int] = None):
+        sha, _ = self._upload_stream(stream, length)
+        self.apply([KeyStoreOperation(KeyStoreOperation.LINK, secret_name, key_name, sha=sha)])
+
+    def has_blobs(self, hashes: Iterable[str]) -> Set[str]:
+        # Content referred to by the index is known to exist, anything else is left over from an interrupted write or
+        # copy and has to be checked for individually
+        client = self.client
+        hashes = set(hashes)
+        indexed = {sha for index in self._read_objects(self._index_names(client), client)
+                   for sha in index.content_hashes()}
+        found = hashes & indexed
+        unknown = list(hashes - indexed)
+        if unknown:
+            with self._executor(len(unknown)) as executor:
+                exists = list(executor.map(lambda h: self._object_exists(self._name(h), client), unknown))
+            found.update(sha for sha, present in zip(unknown, exists) if present)
+        return found
+
+    def open_blob(self, sha: str) -> BinaryIO:
+        client = self.client
+        if self.blob_cache is not None:
+            cached = self.blob_cache.open(sha)
+            if cached is None:
+                self._cache_content(sha, client)
+                cached = self.blob_cache.open(sha)
+            if cached is not None:
+                return cached
+
+        result = client.get_object(self.config.bucket, self._name(sha))
+        return io.BufferedReader(_ObjectStream(result))
+
+    def put_blob(self, sha: str, stream: BinaryIO, length: Optional[int] = None) -> int:
+        _, size = self._upload_stream(stream, length, expected=sha)
+        return size
+
+    def copy_blob_from(self, source: IKeyStore, sha: str) -> bool:
+        """ Content in another S3Store on the same endpoint and with the same credentials is copied by the server """
+        if not isinstance(source, S3Store) or not self._same_server(source):
+            return False
+
+        copy_source = CopySource(source.config.bucket, source._name(sha))
+        self.client.copy_object(self.config.bucket, self._name(sha), copy_source)
+        return True
+
+    def _same_server(self, other: "S3Store") -> bool:
+        return (self.config.endpoint, self.config.access_key, self.config.secure) == \
+               (other.config.endpoint, other.config.access_key, other.config.secure)
+
+    def _upload_stream(self, stream: BinaryIO, length: Optional[int],
+                       expected: Optional[str] = None) -> Tuple[str, int]:
+        """ Uploads a stream as a content object and returns its hash and size. The object name is the hash of the
+        content, so the content has to be read through once before it can be uploaded. """
+        with tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE) as spool:
+            sha, size = copy_hashed(stream, spool, length)
+            if expected is not None and sha != expected:
+                raise ValueError(f"The content given for '{expected}' has the hash '{sha}'")
+            spool.seek(0)
+            self.client.put_object(self.config.bucket, self._name(sha), spool, size)
+        return sha, size
+
+    def _object_exists(self, name: str, client: Minio) -> bool:
+        try:
+            client.stat_object(self.config.bucket, name)
+        except S3Error as e:
+            if e.code == "NoSuchKey":
+                return False
+            raise
+        return True
+
+    def get_values(self, requests: List[Tuple[str, Optional[str]]]) -> List[str]:
+        client = self.client
+        names = [self._index_name_for(secret_name, client) for secret_name, _ in requests]
+        unique_names = list(dict.fromkeys(names))
+        indexes = dict(zip(unique_names, self._read_objects(unique_names, client)))
+        hashes = [indexes[n].find_key(secret_name, key_name) for n, (secret_name, key_name) in zip(names, requests)]
+
+        unique = list(dict.fromkeys(hashes))
+        with self._executor(len(unique)) as executor:
+            contents = dict(zip(unique, executor.map(lambda h: self._get_content(h, client), unique)))
+        return [contents[sha] for sha in hashes]
 
     def get_meta(self, secret_name: str) -> Secret:
-        client = self.config.make_client()
-        index, target = self._find_secret(secret_name, client)
+        client = self.client
+        index = self._read_object(self._index_name_for(secret_name, client), client)
+        target = index.find_secret(secret_name)
+        if not target:
+            raise KeyError(f"No secret named '{secret_name}' was found")
         return target
 
     def set_meta(self, secret_name: str, value: Dict):
-        client = self.config.make_client()
-        index, target = self._find_secret(secret_name, client)
-        target.meta_data = value
-        self._write_index(index, client)
+        self.apply([KeyStoreOperation(KeyStoreOperation.SET_META, secret_name, meta_data=value)])
 
     def all(self) -> Dict[str, Secret]:
-        client = self.config.make_client()
-        index = self._read_index(client)
-        return {x.name: x for x in index.secrets}
+        client = self.client
+        indexes = self._read_objects(self._index_names(client), client)
+        return {x.name: x for index in indexes for x in index.secrets}
 
-    def _find_secret(self, secret_name, client: Minio) -> Tuple[KeyStoreIndex, Secret]:
-        index = self._read_index(client)
+    def has_secret(self, secret_name: str) -> bool:
+        client = self.client
+        return secret_name in self._read_object(self._index_name_for(secret_name, client), client)
 
-        target = index.find_secret(secret_name)
-        if not target:
-            raise KeyError(f"No secret named '{secret_name}' was found")
+    def iter_secrets(self, prefix: Optional[str] = None, type: Optional[str] = None) -> Iterator[Secret]:
+        client = self.client
+        names = self._index_names(client)
+        if prefix and "/" in prefix:
+            # Shards are chosen by the first segment of the name, so a prefix which includes it lives in one shard
+            names = [self._index_name_for(prefix, client)]
+
+        indexes = self._read_objects(names, client)
+        for secret in heapq.merge(*[index.with_prefix(prefix) for index in indexes], key=lambda s: s.name):
+            if not type or secret.get_type_name() == type:
+                yield secret
+
+    def migrate(self, message: Optional[Callable[[str], None]] = None):
+        """ Rewrites the index into the number of shards set by index_shards in the configuration, where zero is the
+        single index.json object, and in the format set by index_format. The new index objects are written before the
+        manifest is switched over to them, so an interrupted migration leaves the old index in place. Other writers
+        should be stopped while it runs. """
+        client = self.client
+        current, target = self._layout(client), self.config.index_shards
+
+        if current != target:
+            old_names = self._index_names(client, current)
+            secrets = [s for index in self._read_objects(old_names, client) for s in index.secrets]
+            new_names = self._index_names(client, target)
+            groups: Dict[str, List[Secret]] = {n: [] for n in new_names}
+            for secret in secrets:
+                groups[new_names[_shard_of(secret.name, len(new_names))]].append(secret)
+
+            for name, group in groups.items():
+                self._write_object(name, KeyStoreIndex(group), client, conditional=False)
+
+            if target:
+                raw_bytes = json.dumps({"shards": target}).encode("utf-8")
+                client.put_object(self.config.bucket, self._name(_MANIFEST_NAME), BytesIO(raw_bytes), len(raw_bytes))
+            else:
+                client.remove_object(self.config.bucket, self._name(_MANIFEST_NAME))
+            self._shard_count = target
+
+            if message:
+                message(f"Wrote {len(secrets)} secrets into {len(new_names)} index objects")
+        else:
+            names = self._index_names(client)
+            indexes = self._read_objects(names, client)
+            converted = [(n, i) for n, i in zip(names, indexes)
+                         if self._object(n).format not in (None, self._codec.name)]
+            for name, index in converted:
+                self._write_object(name, index, client)
+
+            if message and converted:
+                message(f"Converted {len(converted)} index objects to {self._codec.name}")
+
+        # Remove index objects left over from the old layout, including any from an interrupted earlier migration
+        keep = set(self._index_names(client)) | {self._name(_MANIFEST_NAME)}
+        stale = [x.object_name for x in client.list_objects(self.config.bucket, prefix=self._name("index/"),
+                                                            recursive=True) if x.object_name not in keep]
+        if target:
+            stale.append(self._name("index.json"))
+        for name in stale:
+            client.remove_object(self.config.bucket, name)
+            self._objects.pop(name, None)
+
+        if message:
+            message(f"Index layout has {target if target else 'no'} shards")
+
+    def _layout(self, client: Minio) -> int:
+        """ The number of index shards the bucket currently uses, according to its manifest. This is read once per
+        store, since it only changes during a migration. """
+        if self._shard_count is None:
+            try:
+                result: HTTPResponse = client.get_object(self.config.bucket, self._name(_MANIFEST_NAME))
+            except S3Error as e:
+                if e.code == "NoSuchKey":
+                    self._shard_count = 0
+                    return self._shard_count
+                raise
+
+            try:
+                self._shard_count = int(json.loads(result.data.decode("utf-8"))["shards"])
+            finally:
+                result.close()
+                result.release_conn()
+
+        return self._shard_count
+
+    def _index_names(self, client: Minio, shards: Optional[int] = None) -> List[str]:
+        count = self._layout(client) if shards is None else shards
+        if not count:
+            return [self._name("index.json")]
+        return [self._name("index", f"{count}-{i:03}.json") for i in range(count)]
 
-        return index, target
+    def _index_name_for(self, secret_name: str, client: Minio) -> str:
+        names = self._index_names(client)
+        return names[_shard_of(secret_name, len(names))]
 
-    def _find_key(self, secret_name, key_name, client: Minio) -> Tuple[KeyStoreIndex, Secret, str]:
-        index, target = self._find_secret(secret_name, client)
-        if not key_name:
-            key_name = "default"
+    def _object(self, name: str) -> _IndexObject:
+        if name not in self._objects:
+            self._objects[name] = _IndexObject(name)
+        return self._objects[name]
 
-        if key_name not in target.keys:
-            raise KeyError(f"No key named '{key_name}' found in secret '{secret_name}'")
+    def _executor(self, tasks: int) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=max(1, min(self.config.max_workers, tasks)))
 
-        return index, target, target.keys[key_name]
+    def _get_content(self, sha: str, client: Minio) -> str:
+        """ Fetches the content with a hash, using the local blob cache if there is one. Content objects never change,
+        so only the index ever has to be checked against the bucket. """
+        if self.blob_cache is not None:
+            data = self.blob_cache.get(sha)
+            if data is not None:
+                return data.decode("utf-8")
 
-    def _write_index(self, index: KeyStoreIndex, client: Minio):
-        raw_bytes = json.dumps(as_dict_strip(index)).encode("utf-8")
-        buffer = BytesIO(raw_bytes)
-        client.put_object(self.config.bucket, self._index_path, buffer, len(raw_bytes))
+        result: HTTPResponse = client.get_object(self.config.bucket, self._name(sha))
+        try:
+            data = result.data
+        finally:
+            result.close()
+            result.release_conn()
+
+        if self.blob_cache is not None:
+            self.blob_cache.put(sha, data)
+        return data.decode("utf-8")
+
+    def _cache_content(self, sha: str, client: Minio):
+        """ Downloads a content object straight into the blob cache """
+        with io.BufferedReader(_ObjectStream(client.get_object(self.config.bucket, self._name(sha)))) as stream:
+            self.blob_cache.put_stream(sha, stream)
+
+    def _write_object(self, name: str, index: KeyStoreIndex, client: Minio, conditional: bool = True):
+        """ Writes an index object. A conditional write only succeeds if the object still has the ETag it had when it
+        was read, or still doesn't exist if it didn't then, and otherwise raises an S3Error with the code
+        'PreconditionFailed'. """
+        obj = self._object(name)
+        raw_bytes = self._codec.encode(index.to_dict())
+        headers = {"Content-Type": self._codec.content_type}
+        if conditional:
+            etag = obj.cache.signature
+            if etag is not None:
+                headers["If-Match"] = f'"{etag}"'
+            else:
+                headers["If-None-Match"] = "*"
+
+        try:
+            result = _conditional_put(client, self.config.bucket, name, raw_bytes, headers)
+        except Exception:
+            # The cached index may have been modified in place before the write failed
+            obj.cache.clear()
+            raise
+
+        self.write_stats.writes += 1
+        obj.cache.put(result.etag, index)
+        obj.validated_at = time.monotonic()
+        obj.format = self._codec.name
+
+    def _revalidate_objects(self, names: List[str], client: Minio) -> List[KeyStoreIndex]:
+        if len(names) < 2:
+            return [self._read_object(n, client, revalidate=True) for n in names]
+        with self._executor(len(names)) as executor:
+            return list(executor.map(lambda n: self._read_object(n, client, revalidate=True), names))
 
-    def _read_index(self, client: Minio) -> KeyStoreIndex:
+    def _read_objects(self, names: List[str], client: Minio) -> List[KeyStoreIndex]:
+        if len(names) < 2:
+            return [self._read_object(n, client) for n in names]
+        with self._executor(len(names)) as executor:
+            return list(executor.map(lambda n: self._read_object(n, client), names))
+
+    def _read_object(self, name: str, client: Minio, revalidate: bool = False) -> KeyStoreIndex:
+        obj = self._object(name)
+
+        # Within the freshness window the cached index is trusted without asking the server
+        etag = obj.cache.signature
+        if etag is not None and not revalidate and self._is_fresh(obj):
+            return obj.cache.get(etag)
+
+        headers = {"If-None-Match": f'"{etag}"'} if etag is not None else None
         try:
-            result: HTTPResponse = client.get_object(self.config.bucket, self._index_path)
+            result: HTTPResponse = client.get_object(self.config.bucket, name, request_headers=headers)
+        except ServerError as e:
+            if e.status_code == 304:
+                obj.validated_at = time.monotonic()
+                return obj.cache.get(etag)
+            raise
         except S3Error as e:
             if e.code == "NoSuchKey":
+                obj.cache.clear()
+                obj.format = None
                 return KeyStoreIndex()
             raise
 
-        text = result.data.decode("utf-8")
-        return from_dict(KeyStoreIndex, json.loads(text))
+        try:
+            raw_bytes = result.data
+            etag = result.headers.get("etag", "").strip('"') or None
+        finally:
+            result.close()
+            result.release_conn()
+
+        data, obj.format = decode_index(raw_bytes)
+        index = KeyStoreIndex.from_dict(data)
+        obj.cache.misses += 1
+        obj.cache.put(etag, index)
+        obj.validated_at = time.monotonic()
+        return index
+
+    def _is_fresh(self, obj: _IndexObject) -> bool:
+        if not self.config.index_max_age or obj.validated_at is None:
+            return False
+        return time.monotonic() - obj.validated_at < self.config.index_max_age
 
     def _name(self, *args) -> str:
         pieces = [self._prefix] + list(args) if self._prefix else list(args)
         return "/".join(pieces)
 
+
+def _shard_of(secret_name: str, count: int) -> int:
+    if count < 2:
+        return 0
+    top_level = secret_name.split("/", 1)[0]
+    return zlib.crc32(top_level.encode("utf-8")) % count
+
+
+def _conditional_put(client: Minio, bucket: str, name: str, data: bytes, headers: Dict):
+    """ Uploads an object with request headers such as If-Match. The public put_object sends any headers it is given
+    as user metadata, so this has to use Minio._put_object, which takes the headers as they are. That is a private
+    method, but it has the same signature throughout the minio 7.1 releases which setup.py allows. """
+    return client._put_object(bucket, name, data, headers)
@@ -0,0 +1 @@
+from .sqlite_key_store import SqliteKeyStore
@@ -0,0 +1,308 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Dict, Optional, List, Tuple, Callable, BinaryIO, Iterator, Iterable, Set
+
+from ..impl_helpers import copy_hashed
+from ..keys import Secret, IKeyStore, KeyStoreOperation
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS secrets (
+    name TEXT PRIMARY KEY,
+    meta_data TEXT
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS keys (
+    secret TEXT NOT NULL REFERENCES secrets (name) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    sha TEXT NOT NULL,
+    PRIMARY KEY (secret, name)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS blobs (
+    sha TEXT PRIMARY KEY,
+    refs INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+"""
+
+
+class SqliteKeyStore(IKeyStore):
+    """ A key store which keeps secrets, keys and content in a single SQLite database file. Content is stored once per
+    sha1 hash in the blobs table along with the number of keys which refer to it, and is deleted when the last of
+    them goes away. Every write is a single transaction, and the database runs in WAL mode so that readers in other
+    processes are never blocked by a writer. """
+
+    @property
+    def type_name(self) -> str:
+        return "SQLite"
+
+    @dataclass
+    class Config:
+        path: str
+        timeout: float = 30.0
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._path = os.path.expanduser(config.path)
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """ The connection used by the current thread, opened on first use since SQLite connections may not be
+        shared between threads """
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            folder = os.path.dirname(os.path.abspath(self._path))
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+            # Transactions are started explicitly, so the module's implicit transaction handling is turned off
+            conn = sqlite3.connect(self._path, timeout=self.config.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.executescript(_SCHEMA)
+            self._local.connection = conn
+        return conn
+
+    def close(self):
+        """ Closes the connection used by the current thread """
+        conn = getattr(self._local, "connection", None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    def put_value(self, secret_name: str, key_name: Optional[str], value: str):
+        self.apply([KeyStoreOperation(KeyStoreOperation.PUT, secret_name, key_name, value=value)])
+
+    def rm(self, secret_name: str, key_name: Optional[str]):
+        self.apply([KeyStoreOperation(KeyStoreOperation.RM, secret_name, key_name)])
+
+    def set_meta(self, secret_name: str, value: Dict):
+        self.apply([KeyStoreOperation(KeyStoreOperation.SET_META, secret_name, meta_data=value)])
+
+    def apply(self, operations: List[KeyStoreOperation]):
+        with self._transaction() as conn:
+            for op in operations:
+                _apply_operation(conn, op)
+
+    def put_stream(self, secret_name: str, key_name: Optional[str], stream: BinaryIO, length: Optional[int] = None):
+        sha, data = _read_hashed(stream, length)
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO blobs (sha, refs, data) VALUES (?, 0, ?)", (sha, data))
+            _apply_operation(conn, KeyStoreOperation(KeyStoreOperation.LINK, secret_name, key_name, sha=sha))
+
+    def has_blobs(self, hashes: Iterable[str]) -> Set[str]:
+        hashes = list(hashes)
+        found = set()
+        # Stay well under SQLite's limit on the number of parameters in one statement
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            rows = self.connection.execute(f"SELECT sha FROM blobs WHERE sha IN ({', '.join('?' * len(chunk))})",
+                                           chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    def open_blob(self, sha: str) -> BinaryIO:
+        row = self.connection.execute("SELECT data FROM blobs WHERE sha = ?", (sha,)).fetchone()
+        if row is None:
+            raise KeyError(f"No content with the hash '{sha}' is held by the key store")
+        return BytesIO(row[0])
+
+    def put_blob(self, sha: str, stream: BinaryIO, length: Optional[int] = None) -> int:
+        actual, data = _read_hashed(stream, length)
+        if actual != sha:
+            raise ValueError(f"The content given for '{sha}' has the hash '{actual}'")
+
+        # Unreferenced content has a count of zero until a link operation points a key at it
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO blobs (sha, refs, data) VALUES (?, 0, ?)", (sha, data))
+        return len(data)
+
+    def get_value(self, secret_name: str, key_name: Optional[str]) -> str:
+        return self._get_data(self.connection, secret_name, key_name).decode("utf-8")
+
+    def open_value(self, secret_name: str, key_name: Optional[str]) -> BinaryIO:
+        return BytesIO(self._get_data(self.connection, secret_name, key_name))
+
+    def get_values(self, requests: List[Tuple[str, Optional[str]]]) -> List[str]:
+        # A single read transaction gives a consistent view of all the values even while another process writes
+        with self._transaction(read_only=True) as conn:
+            return [self._get_data(conn, s, k).decode("utf-8") for s, k in requests]
+
+    def get_meta(self, secret_name: str) -> Secret:
+        with self._transaction(read_only=True) as conn:
+            row = conn.execute("SELECT name, meta_data FROM secrets WHERE name = ?", (secret_name,)).fetchone()
+            if row is None:
+                raise KeyError(f"No secret named '{secret_name}' was found")
+            keys = conn.execute("SELECT name, sha FROM keys WHERE secret = ?", (secret_name,)).fetchall()
+        return _to_secret(row, keys)
+
+    def has_secret(self, secret_name: str) -> bool:
+        row = self.connection.execute("SELECT 1 FROM secrets WHERE name = ?", (secret_name,)).fetchone()
+        return row is not None
+
+    def all(self) -> Dict[str, Secret]:
+        return {x.name: x for x in self.iter_secrets()}
+
+    def iter_secrets(self, prefix: Optional[str] = None, type: Optional[str] = None) -> Iterator[Secret]:
+        """ The prefix is answered with a range scan over the primary key, and rows are fetched as they are consumed.
+        Being a single statement, the query sees one consistent version of the database even while another process
+        writes to it. """
+        where, args = "", ()
+        if prefix:
+            where = "WHERE secrets.name >= ? AND secrets.name < ?"
+            args = (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+        cursor = self.connection.execute(f"SELECT secrets.name, secrets.meta_data, keys.name, keys.sha FROM secrets "
+                                         f"LEFT JOIN keys ON keys.secret = secrets.name {where} "
+                                         f"ORDER BY secrets.name", args)
+        try:
+            for secret in _group_rows(cursor):
+                if not type or secret.get_type_name() == type:
+                    yield secret
+        finally:
+            cursor.close()
+
+    def import_store(self, source: IKeyStore, message: Optional[Callable[[str], None]] = None):
+        """ Copies every secret in another key store, such as an existing FolderKeyStore, into this one. The import is
+        a single transaction, so it either completes or leaves this store unchanged. Secrets which already exist here
+        have their keys and metadata overwritten. """
+        secrets = list(source.all().values())
+        with self._transaction() as conn:
+            for secret in secrets:
+                for key_name in secret.get_keys():
+                    with source.open_value(secret.name, key_name) as handle:
+                        data = handle.read()
+                    sha = hashlib.sha1(data).hexdigest()
+                    conn.execute("INSERT OR IGNORE INTO blobs (sha, refs, data) VALUES (?, 0, ?)", (sha, data))
+                    _apply_operation(conn, KeyStoreOperation(KeyStoreOperation.LINK, secret.name, key_name, sha=sha))
+                _apply_operation(conn, KeyStoreOperation(KeyStoreOperation.SET_META, secret.name,
+                                                         meta_data=secret.meta_data))
+                if message:
+                    message(f"Imported {secret.name} ({len(secret.get_keys())} keys)")
+
+        if message:
+            message(f"Imported {len(secrets)} secrets from the {source.type_name} key store")
+
+    @contextmanager
+    def _transaction(self, read_only: bool = False) -> Iterator[sqlite3.Connection]:
+        """ Runs the body in a transaction which is committed if it exits without an exception. Write transactions
+        take the database's write lock up front, so two writers never fail part way through with a busy error. """
+        conn = self.connection
+        conn.execute("BEGIN" if read_only else "BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _get_data(conn: sqlite3.Connection, secret_name: str, key_name: Optional[str]) -> bytes:
+        key_name = key_name if key_name else "default"
+        row = conn.execute("SELECT blobs.data FROM keys JOIN blobs ON blobs.sha = keys.sha "
+                           "WHERE keys.secret = ? AND keys.name = ?", (secret_name, key_name)).fetchone()
+        if row is None:
+            _existing_sha(conn, secret_name, key_name)
+        return row[0]
+
+
+def _read_hashed(stream: BinaryIO, length: Optional[int]) -> Tuple[str, bytes]:
+    """ Reads a stream into memory while hashing it, since SQLite needs the whole value to insert it """
+    sink = BytesIO()
+    sha, _ = copy_hashed(stream, sink, length)
+    return sha, sink.getvalue()
+
+
+def _group_rows(rows: Iterable[Tuple[str, Optional[str], Optional[str], Optional[str]]]) -> Iterator[Secret]:
+    """ Turns rows of secrets joined with their keys, ordered by secret name, into one Secret per name """
+    current, keys = None, []
+    for name, meta_data, key_name, sha in rows:
+        if current is not None and current[0] != name:
+            yield _to_secret(current, keys)
+            keys = []
+        current = (name, meta_data)
+        if key_name is not None:
+            keys.append((key_name, sha))
+
+    if current is not None:
+        yield _to_secret(current, keys)
+
+
+def _to_secret(row: Tuple[str, Optional[str]], keys: List[Tuple[str, str]]) -> Secret:
+    name, meta_data = row
+    return Secret(name, json.loads(meta_data) if meta_data is not None else None, dict(keys) if keys else None)
+
+
+def _existing_sha(conn: sqlite3.Connection, secret_name: str, key_name: str) -> str:
+    """ Returns the content hash of a key, raising a KeyError which names whichever of the secret or key is missing """
+    row = conn.execute("SELECT sha FROM keys WHERE secret = ? AND name = ?", (secret_name, key_name)).fetchone()
+    if row is not None:
+        return row[0]
+
+    if conn.execute("SELECT 1 FROM secrets WHERE name = ?", (secret_name,)).fetchone() is None:
+        raise KeyError(f"No secret named '{secret_name}' was found")
+    raise KeyError(f"No key named '{key_name}' found in secret '{secret_name}'")
+
+
+def _apply_operation(conn: sqlite3.Connection, op: KeyStoreOperation):
+    key_name = op.key_name if op.key_name else "default"
+
+    if op.kind == KeyStoreOperation.PUT:
+        data = op.value.encode("utf-8")
+        sha = hashlib.sha1(data).hexdigest()
+        conn.execute("INSERT OR IGNORE INTO blobs (sha, refs, data) VALUES (?, 0, ?)", (sha, data))
+        _set_key(conn, op.secret_name, key_name, sha)
+
+    elif op.kind == KeyStoreOperation.LINK:
+        _set_key(conn, op.secret_name, key_name, op.sha)
+
+    elif op.kind == KeyStoreOperation.RM:
+        sha = _existing_sha(conn, op.secret_name, key_name)
+        conn.execute("DELETE FROM keys WHERE secret = ? AND name = ?", (op.secret_name, key_name))
+        _release(conn, sha)
+
+        # Removing the last key removes the whole secret
+        if conn.execute("SELECT 1 FROM keys WHERE secret = ?", (op.secret_name,)).fetchone() is None:
+            conn.execute("DELETE FROM secrets WHERE name = ?", (op.secret_name,))
+
+    elif op.kind == KeyStoreOperation.SET_META:
+        meta_data = json.dumps(op.meta_data) if op.meta_data is not None else None
+        cursor = conn.execute("UPDATE secrets SET meta_data = ? WHERE name = ?", (meta_data, op.secret_name))
+        if not cursor.rowcount:
+            raise KeyError(f"No secret named '{op.secret_name}' was found")
+
+    else:
+        raise ValueError(f"Unknown key store operation '{op.kind}'")
+
+
+def _set_key(conn: sqlite3.Connection, secret_name: str, key_name: str, sha: str):
+    if not Secret.name_is_valid(secret_name):
+        raise ValueError(f"The secret name '{secret_name}' is not valid")
+    if not Secret.key_is_valid(key_name):
+        raise ValueError(f"The key name '{key_name}' is not valid")
+
+    row = conn.execute("SELECT sha FROM keys WHERE secret = ? AND name = ?", (secret_name, key_name)).fetchone()
+    previous = row[0] if row else None
+    if previous == sha:
+        return
+
+    if not conn.execute("UPDATE blobs SET refs = refs + 1 WHERE sha = ?", (sha,)).rowcount:
+        raise KeyError(f"No content with the hash '{sha}' is held by the key store")
+
+    conn.execute("INSERT OR IGNORE INTO secrets (name) VALUES (?)", (secret_name,))
+    conn.execute("INSERT OR REPLACE INTO keys (secret, name, sha) VALUES (?, ?, ?)", (secret_name, key_name, sha))
+    if previous is not None:
+        _release(conn, previous)
+
+
+def _release(conn: sqlite3.Connection, sha: str):
+    conn.execute("UPDATE blobs SET refs = refs - 1 WHERE sha = ?", (sha,))
+    conn.execute("DELETE FROM blobs WHERE sha = ? AND refs <= 0", (sha,))
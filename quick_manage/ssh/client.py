@@ -1,23 +1,84 @@
+import posixpath
+import shlex
+import shutil
+import stat
+import uuid
+from contextlib import contextmanager
 from dataclasses import dataclass
 from io import StringIO, BytesIO
-from typing import Optional, Dict
+from typing import Optional, Dict, BinaryIO, Tuple, List, Iterator
 
 from fabric import Connection, Config
 
-from quick_manage._common import HostClient
+from quick_manage._common import HostClient, FileUpload
+from quick_manage.impl_helpers import sha1_digest
 from quick_manage.keys import KeyGetter
 from quick_manage.ssh.keys import private_key_from_string
+from quick_manage.ssh.pool import ConnectionPool, default_pool
 
 
 class SSHClient(HostClient):
     def put_data(self, destination: str, data: str):
-        conn = self.connect()
-        bytes_io = BytesIO(data.encode("utf-8"))
-        conn.put(bytes_io, remote=destination)
+        self.put_stream(destination, BytesIO(data.encode("utf-8")))
+
+    def put_stream(self, destination: str, stream: BinaryIO):
+        # fabric's put seeks and tells on the stream, which a stream read straight from a key store may not support,
+        # so the file is written through the SFTP session instead
+        with self._connection() as conn:
+            with conn.sftp().open(destination, "wb") as handle:
+                handle.set_pipelined(True)
+                shutil.copyfileobj(stream, handle, 32768)
+
+    def put_many(self, files: Dict[str, FileUpload]):
+        """ Uploads the files through a single SFTP session. Each file is written in full to a temporary file next to
+        its destination and given its permissions, and only once all of them have been written are they renamed over
+        their destinations, so nothing reading the destinations ever sees a partly written file. If writing any of the
+        files fails, the temporary files are removed and no destination is touched. A failure while renaming leaves
+        the destinations which were already renamed holding their new contents. """
+        with self._connection() as conn:
+            self._put_many(conn.sftp(), files)
+
+    def _put_many(self, sftp, files: Dict[str, FileUpload]):
+        written: Dict[str, str] = {}
+        try:
+            for destination, upload in files.items():
+                folder, name = posixpath.split(destination)
+                temp_path = posixpath.join(folder, f".{name}.{uuid.uuid4().hex}.tmp")
+                written[destination] = temp_path
+
+                with sftp.open(temp_path, "wb") as handle:
+                    # Writes are sent without waiting for each one to be acknowledged
+                    handle.set_pipelined(True)
+                    shutil.copyfileobj(upload.stream, handle, 32768)
+                _set_permissions(sftp, temp_path, destination, upload)
+
+            for destination, temp_path in written.items():
+                sftp.posix_rename(temp_path, destination)
+        except Exception:
+            for temp_path in written.values():
+                try:
+                    sftp.remove(temp_path)
+                except IOError:
+                    pass
+            raise
+
+    def file_hashes(self, paths: List[str]) -> Dict[str, str]:
+        if not paths:
+            return {}
+
+        # A single command hashes every file, and sha1sum exits with an error for any which are missing
+        with self._connection() as conn:
+            result = conn.run("sha1sum -- " + " ".join(shlex.quote(p) for p in paths), hide=True, warn=True)
+        hashes = {}
+        for line in result.stdout.splitlines():
+            sha, _, path = line.partition("  ")
+            if path in paths:
+                hashes[path] = sha
+        return hashes
 
     def action(self, command: str):
-        conn = self.connect()
-        result = conn.run(command)
+        with self._connection() as conn:
+            result = conn.run(command)
         if result.stderr:
             raise RuntimeError(f"Error running command: {result.stderr}")
 
@@ -29,39 +90,99 @@ class SSHClient(HostClient):
         key: Optional[str] = None
         sudo: Optional[str] = None
 
-    def __init__(self, config: Config, key_getter: KeyGetter, nets: Dict[str, str]):
+    def __init__(self, config: Config, key_getter: KeyGetter, nets: Dict[str, str],
+                 pool: Optional[ConnectionPool] = None):
         self.config = config
         self.key_getter = key_getter
         self.nets = nets
+        self.pool = pool if pool is not None else default_pool()
 
-        # Prepare connection arguments
-        self.connect_kwargs = {}
-        if self.config.key:
-            pkey, _ = private_key_from_string(self.key_getter.get(self.config.key))
-            if pkey is None:
-                raise ValueError("Could not create private key from data")
-            self.connect_kwargs['pkey'] = pkey
-        elif self.config.password:
-            self.connect_kwargs["password"] = self.config.password
-        else:
+        if not self.config.key and not self.config.password:
             raise ValueError("Must provide either a password or a private key")
 
-        self._conn: Optional[Connection] = None
-
         # Prepare overrides
         overrides = {}
         if self.config.sudo:
             overrides["sudo"] = {"password": self.config.sudo}
 
         self.ssh_config = Config(overrides=overrides)
+        self._connected: Optional[Connection] = None
 
-    def connect(self):
-        if self._conn is None:
+    def connect(self) -> Connection:
+        """ Leases a connection to the host from the connection pool, which the client holds until close is called.
+        Clients with the same user, endpoint and credentials share one connection, and the private key is only parsed
+        when a new connection has to be made. """
+        if self._connected is None:
             host = self.nets[self.config.endpoint]
-            self._conn = Connection(host=host, user=self.config.user,
-                                    connect_kwargs=self.connect_kwargs,
-                                    config=self.ssh_config)
-        return self._conn
+            self._connected = self.pool.acquire(self._pool_key(host), lambda: self._make_connection(host))
+        return self._connected
+
+    def close(self):
+        """ Hands the connection leased by connect back to the pool """
+        if self._connected is not None:
+            self.pool.release(self._connected)
+            self._connected = None
+
+    @contextmanager
+    def _connection(self) -> Iterator[Connection]:
+        """ Leases a connection for a single operation, or uses the one already held by the client """
+        if self._connected is not None:
+            yield self._connected
+            return
+
+        host = self.nets[self.config.endpoint]
+        with self.pool.lease(self._pool_key(host), lambda: self._make_connection(host)) as conn:
+            yield conn
+
+    def _make_connection(self, host: str) -> Connection:
+        connect_kwargs = {}
+        if self.config.key:
+            pkey, _ = private_key_from_string(self.key_getter.get(self.config.key))
+            if pkey is None:
+                raise ValueError("Could not create private key from data")
+            connect_kwargs["pkey"] = pkey
+        else:
+            connect_kwargs["password"] = self.config.password
+
+        return Connection(host=host, user=self.config.user, connect_kwargs=connect_kwargs, config=self.ssh_config)
+
+    def _pool_key(self, host: str) -> Tuple:
+        # Passwords are hashed so they aren't held in the key, and the sudo password is included because it is part
+        # of the connection's configuration
+        auth = ("key", self.config.key) if self.config.key else ("password", sha1_digest(self.config.password))
+        sudo = sha1_digest(self.config.sudo) if self.config.sudo else None
+        return self.config.user, host, auth, sudo
+
+
+def _set_permissions(sftp, temp_path: str, destination: str, upload: FileUpload):
+    """ Gives a newly written file the configured mode and owner, keeping those of the file it will replace where
+    none are configured. A new file with no configured mode is only readable by its owner, since it may hold a private
+    key. Keeping the owner of the replaced file is only attempted, since a login which isn't root can't give files
+    to other users, in which case the file is left owned by the login. """
+    try:
+        existing = sftp.stat(destination)
+    except IOError:
+        existing = None
+
+    mode = upload.mode
+    if mode is None:
+        mode = stat.S_IMODE(existing.st_mode) if existing is not None else 0o600
+    sftp.chmod(temp_path, mode)
+
+    if upload.uid is None and upload.gid is None and existing is None:
+        return
+
+    current = sftp.stat(temp_path)
+    if upload.uid is not None or upload.gid is not None:
+        base = existing if existing is not None else current
+        uid = upload.uid if upload.uid is not None else base.st_uid
+        gid = upload.gid if upload.gid is not None else base.st_gid
+        sftp.chown(temp_path, uid, gid)
+    elif (existing.st_uid, existing.st_gid) != (current.st_uid, current.st_gid):
+        try:
+            sftp.chown(temp_path, existing.st_uid, existing.st_gid)
+        except PermissionError:
+            pass
 
 
 def create_remote_admin(username, host, password, admin_name, public_key):
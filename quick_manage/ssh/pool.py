@@ -0,0 +1,155 @@
+"""
+    A process-wide pool of open SSH connections, so that every client which logs into the same host as the same user
+    with the same credentials shares one connection instead of making its own handshake.
+"""
+import atexit
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Tuple, Callable, Optional, Iterator
+
+from fabric import Connection
+
+
+class _PooledConnection:
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.last_used = time.monotonic()
+        self.leases = 0
+        self.discarded = False
+
+
+class ConnectionPool:
+    """ Open connections by key, where the key identifies the user, endpoint and credentials the connection was made
+    with. Connections are leased out with acquire and handed back with release, and a connection is never closed
+    while it is leased.
+
+    A connection which has not been leased for idle_timeout seconds is closed, and when the pool holds more than
+    max_size connections the least recently used of those not leased are closed. If every connection is leased the
+    pool grows past max_size until enough are released. A connection whose transport has been dropped is replaced the
+    next time it is asked for. """
+
+    def __init__(self, max_size: int = 32, idle_timeout: float = 300):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[Tuple, _PooledConnection] = OrderedDict()
+        self._leased: Dict[int, _PooledConnection] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def acquire(self, key: Tuple, factory: Callable[[], Connection]) -> Connection:
+        """ Leases the pooled connection for the key, calling the factory to make one if there isn't a usable one. The
+        connection must be handed back with release. Connections are opened lazily by fabric when they are first
+        used. """
+        with self._lock:
+            connection = self._take(key)
+            if connection is not None:
+                return connection
+
+        # The factory may have to fetch and parse a private key, which shouldn't hold up other threads
+        made = factory()
+        with self._lock:
+            connection = self._take(key)
+            if connection is not None:
+                # Another thread made a connection for the same key in the meantime
+                return connection
+
+            self.misses += 1
+            entry = _PooledConnection(made)
+            self._entries[key] = entry
+            self._lease(entry)
+            self._trim()
+            return made
+
+    def release(self, connection: Connection):
+        with self._lock:
+            entry = self._leased.get(id(connection), None)
+            if entry is None:
+                return
+
+            entry.leases -= 1
+            entry.last_used = time.monotonic()
+            if entry.leases == 0:
+                del self._leased[id(connection)]
+                if entry.discarded:
+                    self._close(entry)
+                else:
+                    self._trim()
+
+    @contextmanager
+    def lease(self, key: Tuple, factory: Callable[[], Connection]) -> Iterator[Connection]:
+        connection = self.acquire(key, factory)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close_all(self):
+        """ Closes every connection, including leased ones, which is meant for when the process is exiting """
+        with self._lock:
+            for entry in list(self._entries.values()) + list(self._leased.values()):
+                self._close(entry)
+            self._entries.clear()
+            self._leased.clear()
+
+    def _take(self, key: Tuple) -> Optional[Connection]:
+        """ Leases the usable connection for a key if there is one, which must be done while holding the lock """
+        self._expire()
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return None
+
+        if entry.connection.transport is not None and not entry.connection.is_connected:
+            # The connection was opened at some point and has since been dropped
+            self._discard(key)
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        self._lease(entry)
+        return entry.connection
+
+    def _lease(self, entry: _PooledConnection):
+        entry.leases += 1
+        entry.last_used = time.monotonic()
+        self._leased[id(entry.connection)] = entry
+
+    def _discard(self, key: Tuple):
+        """ Removes a connection from the pool, closing it now if it isn't leased or otherwise once it is released """
+        entry = self._entries.pop(key)
+        if entry.leases:
+            entry.discarded = True
+        else:
+            self._close(entry)
+
+    def _trim(self):
+        unleased = [k for k, e in self._entries.items() if not e.leases]
+        for key in unleased[:max(0, len(self._entries) - self.max_size)]:
+            self._discard(key)
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        for key in [k for k, e in self._entries.items() if not e.leases and e.last_used < cutoff]:
+            self._discard(key)
+
+    @staticmethod
+    def _close(entry: _PooledConnection):
+        try:
+            entry.connection.close()
+        except Exception:
+            # A connection which fails to close cleanly is being discarded either way
+            pass
+
+
+_default_pool = ConnectionPool()
+atexit.register(_default_pool.close_all)
+
+
+def default_pool() -> ConnectionPool:
+    """ The pool shared by every SSH client in this process, whose connections are closed when the process exits """
+    return _default_pool
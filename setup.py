@@ -34,6 +34,10 @@ setuptools.setup(
         "dacite~=1.6.0",
         "ruamel.yaml~=0.17.21",
     ],
+    extras_require={
+        "msgpack": ["msgpack~=1.0.4"],
+        "zstd": ["zstandard~=0.19.0"],
+    },
     entry_points={
         "console_scripts": [
             f"{ENTRY_POINT}=quick_manage.cli.main:main",
@@ -0,0 +1,124 @@
+import hashlib
+import io
+from typing import Dict, List
+
+import pytest
+
+from quick_manage._common import IBuilder, EntityConfig, HostClient, ClientAction
+from quick_manage.file import FolderKeyStore
+from quick_manage.hosts import Host, HostConfig, HostCertConfig, DeployConfig, deploy_certs
+from quick_manage.impl_helpers import from_yaml
+from quick_manage.keys import CachingKeyGetter
+
+from tests.tools.file_mocks import TestFileSystemProvider
+
+
+class RecordingClient(HostClient):
+    def __init__(self, files: Dict[str, str], actions: List[str], fail: bool):
+        self.files = files
+        self.actions = actions
+        self.fail = fail
+
+    def put_data(self, destination: str, data: str):
+        if self.fail:
+            raise RuntimeError("Connection refused")
+        self.files[destination] = data
+
+    def file_hashes(self, paths: List[str]) -> Dict[str, str]:
+        return {p: hashlib.sha1(self.files[p].encode("utf-8")).hexdigest() for p in paths if p in self.files}
+
+    def action(self, command: str):
+        self.actions.append(command)
+
+
+class RecordingBuilder(IBuilder):
+    def __init__(self):
+        self.files: Dict[str, Dict[str, str]] = {}
+        self.actions: Dict[str, List[str]] = {}
+
+    def build(self, config: EntityConfig, **kwargs):
+        host = config.config["endpoint"]
+        return RecordingClient(self.files.setdefault(host, {}), self.actions.setdefault(host, []),
+                               host.startswith("bad"))
+
+
+def _host(name: str, builder: IBuilder, key_getter: CachingKeyGetter) -> Host:
+    deploy = DeployConfig("push", fullchain="/etc/cert.pem", private="/etc/key.pem",
+                          post=[ClientAction("push", ["systemctl reload nginx"])])
+    config = HostConfig(name, {}, [EntityConfig("push", "test", {"endpoint": name})],
+                        [HostCertConfig("wild", "store/web/wild", deploy)])
+    return Host(config, builder, key_getter)
+
+
+def test_deploy_certs_isolates_failures():
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=TestFileSystemProvider({}))
+    store.put_value("web/wild", "fullchain", "chain data")
+    store.put_value("web/wild", "private", "key data")
+    requests = []
+    get_values = store.get_values
+    store.get_values = lambda r: requests.append(r) or get_values(r)
+
+    builder = RecordingBuilder()
+    key_getter = CachingKeyGetter({"store": store})
+    hosts = [_host(n, builder, key_getter) for n in ["web01", "bad01", "web02"]]
+    results = deploy_certs([(h, h.config.certs) for h in hosts], key_getter, workers=2)
+
+    assert [(r.host, r.success) for r in results] == [("web01", True), ("bad01", False), ("web02", True)]
+    assert "Connection refused" in results[1].error
+    assert builder.files["web02"] == {"/etc/cert.pem": "chain data", "/etc/key.pem": "key data"}
+    assert builder.actions == {"web01": ["systemctl reload nginx"], "bad01": [], "web02": ["systemctl reload nginx"]}
+    # Both parts of the certificate are fetched in a single request
+    assert requests and all(len(r) == 2 for r in requests)
+    assert key_getter.cached_bytes == len("chain data") + len("key data")
+
+
+def test_deploy_cert_skips_unchanged_files():
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=TestFileSystemProvider({}))
+    store.put_value("web/wild", "fullchain", "chain data")
+    store.put_value("web/wild", "private", "key data")
+
+    builder = RecordingBuilder()
+    host = _host("web01", builder, CachingKeyGetter({"store": store}))
+    assert host.deploy_cert(host.config.certs[0])
+
+    # Nothing changed, so the post-deployment commands aren't run again
+    builder.files["web01"]["/etc/cert.pem"] = "old data"
+    assert host.deploy_cert(host.config.certs[0])
+    assert not host.deploy_cert(host.config.certs[0])
+    assert builder.files["web01"]["/etc/cert.pem"] == "chain data"
+    assert len(builder.actions["web01"]) == 2
+
+    assert host.deploy_cert(host.config.certs[0], force=True)
+    assert len(builder.actions["web01"]) == 3
+
+
+def test_host_config_reads_mode_as_octal_digits():
+    text = "host: web01\nnetwork: {}\nclients: []\ncerts:\n- name: wild\n  secret: store/web/wild\n  deploy:\n" \
+           "    client: push\n    mode: {}\n"
+    for mode in ["640", "'640'", "'0o640'"]:
+        config = from_yaml(HostConfig, io.StringIO(text.replace("mode: {}", f"mode: {mode}")))
+        assert config.certs[0].deploy.file_mode() == 0o640
+
+    with pytest.raises(ValueError):
+        DeployConfig("push", mode="rw-r-----").file_mode()
+    with pytest.raises(ValueError):
+        DeployConfig("push", mode=999).file_mode()
+
+
+def test_deploy_cert_streams_binary_parts():
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=TestFileSystemProvider({}))
+    store.put_stream("web/wild", "fullchain", io.BytesIO(b"\x30\x82\xff binary chain"))
+    store.put_value("web/wild", "private", "key data")
+    uploaded = {}
+
+    class StreamingClient(RecordingClient):
+        def put_stream(self, destination: str, stream):
+            uploaded[destination] = stream.read()
+
+    class StreamingBuilder(RecordingBuilder):
+        def build(self, config: EntityConfig, **kwargs):
+            return StreamingClient({}, [], False)
+
+    host = _host("web01", StreamingBuilder(), CachingKeyGetter({"store": store}))
+    assert host.deploy_cert(host.config.certs[0])
+    assert uploaded == {"/etc/cert.pem": b"\x30\x82\xff binary chain", "/etc/key.pem": b"key data"}
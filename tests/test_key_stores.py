@@ -1,7 +1,10 @@
+import hashlib
+import io
+import os
 import pytest
-from quick_manage.keys import Secret, IKeyStore
+from quick_manage.keys import Secret, IKeyStore, KeyGetter, CachingKeyGetter, copy_secrets, sync_stores
 from quick_manage.file import FolderKeyStore
-from quick_manage.impl_helpers import sha1_digest
+from quick_manage.impl_helpers import sha1_digest, KeyStoreIndex, get_codec, detect_format, decode_index
 
 from tests.tools.file_mocks import TestFileSystemProvider
 
@@ -94,3 +97,562 @@ def test_folder_store_no_delete_on_identical_secret():
     assert store.get_value("secret1", None) == payload
     with pytest.raises(KeyError):
         store.get_value("secret0", None)
+
+
+def test_index_lookup_and_remove():
+    index = KeyStoreIndex()
+    index.create_secret("bb/two")
+    index.create_secret("aa/one")
+    assert index.find_secret("aa/one").name == "aa/one"
+    assert "bb/two" in index
+
+    with pytest.raises(KeyError):
+        index.create_secret("aa/one")
+
+    index.remove_secret("aa/one")
+    assert index.find_secret("aa/one") is None
+    assert len(index) == 1
+
+
+def test_index_prefix_query():
+    index = KeyStoreIndex()
+    for name in ["web/zz", "db/bb", "web/aa", "webserver", "db/aa"]:
+        index.create_secret(name)
+
+    assert list(index.names_with_prefix("web/")) == ["web/aa", "web/zz"]
+    assert list(index.names_with_prefix("db")) == ["db/aa", "db/bb"]
+    assert list(index.names_with_prefix("nothing")) == []
+    assert len(list(index.with_prefix(None))) == 5
+
+
+def test_index_dict_round_trip():
+    index = KeyStoreIndex()
+    index.set_key("secret0", None, sha1_digest("value"))
+    index.set_meta("secret0", {"type": "test"})
+    index.create_secret("secret1")
+
+    data = index.to_dict()
+    assert data == {"secrets": [{"name": "secret0", "meta_data": {"type": "test"},
+                                 "keys": {"default": sha1_digest("value")}},
+                                {"name": "secret1"}]}
+    loaded = KeyStoreIndex.from_dict(data)
+    assert loaded.find_secret("secret0") == Secret("secret0", {"type": "test"}, {"default": sha1_digest("value")})
+    assert KeyStoreIndex.from_dict(data, trusted=False).to_dict() == data
+
+    with pytest.raises(ValueError):
+        KeyStoreIndex.from_dict({"secrets": [{"name": "-invalid"}]}, trusted=False)
+
+
+def test_folder_store_reuses_cached_index():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    store.put_value("secret0", None, "this is test data")
+    misses = store.index_cache.misses
+
+    for _ in range(3):
+        assert store.get_value("secret0", None) == "this is test data"
+    assert store.has_secret("secret0")
+
+    assert store.index_cache.misses == misses
+    assert store.index_cache.hits >= 4
+
+
+def test_folder_store_cache_sees_other_writers():
+    mock_fs = TestFileSystemProvider({})
+    store0 = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    store1 = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    store0.put_value("secret0", None, "this is test data")
+    assert store1.all().keys() == {"secret0"}
+
+    store0.put_value("secret1", None, "this is other test data")
+    assert store1.all().keys() == {"secret0", "secret1"}
+
+
+def test_folder_store_batch_writes_index_once():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    before = mock_fs._writes
+
+    with store.batch() as batch:
+        for key in ["fullchain", "chain", "private", "cert"]:
+            batch.put("cert0", key, f"{key} data")
+        batch.set_meta("cert0", {"type": "certificate"})
+
+    # Four content files and a single index
+    assert mock_fs._writes - before == 5
+    assert store.get_meta("cert0").get_type_name() == "certificate"
+    assert store.get_value("cert0", "chain") == "chain data"
+
+
+def test_folder_store_batch_rm_deletes_unused_content():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    store.put_value("secret0", "test0", "shared data")
+    store.put_value("secret0", "test1", "unique data")
+    store.put_value("secret1", None, "shared data")
+
+    with store.batch() as batch:
+        batch.rm("secret0", "test0")
+        batch.rm("secret0", "test1")
+
+    assert not store.has_secret("secret0")
+    assert not mock_fs.exists(f"/test/{sha1_digest('unique data')}")
+    assert store.get_value("secret1", None) == "shared data"
+
+
+def test_folder_store_failed_batch_changes_nothing():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    store.put_value("secret0", None, "this is test data")
+
+    with pytest.raises(KeyError):
+        with store.batch() as batch:
+            batch.put("secret1", None, "this is other data")
+            batch.rm("missing", None)
+
+    assert store.all().keys() == {"secret0"}
+
+
+def test_folder_store_failed_content_write_keeps_index_clean():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    store.put_value("aa", None, "aa data")
+
+    write_file = mock_fs.write_file
+    def fail(*args, **kwargs):
+        raise IOError("No space left on device")
+
+    mock_fs.write_file = fail
+    with pytest.raises(IOError):
+        store.put_value("bb", None, "bb data")
+    mock_fs.write_file = write_file
+    store.put_value("cc", None, "cc data")
+
+    assert FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs).all().keys() == {"aa", "cc"}
+
+
+def test_folder_store_leaves_existing_content_alone():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    store.put_value("aa", None, "shared data")
+    blob = mock_fs.internal[f"/test/{sha1_digest('shared data')}"]
+    modified = blob["modified"]
+
+    # Content which is already stored is never rewritten, since readers of other keys may be reading it
+    store.put_value("bb", None, "shared data")
+    store.put_value("aa", None, "shared data")
+
+    assert blob["modified"] == modified
+    assert store.get_value("bb", None) == "shared data"
+    assert not any(".incoming-" in path for path in mock_fs.internal)
+
+
+def test_key_getter_get_many():
+    store0 = FolderKeyStore(FolderKeyStore.Config("/test0"), file_system=TestFileSystemProvider({}))
+    store1 = FolderKeyStore(FolderKeyStore.Config("/test1"), file_system=TestFileSystemProvider({}))
+    store0.put_value("secret0", "test0", "value0")
+    store0.put_value("secret0", "test1", "value1")
+    store1.put_value("secret1", None, "value2")
+
+    getter = KeyGetter({"store0": store0, "store1": store1})
+    values = getter.get_many(["store0/secret0@test1", "store1/secret1", "store0/secret0@test0"])
+    assert values == {"store0/secret0@test1": "value1", "store1/secret1": "value2", "store0/secret0@test0": "value0"}
+
+    with pytest.raises(KeyError):
+        getter.get_many(["store2/secret0"])
+
+
+def test_index_reference_counts():
+    shared, unique = sha1_digest("shared"), sha1_digest("unique")
+    index = KeyStoreIndex.from_dict({"secrets": [{"name": "secret0", "keys": {"test0": shared, "test1": unique}},
+                                                 {"name": "secret1", "keys": {"default": shared}}]})
+    assert index.ref_count(shared) == 2
+    assert index.ref_count(unique) == 1
+
+    assert index.set_key("secret0", "test1", shared) == unique
+    assert index.ref_count(unique) == 0
+    assert index.ref_count(shared) == 3
+
+    index.remove_key("secret1", None)
+    index.remove_secret("secret0")
+    assert index.ref_count(shared) == 0
+    assert len(index) == 0
+
+
+def test_folder_store_overwrite_deletes_unused_content():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    store.put_value("secret0", None, "first value")
+    store.put_value("secret0", None, "second value")
+
+    assert not mock_fs.exists(f"/test/{sha1_digest('first value')}")
+    assert store.get_value("secret0", None) == "second value"
+
+
+def test_folder_store_journal_appends_and_replays():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test", journal=True), file_system=mock_fs)
+    store.put_value("secret0", None, "this is test data")
+    store.put_value("secret1", "test0", "this is other test data")
+    store.set_meta("secret1", {"type": "test"})
+    store.rm("secret0", None)
+
+    assert "/test/index.yaml" not in mock_fs.internal
+    assert len(mock_fs.internal["/test/index.log"]["content"].splitlines()) == 4
+
+    new_store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    assert new_store.all().keys() == {"secret1"}
+    assert new_store.get_meta("secret1").get_type_name() == "test"
+    assert new_store.get_value("secret1", "test0") == "this is other test data"
+
+
+def test_folder_store_journal_compacts():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test", journal=True, compact_after=3), file_system=mock_fs)
+    for i in range(3):
+        store.put_value(f"secret{i}", None, f"value {i}")
+
+    assert not mock_fs.exists("/test/index.log")
+    new_store = FolderKeyStore(FolderKeyStore.Config("/test", journal=True), file_system=mock_fs)
+    assert new_store.all().keys() == {"secret0", "secret1", "secret2"}
+
+
+def test_folder_store_journal_ignores_torn_record():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test", journal=True), file_system=mock_fs)
+    store.put_value("secret0", None, "this is test data")
+    mock_fs.internal["/test/index.log"]["content"] += '{"op": "put", "secret": "sec'
+
+    new_store = FolderKeyStore(FolderKeyStore.Config("/test", journal=True), file_system=mock_fs)
+    assert new_store.all().keys() == {"secret0"}
+
+    new_store.put_value("secret1", None, "this is other test data")
+    assert FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs).all().keys() == {"secret0", "secret1"}
+
+
+def test_folder_store_sharded_layout():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test", shard_depth=2), file_system=mock_fs)
+    store.put_value("secret0", None, "this is test data")
+
+    sha = sha1_digest("this is test data")
+    assert mock_fs.exists(f"/test/{sha[:2]}/{sha[2:4]}/{sha}")
+    assert store.get_value("secret0", None) == "this is test data"
+
+
+def test_folder_store_migrates_to_sharded_layout():
+    mock_fs = TestFileSystemProvider({})
+    flat = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    flat.put_value("secret0", None, "this is test data")
+    flat.put_value("secret1", None, "this is other test data")
+
+    sha0, sha1 = sha1_digest("this is test data"), sha1_digest("this is other test data")
+    mock_fs.move_file(f"/test/{sha0}", f"/test/{sha0[:2]}/{sha0}")
+
+    # Both layouts are readable part way through the migration
+    sharded = FolderKeyStore(FolderKeyStore.Config("/test", shard_depth=1), file_system=mock_fs)
+    assert sharded.get_values([("secret0", None), ("secret1", None)]) == ["this is test data",
+                                                                          "this is other test data"]
+
+    sharded.migrate()
+    assert mock_fs.exists(f"/test/{sha1[:2]}/{sha1}")
+    assert not mock_fs.exists(f"/test/{sha1}")
+
+    sharded.rm("secret1", None)
+    assert not mock_fs.exists(f"/test/{sha1[:2]}/{sha1}")
+
+
+def test_folder_store_concurrent_writers(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def _write(worker: int):
+        store = FolderKeyStore(FolderKeyStore.Config(str(tmp_path)))
+        for i in range(10):
+            store.put_value(f"worker{worker}/secret{i}", None, f"data {worker} {i}")
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(_write, range(4)))
+
+    store = FolderKeyStore(FolderKeyStore.Config(str(tmp_path)))
+    assert len(store.all()) == 40
+    assert store.get_value("worker3/secret9", None) == "data 3 9"
+    assert not [x for x in os.listdir(tmp_path) if x.endswith(".tmp")]
+
+
+def test_folder_store_streams_binary_values():
+    payload = bytes(range(256)) * 1000
+
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test", shard_depth=1), file_system=mock_fs)
+    store.put_stream("secret0", "store.pfx", io.BytesIO(payload))
+
+    sha = hashlib.sha1(payload).hexdigest()
+    assert store.get_meta("secret0").keys == {"store.pfx": sha}
+    with store.open_value("secret0", "store.pfx") as handle:
+        assert handle.read() == payload
+    assert not [p for p in mock_fs.internal if ".incoming-" in p]
+
+
+def test_folder_store_stream_matches_text_hash():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    store.put_value("secret0", None, "this is test data")
+    store.put_stream("secret1", None, io.BytesIO(b"this is test data and more"), length=17)
+
+    assert store.get_meta("secret0").keys == store.get_meta("secret1").keys
+    assert store.get_value("secret1", None) == "this is test data"
+
+    with pytest.raises(ValueError):
+        store.put_stream("secret2", None, io.BytesIO(b"short"), length=17)
+    assert not store.has_secret("secret2")
+
+
+def test_copy_secrets_skips_content_already_present():
+    source = FolderKeyStore(FolderKeyStore.Config("/source"), file_system=TestFileSystemProvider({}))
+    source.put_value("ab/secret0", "test0", "this is test data")
+    source.put_value("ab/secret0", "test1", "this is other test data")
+    source.set_meta("ab/secret0", {"type": "example"})
+    source.put_value("ab/secret1", None, "this is test data")
+
+    dest_fs = TestFileSystemProvider({})
+    destination = FolderKeyStore(FolderKeyStore.Config("/dest"), file_system=dest_fs)
+    destination.put_value("other", None, "this is other test data")
+    writes = dest_fs._writes
+
+    stats = copy_secrets(source, destination, [("ab/secret0", "cd/secret0"), ("ab/secret1", "cd/secret1")])
+
+    assert (stats.sent, stats.skipped) == (1, 1)
+    assert stats.bytes_sent == len("this is test data")
+    assert destination.get_meta("cd/secret0").get_type_name() == "example"
+    assert destination.get_values([("cd/secret0", "test1"), ("cd/secret1", None)]) == ["this is other test data",
+                                                                                       "this is test data"]
+    # One content file and one index write
+    assert dest_fs._writes == writes + 2
+
+
+class _ValueOnlyStore(IKeyStore):
+    """ A store written against the original interface, implementing only the value and metadata methods """
+
+    def __init__(self):
+        self.secrets = {}
+
+    def put_value(self, secret_name: str, key_name, value: str):
+        self.secrets.setdefault(secret_name, Secret(secret_name, {}, {})).keys[key_name or "default"] = value
+
+    def rm(self, secret_name: str, key_name):
+        secret = self.secrets[secret_name]
+        del secret.keys[key_name or "default"]
+        if not secret.keys:
+            del self.secrets[secret_name]
+
+    def get_value(self, secret_name: str, key_name) -> str:
+        return self.secrets[secret_name].keys[key_name or "default"]
+
+    def get_meta(self, secret_name: str) -> Secret:
+        secret = self.secrets[secret_name]
+        return Secret(secret.name, secret.meta_data, {k: sha1_digest(v) for k, v in secret.keys.items()})
+
+    def set_meta(self, secret_name: str, value):
+        self.secrets[secret_name].meta_data = value
+
+    def all(self):
+        return {n: self.get_meta(n) for n in self.secrets}
+
+
+def test_copy_and_sync_with_stores_implementing_only_values():
+    source = FolderKeyStore(FolderKeyStore.Config("/source"), file_system=TestFileSystemProvider({}))
+    source.put_value("ab/secret0", "test0", "this is test data")
+    source.set_meta("ab/secret0", {"type": "example"})
+    plain = _ValueOnlyStore()
+
+    stats = copy_secrets(source, plain, [("ab/secret0", "cd/secret0")])
+    assert (stats.sent, stats.bytes_sent) == (1, len("this is test data"))
+    assert plain.get_value("cd/secret0", "test0") == "this is test data"
+    assert plain.get_meta("cd/secret0").get_type_name() == "example"
+
+    plain.put_value("cd/secret1", None, "this is other test data")
+    destination = FolderKeyStore(FolderKeyStore.Config("/dest"), file_system=TestFileSystemProvider({}))
+    result = sync_stores(plain, destination)
+    assert (result.created, result.transfer.sent) == (2, 2)
+    assert destination.get_value("cd/secret1", None) == "this is other test data"
+
+
+def test_sync_stores_transfers_only_changes():
+    source = FolderKeyStore(FolderKeyStore.Config("/source"), file_system=TestFileSystemProvider({}))
+    source.put_value("ab/secret0", "test0", "this is test data")
+    source.put_value("ab/secret1", "test0", "this is other test data")
+    source.put_value("cd/secret0", "test0", "this is unrelated data")
+
+    dest_fs = TestFileSystemProvider({})
+    destination = FolderKeyStore(FolderKeyStore.Config("/dest"), file_system=dest_fs)
+    destination.put_value("ab/secret0", "test0", "this is test data")
+    destination.put_value("ab/secret1", "test1", "this is stale data")
+    destination.put_value("ab/secret2", "test0", "this is removed data")
+
+    result = sync_stores(source, destination, prefix="ab/", delete=True)
+
+    assert (result.created, result.updated, result.removed, result.unchanged) == (0, 1, 1, 1)
+    assert result.transfer.sent == 1
+    assert destination.all().keys() == {"ab/secret0", "ab/secret1"}
+    assert destination.get_meta("ab/secret1").get_keys().keys() == {"test0"}
+    assert not dest_fs.exists(f"/dest/{sha1_digest('this is stale data')}")
+
+    again = sync_stores(source, destination, prefix="ab/", delete=True)
+    assert (again.unchanged, again.transfer.sent) == (2, 0)
+
+
+def test_sync_stores_resumes_after_interruption():
+    source = FolderKeyStore(FolderKeyStore.Config("/source"), file_system=TestFileSystemProvider({}))
+    for i in range(4):
+        source.put_value(f"secret{i}", None, f"this is test data {i}")
+
+    class _Failing(FolderKeyStore):
+        def apply(self, operations):
+            raise RuntimeError("Interrupted")
+
+    dest_fs = TestFileSystemProvider({})
+    with pytest.raises(RuntimeError):
+        sync_stores(source, _Failing(FolderKeyStore.Config("/dest"), file_system=dest_fs))
+
+    destination = FolderKeyStore(FolderKeyStore.Config("/dest"), file_system=dest_fs)
+    assert destination.all() == {}
+    result = sync_stores(source, destination)
+    assert (result.created, result.transfer.sent, result.transfer.skipped) == (4, 0, 4)
+    assert destination.get_value("secret3", None) == "this is test data 3"
+
+
+def test_folder_store_iter_secrets():
+    mock_fs = TestFileSystemProvider({})
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    with store.batch() as batch:
+        for name in ["cd/one", "ab/two", "abc/one", "ab/one"]:
+            batch.put(name, "kk", f"value of {name}")
+        batch.set_meta("ab/two", {"type": "certificate"})
+
+    assert [s.name for s in store.iter_secrets()] == ["ab/one", "ab/two", "abc/one", "cd/one"]
+    assert [s.name for s in store.iter_secrets("ab/")] == ["ab/one", "ab/two"]
+    assert [s.name for s in store.iter_secrets("ab", type="certificate")] == ["ab/two"]
+    assert store.has_secret("abc/one") and not store.has_secret("abc")
+
+
+def test_index_hands_out_copies_of_secrets():
+    meta = {"type": "certificate"}
+    index = KeyStoreIndex()
+    index.set_key("secret0", "test0", sha1_digest("value"))
+    index.set_key("secret1", "test0", sha1_digest("other"))
+    index.set_meta("secret0", meta)
+    index.set_meta("secret1", {"type": "certificate"})
+
+    secret = index.find_secret("secret0")
+    secret.keys["test0"] = sha1_digest("changed")
+    secret.meta_data["type"] = "changed"
+    meta["type"] = "changed"
+
+    assert index.find_key("secret0", "test0") == sha1_digest("value")
+    assert index.find_secret("secret1").get_type_name() == "certificate"
+    assert index.find_secret("secret0").get_type_name() == "certificate"
+
+
+@pytest.mark.parametrize("name", ["yaml", "json", "json+gzip"])
+def test_index_formats_round_trip(name):
+    data = {"secrets": [{"name": "web/cert0", "meta_data": {"type": "certificate"}, "keys": {"cert": "abc"}}]}
+    raw = get_codec(name).encode(data)
+
+    assert detect_format(raw) == name
+    assert decode_index(raw) == (data, name)
+
+
+def test_unknown_index_format_is_rejected():
+    with pytest.raises(ValueError):
+        get_codec("json+lz4")
+    with pytest.raises(ValueError):
+        FolderKeyStore(FolderKeyStore.Config("/test", index_format="xml"), file_system=TestFileSystemProvider({}))
+
+
+def test_folder_store_converts_index_format():
+    mock_fs = TestFileSystemProvider({})
+    FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs).put_value("secret0", None, "this is test data")
+
+    # A store configured for another format still reads the old index, and rewrites it when migrated
+    store = FolderKeyStore(FolderKeyStore.Config("/test", index_format="json+gzip"), file_system=mock_fs)
+    assert store.get_value("secret0", None) == "this is test data"
+    with mock_fs.read_binary("/test/index.yaml") as handle:
+        assert detect_format(handle.read()) == "yaml"
+
+    messages = []
+    store.migrate(message=messages.append)
+    with mock_fs.read_binary("/test/index.yaml") as handle:
+        assert detect_format(handle.read()) == "json+gzip"
+    assert "Converted the index from yaml to json+gzip" in messages
+
+    yaml_store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=mock_fs)
+    assert yaml_store.get_value("secret0", None) == "this is test data"
+
+
+def test_caching_key_getter_fetches_each_value_once():
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=TestFileSystemProvider({}))
+    store.put_value("secret0", "test0", "value0")
+    store.put_value("secret0", "test1", "value1")
+    store.put_value("secret1", None, "value2")
+
+    requests = []
+    get_values = store.get_values
+    store.get_values = lambda r: requests.append(r) or get_values(r)
+
+    getter = CachingKeyGetter({"store": store})
+    getter.prefetch(["store/secret0@test0", "store/secret0@test1"])
+    assert len(requests) == 1
+
+    assert getter.get("store/secret0@test0") == "value0"
+    with getter.open("store/secret0@test1") as stream:
+        assert stream.read() == b"value1"
+    assert getter.get_many(["store/secret0@test0", "store/secret1"]) == {"store/secret0@test0": "value0",
+                                                                         "store/secret1": "value2"}
+    assert requests[1:] == [[("secret1", None)]]
+    assert (getter.hits, getter.misses) == (3, 1)
+
+
+def test_caching_key_getter_keeps_within_byte_cap():
+    store = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=TestFileSystemProvider({}))
+    for i in range(3):
+        store.put_value(f"secret{i}", None, f"value{i}")
+
+    getter = CachingKeyGetter({"store": store}, max_bytes=12)
+    for i in range(3):
+        getter.get(f"store/secret{i}")
+    assert getter.cached_bytes == 12
+    assert getter.evictions == 1
+
+    getter.get("store/secret0")
+    assert getter.misses == 4
+
+
+def test_index_keeps_metadata_of_equal_values_with_different_types_apart():
+    index = KeyStoreIndex()
+    index.set_key("secret1", "key", sha1_digest("one"))
+    index.set_key("secret2", "key", sha1_digest("two"))
+    index.set_meta("secret1", {"flag": 1})
+    index.set_meta("secret2", {"flag": True})
+
+    assert index.find_secret("secret2").meta_data["flag"] is True
+
+
+def test_index_dict_holds_copies_of_shared_metadata():
+    index = KeyStoreIndex()
+    for name in ["secret1", "secret2"]:
+        index.set_key(name, "key", sha1_digest(name))
+        index.set_meta(name, {"type": "certificate"})
+
+    index.to_dict()["secrets"][0]["meta_data"]["type"] = "ssh-key"
+    assert [s.meta_data["type"] for s in index.secrets] == ["certificate", "certificate"]
+
+
+def test_index_copies_of_shared_metadata_include_nested_values():
+    index = KeyStoreIndex()
+    for name in ["secret1", "secret2"]:
+        index.set_key(name, "key", sha1_digest(name))
+        index.set_meta(name, {"tags": ["a"]})
+
+    index.find_secret("secret1").meta_data["tags"].append("x")
+    index.to_dict()["secrets"][0]["meta_data"]["tags"].append("y")
+    assert [s.meta_data["tags"] for s in index.secrets] == [["a"], ["a"]]
@@ -0,0 +1,311 @@
+import hashlib
+import io
+import os
+import pytest
+from minio import S3Error
+from quick_manage.impl_helpers import BlobCache, detect_format
+from quick_manage.keys import copy_secrets
+from quick_manage.s3 import S3Config, S3Store
+
+from tests.tools.s3_mocks import TestMinio
+
+
+def _store(client: TestMinio, **kwargs) -> S3Store:
+    config = S3Config("localhost:9000", "bucket", "access", "secret", **kwargs)
+    config.make_client = lambda: client
+    return S3Store(config)
+
+
+def test_s3_store_create():
+    client = TestMinio()
+    store = _store(client)
+    store.put_value("secret0", None, "this is test data")
+
+    assert store.get_value("secret0", None) == "this is test data"
+
+
+def test_s3_store_persists():
+    client = TestMinio()
+    _store(client).put_value("secret0", "test0", "this is test data")
+
+    assert _store(client).get_value("secret0", "test0") == "this is test data"
+
+
+def test_s3_store_delete_one_removes_secret():
+    client = TestMinio()
+    store = _store(client)
+    store.put_value("secret0", "test", "this is test data")
+    store.rm("secret0", "test")
+
+    with pytest.raises(KeyError):
+        store.get_value("secret0", "test")
+    assert list(client.objects.keys()) == ["index.json"]
+
+
+def test_s3_store_streams_binary_values():
+    payload = bytes(range(256)) * 100
+    client = TestMinio()
+    store = _store(client)
+    store.put_stream("secret0", "store.pfx", io.BytesIO(payload), length=len(payload))
+
+    with _store(client).open_value("secret0", "store.pfx") as handle:
+        assert handle.read() == payload
+    assert hashlib.sha1(payload).hexdigest() in client.objects
+
+
+def test_s3_store_revalidates_cached_index():
+    client = TestMinio()
+    store = _store(client)
+    store.put_value("secret0", None, "this is test data")
+
+    for _ in range(3):
+        assert store.all().keys() == {"secret0"}
+    assert store.index_caches["index.json"].hits == 3
+
+    _store(client).put_value("secret1", None, "this is other test data")
+    assert store.all().keys() == {"secret0", "secret1"}
+
+
+def test_s3_store_freshness_window_skips_requests():
+    client = TestMinio()
+    store = _store(client, index_max_age=60)
+    store.put_value("secret0", None, "this is test data")
+
+    before = client.calls.get("get_object", 0)
+    for _ in range(3):
+        assert store.has_secret("secret0")
+    assert client.calls.get("get_object", 0) == before
+
+
+def test_s3_store_reuses_one_client():
+    client = TestMinio()
+    config = S3Config("localhost:9000", "bucket", "access", "secret")
+    created = []
+    config.make_client = lambda: created.append(client) or client
+    store = S3Store(config)
+
+    store.put_value("secret0", None, "this is test data")
+    store.get_value("secret0", None)
+    store.rm("secret0", None)
+    assert len(created) == 1
+
+
+def test_s3_store_get_values():
+    client = TestMinio()
+    store = _store(client)
+    with store.batch() as batch:
+        batch.put("cert0", "fullchain", "fullchain data")
+        batch.put("cert0", "private", "private data")
+        batch.put("cert1", "private", "private data")
+
+    before = client.calls["get_object"]
+    values = store.get_values([("cert0", "private"), ("cert0", "fullchain"), ("cert1", "private")])
+    assert values == ["private data", "fullchain data", "private data"]
+
+    # One index revalidation and one request per distinct content object
+    assert client.calls["get_object"] - before == 3
+
+
+def test_s3_store_partitioned_index():
+    client = TestMinio()
+    store = _store(client)
+    for name in ["web/cert0", "web/cert1", "db/password", "ssh/admin"]:
+        store.put_value(name, None, f"{name} data")
+
+    partitioned = _store(client, index_shards=4)
+    partitioned.migrate()
+    assert "index.json" not in client.objects
+    assert "index/manifest.json" in client.objects
+    assert partitioned.all().keys() == {"web/cert0", "web/cert1", "db/password", "ssh/admin"}
+
+    # A lookup or write only touches the shard holding the secret
+    reader = _store(client, index_shards=4)
+    reader.get_value("web/cert0", None)
+    assert len(reader.index_caches) == 1
+    reader.put_value("web/cert2", None, "web/cert2 data")
+    assert len(reader.index_caches) == 1
+
+    assert _store(client).get_value("web/cert2", None) == "web/cert2 data"
+
+
+def test_s3_store_partitioned_rm_keeps_shared_content():
+    client = TestMinio()
+    _store(client, index_shards=8).migrate()
+    store = _store(client, index_shards=8)
+    store.put_value("web/cert0", None, "shared data")
+    store.put_value("db/password", None, "shared data")
+    assert len(store.index_caches) == 2
+
+    store.rm("web/cert0", None)
+    assert store.get_value("db/password", None) == "shared data"
+
+
+def test_s3_store_rm_keeps_content_linked_by_another_writer():
+    client = TestMinio()
+    _store(client, index_shards=8).migrate()
+    store0 = _store(client, index_shards=8, index_max_age=60)
+    store0.put_value("web/cert0", None, "shared data")
+    store0.put_value("db/user", None, "other data")
+
+    # The second writer links the content into a shard the first is holding a cached copy of
+    _store(client, index_shards=8).put_value("db/password", None, "shared data")
+    store0.rm("web/cert0", None)
+
+    assert _store(client, index_shards=8).get_value("db/password", None) == "shared data"
+
+
+def test_s3_store_migrates_back_to_single_index():
+    client = TestMinio()
+    store = _store(client, index_shards=4)
+    store.migrate()
+    store.put_value("web/cert0", None, "this is test data")
+
+    _store(client).migrate()
+    assert sorted(client.objects.keys())[-1] == "index.json"
+    assert not any(k.startswith("index/") for k in client.objects)
+    assert _store(client).get_value("web/cert0", None) == "this is test data"
+
+
+def test_s3_store_concurrent_writers_merge():
+    client = TestMinio()
+    store0 = _store(client, index_max_age=60, retry_backoff=0)
+    store1 = _store(client)
+    store0.put_value("secret0", None, "this is test data")
+
+    # The second writer changes the index while the first is still holding its cached copy
+    store1.put_value("secret1", None, "this is other test data")
+    store0.put_value("secret2", None, "this is more test data")
+
+    assert store0.write_stats.conflicts == 1
+    assert store0.write_stats.retries == 1
+    assert _store(client).all().keys() == {"secret0", "secret1", "secret2"}
+
+
+def test_s3_store_failed_content_upload_keeps_index_clean():
+    client = TestMinio()
+    store = _store(client, index_max_age=60)
+    store.put_value("aa", None, "aa data")
+
+    put_object = client.put_object
+    def fail(*args, **kwargs):
+        raise IOError("Connection reset")
+
+    client.put_object = fail
+    with pytest.raises(IOError):
+        store.put_value("bb", None, "bb data")
+    client.put_object = put_object
+    store.put_value("cc", None, "cc data")
+
+    assert _store(client).all().keys() == {"aa", "cc"}
+
+
+def test_s3_store_gives_up_after_retries():
+    client = TestMinio()
+    store = _store(client, write_retries=2, retry_backoff=0)
+    store.put_value("secret0", None, "this is test data")
+
+    def always_conflict(*args, **kwargs):
+        raise S3Error("PreconditionFailed", "Conflict", "index.json", None, None, None)
+
+    client._put_object = always_conflict
+    with pytest.raises(RuntimeError):
+        store.put_value("secret1", None, "this is other test data")
+    assert store.write_stats.conflicts == 3
+
+
+def test_s3_store_serves_content_from_blob_cache(tmp_path):
+    client = TestMinio()
+    _store(client).put_value("secret0", None, "this is test data")
+    _store(client, cache_path=str(tmp_path / "blobs")).get_value("secret0", None)
+
+    before = client.calls["get_object"]
+    store = _store(client, cache_path=str(tmp_path / "blobs"), index_max_age=60)
+    assert store.get_value("secret0", None) == "this is test data"
+    with store.open_value("secret0", None) as handle:
+        assert handle.read() == b"this is test data"
+
+    # Only the manifest and the index are fetched from the bucket
+    assert client.calls["get_object"] == before + 2
+    assert store.blob_cache.hits == 2
+    assert oct(os.stat(tmp_path / "blobs").st_mode & 0o777) == oct(0o700)
+
+
+def test_blob_cache_evicts_least_recently_used(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=482)
+    blobs = {f"value {i} ".encode("utf-8") * 20: None for i in range(3)}
+    hashes = [hashlib.sha1(b).hexdigest() for b in blobs]
+    for i, (data, sha) in enumerate(zip(blobs, hashes)):
+        cache.put(sha, data)
+        os.utime(tmp_path / sha[:2] / sha, (i, i))
+
+    # Reading the oldest blob makes it the most recently used
+    assert cache.get(hashes[0]) is not None
+    cache.put(hashlib.sha1(b"extra").hexdigest(), b"extra")
+
+    assert cache.get(hashes[1]) is None
+    assert cache.get(hashes[0]) is not None
+    assert cache.get(hashes[2]) is not None
+    assert oct(os.stat(tmp_path / hashes[0][:2] / hashes[0]).st_mode & 0o777) == oct(0o600)
+
+
+def test_blob_cache_keeps_running_total(tmp_path):
+    BlobCache(str(tmp_path), max_bytes=100).put(hashlib.sha1(b"first").hexdigest(), b"first")
+    cache = BlobCache(str(tmp_path), max_bytes=100)
+    scans = []
+    scan = cache._scan
+    cache._scan = lambda: scans.append(1) or scan()
+
+    # The folder is scanned once to find the existing blobs, and only again when the cache is over its size
+    for data in [b"second", b"third", b"third"]:
+        cache.put(hashlib.sha1(data).hexdigest(), data)
+    assert cache.cached_bytes == len(b"firstsecondthird")
+    assert len(scans) == 1
+
+    cache.put(hashlib.sha1(b"x" * 90).hexdigest(), b"x" * 90)
+    assert len(scans) == 2
+    assert cache.cached_bytes <= 100
+
+
+def test_s3_store_copies_content_on_the_server():
+    client = TestMinio()
+    source, destination = _store(client, prefix="source"), _store(client, prefix="dest")
+    source.put_value("secret0", "test0", "this is test data")
+    source.put_value("secret0", "test1", "this is other test data")
+
+    stats = copy_secrets(source, destination, [("secret0", "secret1")])
+
+    assert (stats.server_copies, stats.sent) == (2, 0)
+    assert client.calls["copy_object"] == 2
+    assert destination.get_value("secret1", "test1") == "this is other test data"
+    assert copy_secrets(source, destination, [("secret0", "secret2")]).skipped == 2
+
+
+def test_s3_store_iter_secrets_reads_one_shard_for_a_full_segment():
+    client = TestMinio()
+    store = _store(client, index_shards=8)
+    store.migrate()
+    with store.batch() as batch:
+        for name in ["cd/one", "ab/two", "ef/one", "ab/one", "gh/one"]:
+            batch.put(name, "kk", f"value of {name}")
+
+    store = _store(client)
+    assert [s.name for s in store.iter_secrets()] == ["ab/one", "ab/two", "cd/one", "ef/one", "gh/one"]
+
+    store = _store(client)
+    assert [s.name for s in store.iter_secrets("ab/")] == ["ab/one", "ab/two"]
+    assert len(store.index_caches) == 1
+
+
+def test_s3_store_converts_index_format():
+    client = TestMinio()
+    _store(client).put_value("web/cert0", None, "this is test data")
+    assert detect_format(client.objects["index.json"]) == "json"
+
+    store = _store(client, index_format="json+gzip")
+    assert store.get_value("web/cert0", None) == "this is test data"
+    store.migrate()
+    assert detect_format(client.objects["index.json"]) == "json+gzip"
+
+    store.put_value("web/cert1", None, "this is other test data")
+    assert _store(client).get_values([("web/cert0", None), ("web/cert1", None)]) == ["this is test data",
+                                                                                     "this is other test data"]
@@ -0,0 +1,112 @@
+import io
+import sqlite3
+
+import pytest
+from quick_manage.file import FolderKeyStore
+from quick_manage.impl_helpers import sha1_digest
+from quick_manage.keys import copy_secrets
+from quick_manage.sqlite import SqliteKeyStore
+
+from tests.tools.file_mocks import TestFileSystemProvider
+
+
+def _store(tmp_path) -> SqliteKeyStore:
+    return SqliteKeyStore(SqliteKeyStore.Config(str(tmp_path / "keys.db")))
+
+
+def _blob_refs(tmp_path):
+    with sqlite3.connect(str(tmp_path / "keys.db")) as conn:
+        return dict(conn.execute("SELECT sha, refs FROM blobs").fetchall())
+
+
+def test_sqlite_store_create(tmp_path):
+    store = _store(tmp_path)
+    store.put_value("secret0", None, "this is test data")
+
+    assert _store(tmp_path).get_value("secret0", None) == "this is test data"
+    assert store.get_meta("secret0").keys == {"default": sha1_digest("this is test data")}
+
+
+def test_sqlite_store_rm_last_key_removes_secret_and_content(tmp_path):
+    store = _store(tmp_path)
+    store.put_value("secret0", "test0", "this is test data")
+    store.rm("secret0", "test0")
+
+    assert not store.has_secret("secret0")
+    assert _blob_refs(tmp_path) == {}
+    with pytest.raises(KeyError):
+        store.get_value("secret0", "test0")
+
+
+def test_sqlite_store_counts_shared_content(tmp_path):
+    store = _store(tmp_path)
+    store.put_value("secret0", None, "this is test data")
+    store.put_value("secret1", None, "this is test data")
+    store.put_value("secret0", None, "this is other test data")
+
+    assert _blob_refs(tmp_path) == {sha1_digest("this is test data"): 1, sha1_digest("this is other test data"): 1}
+    store.rm("secret1", None)
+    assert _blob_refs(tmp_path) == {sha1_digest("this is other test data"): 1}
+
+
+def test_sqlite_store_failed_batch_changes_nothing(tmp_path):
+    store = _store(tmp_path)
+    store.put_value("secret0", None, "this is test data")
+
+    with pytest.raises(KeyError):
+        with store.batch() as batch:
+            batch.put("secret1", None, "this is other test data")
+            batch.rm("missing", None)
+
+    assert list(store.all().keys()) == ["secret0"]
+    assert _blob_refs(tmp_path) == {sha1_digest("this is test data"): 1}
+
+
+def test_sqlite_store_meta_and_prefix(tmp_path):
+    store = _store(tmp_path)
+    with store.batch() as batch:
+        for name in ["ab/one", "ab/two", "abc/one", "cd/one"]:
+            batch.put(name, "kk", f"value of {name}")
+        batch.set_meta("ab/two", {"type": "example"})
+
+    assert [s.name for s in store.iter_secrets("ab/")] == ["ab/one", "ab/two"]
+    assert [s.name for s in store.iter_secrets("ab")] == ["ab/one", "ab/two", "abc/one"]
+    assert store.get_meta("ab/two").get_type_name() == "example"
+    assert store.get_values([("cd/one", "kk"), ("ab/one", "kk")]) == ["value of cd/one", "value of ab/one"]
+
+
+def test_sqlite_store_streams_binary_values(tmp_path):
+    payload = bytes(range(256)) * 100
+    store = _store(tmp_path)
+    store.put_stream("secret0", "store.pfx", io.BytesIO(payload))
+
+    with store.open_value("secret0", "store.pfx") as handle:
+        assert handle.read() == payload
+
+
+def test_sqlite_store_imports_folder_store(tmp_path):
+    folder = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=TestFileSystemProvider({}))
+    folder.put_value("secret0", "test0", "this is test data")
+    folder.put_value("secret0", "test1", "this is other test data")
+    folder.set_meta("secret0", {"type": "example"})
+    folder.put_value("secret1", None, "this is test data")
+
+    store = _store(tmp_path)
+    store.import_store(folder)
+
+    assert store.all() == folder.all()
+    assert store.get_value("secret0", "test1") == "this is other test data"
+    assert _blob_refs(tmp_path)[sha1_digest("this is test data")] == 2
+
+
+def test_sqlite_store_receives_copied_secrets(tmp_path):
+    folder = FolderKeyStore(FolderKeyStore.Config("/test"), file_system=TestFileSystemProvider({}))
+    folder.put_value("secret0", "test0", "this is test data")
+
+    store = _store(tmp_path)
+    stats = copy_secrets(folder, store, [("secret0", "secret0")])
+
+    assert stats.sent == 1
+    assert store.get_value("secret0", "test0") == "this is test data"
+    assert copy_secrets(folder, store, [("secret0", "secret1")]).skipped == 1
+    assert _blob_refs(tmp_path) == {sha1_digest("this is test data"): 2}
@@ -0,0 +1,209 @@
+import errno
+import io
+import time
+from types import SimpleNamespace
+from typing import Dict
+
+import pytest
+
+from quick_manage._common import FileUpload
+from quick_manage.ssh.client import SSHClient
+from quick_manage.ssh.pool import ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self):
+        self.transport = None
+        self.closed = False
+
+    @property
+    def is_connected(self):
+        return self.transport is not None and not self.closed
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_reuses_connections_by_key():
+    pool = ConnectionPool()
+    first = pool.acquire(("root", "web01"), FakeConnection)
+
+    assert pool.acquire(("root", "web01"), FakeConnection) is first
+    assert pool.acquire(("admin", "web01"), FakeConnection) is not first
+    assert (pool.hits, pool.misses) == (1, 2)
+
+
+def test_pool_closes_least_recently_used_past_max_size():
+    pool = ConnectionPool(max_size=2)
+    for host in ["web01", "web02", "web03"]:
+        with pool.lease(("root", host), FakeConnection) as connection:
+            if host == "web01":
+                oldest = connection
+
+    assert len(pool) == 2
+    assert oldest.closed
+
+
+def test_pool_never_closes_leased_connections():
+    pool = ConnectionPool(max_size=1, idle_timeout=0.01)
+    first = pool.acquire(("root", "web01"), FakeConnection)
+    second = pool.acquire(("root", "web02"), FakeConnection)
+    time.sleep(0.02)
+    pool.acquire(("root", "web03"), FakeConnection)
+
+    assert not first.closed and not second.closed
+    assert len(pool) == 3
+
+    pool.release(first)
+    assert first.closed
+    assert len(pool) == 2
+
+
+def test_pool_closes_idle_connections():
+    pool = ConnectionPool(idle_timeout=0.01)
+    first = pool.acquire(("root", "web01"), FakeConnection)
+    pool.release(first)
+    time.sleep(0.02)
+
+    assert pool.acquire(("root", "web01"), FakeConnection) is not first
+    assert first.closed
+
+
+def test_pool_replaces_dropped_connections():
+    pool = ConnectionPool()
+    first = pool.acquire(("root", "web01"), FakeConnection)
+    first.transport = object()
+    first.closed = True
+
+    assert pool.acquire(("root", "web01"), FakeConnection) is not first
+    assert len(pool) == 1
+
+    pool.close_all()
+    assert len(pool) == 0
+
+
+def test_ssh_clients_share_pooled_connection():
+    pool = ConnectionPool()
+    nets = {"web": "10.0.0.1"}
+    config = SSHClient.Config("root", "web", password="secret")
+    first = SSHClient(config, None, nets, pool=pool)
+    second = SSHClient(SSHClient.Config("root", "web", password="secret"), None, nets, pool=pool)
+    other = SSHClient(SSHClient.Config("root", "web", password="other"), None, nets, pool=pool)
+
+    assert first.connect() is second.connect()
+    assert first.connect() is not other.connect()
+    assert first.connect().host == "10.0.0.1"
+
+
+class FakeAttributes:
+    def __init__(self, mode: int, uid: int, gid: int):
+        self.st_mode, self.st_uid, self.st_gid = mode, uid, gid
+
+
+class FakeSftp:
+    """ An in memory SFTP session holding file contents and attributes by path """
+
+    def __init__(self, files: Dict[str, bytes], attributes: Dict[str, FakeAttributes], fail_on: str = None,
+                 root: bool = True):
+        self.files = files
+        self.attributes = attributes
+        self.fail_on = fail_on
+        self.root = root
+
+    def open(self, path: str, mode: str):
+        sftp = self
+
+        class Handle(io.BytesIO):
+            def set_pipelined(self, pipelined):
+                pass
+
+            def close(self):
+                if sftp.fail_on and sftp.fail_on in path:
+                    raise IOError("No space left on device")
+                sftp.files[path] = self.getvalue()
+                sftp.attributes[path] = FakeAttributes(0o100644, 1000, 1000)
+                super().close()
+
+        return Handle()
+
+    def stat(self, path: str) -> FakeAttributes:
+        if path not in self.attributes:
+            raise IOError(f"No such file {path}")
+        return self.attributes[path]
+
+    def chmod(self, path: str, mode: int):
+        self.attributes[path].st_mode = 0o100000 | mode
+
+    def chown(self, path: str, uid: int, gid: int):
+        if not self.root and uid != 1000:
+            raise PermissionError(errno.EPERM, "Operation not permitted")
+        self.attributes[path].st_uid, self.attributes[path].st_gid = uid, gid
+
+    def posix_rename(self, source: str, destination: str):
+        self.files[destination] = self.files.pop(source)
+        self.attributes[destination] = self.attributes.pop(source)
+
+    def remove(self, path: str):
+        if path not in self.files:
+            raise IOError(f"No such file {path}")
+        self.files.pop(path)
+        self.attributes.pop(path)
+
+
+def _sftp_client(sftp: FakeSftp) -> SSHClient:
+    client = SSHClient(SSHClient.Config("root", "web", password="secret"), None, {"web": "10.0.0.1"},
+                       pool=ConnectionPool())
+    client._connected = SimpleNamespace(sftp=lambda: sftp)
+    return client
+
+
+def test_ssh_put_many_replaces_files_keeping_permissions():
+    sftp = FakeSftp({"/etc/cert.pem": b"old"}, {"/etc/cert.pem": FakeAttributes(0o100640, 0, 33)})
+    _sftp_client(sftp).put_many({"/etc/cert.pem": FileUpload(io.BytesIO(b"new cert")),
+                                 "/etc/key.pem": FileUpload(io.BytesIO(b"new key")),
+                                 "/etc/chain.pem": FileUpload(io.BytesIO(b"new chain"), mode=0o644, uid=0, gid=0)})
+
+    assert sftp.files == {"/etc/cert.pem": b"new cert", "/etc/key.pem": b"new key", "/etc/chain.pem": b"new chain"}
+    modes = {p: (a.st_mode & 0o777, a.st_uid, a.st_gid) for p, a in sftp.attributes.items()}
+    assert modes == {"/etc/cert.pem": (0o640, 0, 33), "/etc/key.pem": (0o600, 1000, 1000),
+                     "/etc/chain.pem": (0o644, 0, 0)}
+
+
+def test_ssh_put_many_failure_leaves_destinations_alone():
+    sftp = FakeSftp({"/etc/cert.pem": b"old"}, {"/etc/cert.pem": FakeAttributes(0o100640, 0, 33)}, fail_on="key")
+    with pytest.raises(IOError):
+        _sftp_client(sftp).put_many({"/etc/cert.pem": FileUpload(io.BytesIO(b"new cert")),
+                                     "/etc/key.pem": FileUpload(io.BytesIO(b"new key"))})
+
+    assert sftp.files == {"/etc/cert.pem": b"old"}
+
+
+def test_ssh_put_many_as_other_user_keeps_mode_of_root_owned_files():
+    sftp = FakeSftp({"/etc/cert.pem": b"old"}, {"/etc/cert.pem": FakeAttributes(0o100640, 0, 33)}, root=False)
+    _sftp_client(sftp).put_many({"/etc/cert.pem": FileUpload(io.BytesIO(b"new cert"))})
+
+    attributes = sftp.attributes["/etc/cert.pem"]
+    assert sftp.files == {"/etc/cert.pem": b"new cert"}
+    assert (attributes.st_mode & 0o777, attributes.st_uid) == (0o640, 1000)
+
+    with pytest.raises(PermissionError):
+        _sftp_client(sftp).put_many({"/etc/key.pem": FileUpload(io.BytesIO(b"new key"), uid=0)})
+    assert "/etc/key.pem" not in sftp.files
+
+
+class ForwardOnlyStream(io.RawIOBase):
+    def __init__(self, data: bytes):
+        self._data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self._data.readinto(buffer)
+
+
+def test_ssh_put_stream_reads_forward_only_streams():
+    sftp = FakeSftp({}, {})
+    _sftp_client(sftp).put_stream("/etc/cert.pem", io.BufferedReader(ForwardOnlyStream(b"new cert")))
+
+    assert sftp.files == {"/etc/cert.pem": b"new cert"}
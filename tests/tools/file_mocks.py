@@ -1,8 +1,9 @@
 import os
 import io
 import hashlib
+from contextlib import nullcontext
 from copy import deepcopy
-from typing import TextIO, Optional, Callable, List, Dict, Tuple
+from typing import TextIO, BinaryIO, Optional, Callable, List, Dict, Tuple
 
 from quick_manage.file import IFileProvider, FileInfo
 
@@ -17,6 +18,16 @@ class StringWrapper(io.StringIO):
         super().__exit__(exc_type, exc_val, exc_tb)
 
 
+class BytesWrapper(io.BytesIO):
+    def __init__(self, on_close: Callable[[bytes], None]):
+        super().__init__()
+        self.on_close = on_close
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.on_close(self.getvalue())
+        super().__exit__(exc_type, exc_val, exc_tb)
+
+
 class TestFileSystemProvider(IFileProvider):
     """
         Mock for FileSystemProvider that operates on an in memory python dictionary.  The dictionary should
@@ -34,6 +45,7 @@ class TestFileSystemProvider(IFileProvider):
 
     def __init__(self, internal: Dict):
         self.internal = internal
+        self._writes = 0
 
     def checksum(self, path: str) -> str:
         raise NotImplementedError()
@@ -66,16 +78,57 @@ class TestFileSystemProvider(IFileProvider):
             self.internal[path] = {}
 
         def write_action(s: str):
+            self._writes += 1
             self.internal[path]["content"] = s
+            self.internal[path]["modified"] = self._writes
 
         return StringWrapper(write_action)
 
+    def write_binary(self, path) -> BinaryIO:
+        if path not in self.internal:
+            self.internal[path] = {}
+
+        def write_action(b: bytes):
+            self._writes += 1
+            self.internal[path]["content"] = b
+            self.internal[path]["modified"] = self._writes
+
+        return BytesWrapper(write_action)
+
+    def append_file(self, path) -> TextIO:
+        existing = self.internal.get(path, {}).get("content", "")
+        if path not in self.internal:
+            self.internal[path] = {}
+
+        def append_action(s: str):
+            self._writes += 1
+            self.internal[path]["content"] = existing + s
+            self.internal[path]["modified"] = self._writes
+
+        return StringWrapper(append_action)
+
+    def write_file_atomic(self, path, binary: bool = False):
+        return self.write_binary(path) if binary else self.write_file(path)
+
+    def lock(self, path: str):
+        return nullcontext()
+
     def read_file(self, path) -> TextIO:
-        return io.StringIO(self.internal[path]["content"])
+        content = self.internal[path]["content"]
+        return io.StringIO(content.decode("utf-8") if isinstance(content, bytes) else content)
+
+    def read_binary(self, path) -> BinaryIO:
+        content = self.internal[path]["content"]
+        return io.BytesIO(content.encode("utf-8") if isinstance(content, str) else content)
 
     def move_file(self, source: str, dest: str):
         self.internal[dest] = deepcopy(self.internal[source])
         del self.internal[source]
 
+    def signature(self, path: str) -> Optional[Tuple]:
+        if path not in self.internal:
+            return None
+        return self.internal[path].get("modified", None), len(self.internal[path].get("content", ""))
+
     def exists(self, path: str) -> bool:
         return path in self.internal
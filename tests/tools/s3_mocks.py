@@ -0,0 +1,109 @@
+import hashlib
+import io
+from typing import Dict, Optional, BinaryIO
+
+from minio import S3Error
+from minio.error import ServerError
+
+
+class TestResponse:
+    def __init__(self, data: bytes, etag: str):
+        self.data = data
+        self.headers = {"etag": f'"{etag}"', "content-length": str(len(data))}
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        return self._stream.read(amt)
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class TestWriteResult:
+    def __init__(self, object_name: str, etag: str):
+        self.object_name = object_name
+        self.etag = etag
+
+
+class TestObject:
+    def __init__(self, object_name: str, size: int):
+        self.object_name = object_name
+        self.size = size
+
+
+class TestMinio:
+    """
+        Mock for the parts of the minio client used by the S3 key store, operating on an in memory dictionary of
+        object names to their contents. Requests are counted by operation name in `calls`.
+    """
+
+    def __init__(self, objects: Optional[Dict[str, bytes]] = None):
+        self.objects: Dict[str, bytes] = objects if objects is not None else {}
+        self.calls: Dict[str, int] = {}
+
+    def _count(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    @staticmethod
+    def _etag(data: bytes) -> str:
+        return hashlib.md5(data).hexdigest()
+
+    @staticmethod
+    def _missing(object_name: str) -> S3Error:
+        return S3Error("NoSuchKey", "Object does not exist", object_name, None, None, None)
+
+    def get_object(self, bucket_name: str, object_name: str, request_headers: Optional[Dict] = None, **kwargs):
+        self._count("get_object")
+        if object_name not in self.objects:
+            raise self._missing(object_name)
+
+        data = self.objects[object_name]
+        etag = self._etag(data)
+        if request_headers and request_headers.get("If-None-Match", None) == f'"{etag}"':
+            raise ServerError("server failed with HTTP status code 304", 304)
+
+        return TestResponse(data, etag)
+
+    def put_object(self, bucket_name: str, object_name: str, data: BinaryIO, length: int, **kwargs):
+        self._count("put_object")
+        raw = data.read(length) if length >= 0 else data.read()
+        self.objects[object_name] = raw
+        return TestWriteResult(object_name, self._etag(raw))
+
+    def _put_object(self, bucket_name: str, object_name: str, data: bytes, headers: Dict, query_params=None):
+        self._count("put_object")
+        existing = self.objects.get(object_name, None)
+        if_match = headers.get("If-Match", None)
+        if_none_match = headers.get("If-None-Match", None)
+        if (if_match is not None and (existing is None or if_match != f'"{self._etag(existing)}"')) or \
+                (if_none_match == "*" and existing is not None):
+            raise S3Error("PreconditionFailed", "At least one of the pre-conditions you specified did not hold",
+                          object_name, None, None, None)
+
+        self.objects[object_name] = data
+        return TestWriteResult(object_name, self._etag(data))
+
+    def stat_object(self, bucket_name: str, object_name: str, **kwargs):
+        self._count("stat_object")
+        if object_name not in self.objects:
+            raise self._missing(object_name)
+        return TestObject(object_name, len(self.objects[object_name]))
+
+    def copy_object(self, bucket_name: str, object_name: str, source, **kwargs):
+        """ Copies within the same in memory objects, so the source bucket name is ignored """
+        self._count("copy_object")
+        if source.object_name not in self.objects:
+            raise self._missing(source.object_name)
+        self.objects[object_name] = self.objects[source.object_name]
+        return TestWriteResult(object_name, self._etag(self.objects[object_name]))
+
+    def remove_object(self, bucket_name: str, object_name: str, **kwargs):
+        self._count("remove_object")
+        self.objects.pop(object_name, None)
+
+    def list_objects(self, bucket_name: str, prefix: Optional[str] = None, recursive: bool = False, **kwargs):
+        self._count("list_objects")
+        return [TestObject(k, len(v)) for k, v in sorted(self.objects.items()) if k.startswith(prefix or "")]